@@ -1,3 +1,4 @@
+from .dtls import RTCCertificate  # noqa
 from .exceptions import InvalidAccessError, InvalidStateError  # noqa
 from .mediastreams import AudioStreamTrack, VideoStreamTrack  # noqa
 from .rtcdatachannel import RTCDataChannel  # noqa
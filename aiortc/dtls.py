@@ -1,10 +1,12 @@
 import asyncio
 import base64
 import binascii
+import datetime
 import enum
 import logging
 import os
 import struct
+from collections import OrderedDict
 
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.bindings.openssl.binding import Binding
@@ -13,18 +15,36 @@ from cryptography.hazmat.primitives.serialization import (Encoding,
                                                           NoEncryption,
                                                           PrivateFormat)
 from OpenSSL import crypto
-from pylibsrtp import Policy, Session
+from pylibsrtp import Error, Policy, Session
 
+from .instrumentation import NULL_INSTRUMENTATION
 from .rtp import is_rtcp
-from .utils import first_completed
+from .utils import ClosableQueue, first_completed
 
 binding = Binding()
 binding.init_static_locks()
 ffi = binding.ffi
 lib = binding.lib
 
-SRTP_KEY_LEN = 16
-SRTP_SALT_LEN = 14
+CERTIFICATE_LIFETIME = datetime.timedelta(days=30)
+CERTIFICATE_RENEWAL = datetime.timedelta(days=1)
+
+# maximum size of the datagrams we send, leaving room for IP, UDP and TURN headers
+DTLS_MTU = 1400
+
+# size of a DTLS record header
+DTLS_RECORD_HEADER_LENGTH = 13
+
+# number of client sessions kept for resumption
+SESSION_CACHE_SIZE = 64
+SESSION_ID_CONTEXT = b'aiortc'
+
+# ECDHE key exchange with ECDSA authentication, AEAD ciphers only
+DTLS_CIPHERS = b':'.join([
+    b'ECDHE-ECDSA-AES128-GCM-SHA256',
+    b'ECDHE-ECDSA-CHACHA20-POLY1305',
+    b'ECDHE-ECDSA-AES256-GCM-SHA384',
+])
 
 
 logger = logging.getLogger('dtls')
@@ -64,11 +84,11 @@ def generate_key():
     return crypto.load_privatekey(crypto.FILETYPE_PEM, key_pem)
 
 
-def generate_certificate(key):
+def generate_certificate(key, lifetime=CERTIFICATE_LIFETIME):
     cert = crypto.X509()
     cert.get_subject().CN = binascii.hexlify(os.urandom(16)).decode('ascii')
     cert.gmtime_adj_notBefore(-86400)
-    cert.gmtime_adj_notAfter(30 * 86400)
+    cert.gmtime_adj_notAfter(int(lifetime.total_seconds()))
     cert.set_version(2)
     cert.set_serial_number(struct.unpack('!L', os.urandom(4))[0])
     cert.set_issuer(cert.get_subject())
@@ -77,13 +97,69 @@ def generate_certificate(key):
     return cert
 
 
-def get_srtp_key_salt(src, idx):
-    key_start = idx * SRTP_KEY_LEN
-    salt_start = 2 * SRTP_KEY_LEN + idx * SRTP_SALT_LEN
-    return (
-        src[key_start:key_start + SRTP_KEY_LEN] +
-        src[salt_start:salt_start + SRTP_SALT_LEN]
-    )
+class SrtpProfile:
+    """
+    An SRTP protection profile, which can be negotiated by DTLS.
+    """
+    def __init__(self, openssl_profile, libsrtp_profile, key_length, salt_length):
+        self.openssl_profile = openssl_profile
+        self.libsrtp_profile = libsrtp_profile
+        self.key_length = key_length
+        self.salt_length = salt_length
+
+    def is_supported(self):
+        """
+        Return True if libsrtp can protect packets using this profile.
+
+        AEAD profiles are only available if libsrtp was built with OpenSSL.
+        """
+        try:
+            Session(Policy(key=bytes(self.key_length + self.salt_length),
+                           ssrc_type=Policy.SSRC_ANY_OUTBOUND,
+                           srtp_profile=self.libsrtp_profile))
+        except Error:
+            return False
+        return True
+
+    def get_key_and_salt(self, src, idx):
+        key_start = idx * self.key_length
+        salt_start = 2 * self.key_length + idx * self.salt_length
+        return (
+            src[key_start:key_start + self.key_length] +
+            src[salt_start:salt_start + self.salt_length]
+        )
+
+
+# SRTP profiles supported by libsrtp, in order of preference
+SRTP_PROFILES = [x for x in [
+    SrtpProfile(b'SRTP_AEAD_AES_128_GCM', Policy.SRTP_PROFILE_AEAD_AES_128_GCM, 16, 12),
+    SrtpProfile(b'SRTP_AEAD_AES_256_GCM', Policy.SRTP_PROFILE_AEAD_AES_256_GCM, 32, 12),
+    SrtpProfile(b'SRTP_AES128_CM_SHA1_80', Policy.SRTP_PROFILE_AES128_CM_SHA1_80, 16, 14),
+] if x.is_supported()]
+
+
+def coalesce_records(data, mtu):
+    """
+    Split a stream of DTLS records into datagrams of at most `mtu` bytes,
+    without splitting any record across datagrams.
+    """
+    datagrams = []
+    datagram = b''
+    pos = 0
+    while pos < len(data):
+        length = DTLS_RECORD_HEADER_LENGTH + struct.unpack_from(
+            '!H', data, pos + DTLS_RECORD_HEADER_LENGTH - 2)[0]
+        record = data[pos:pos + length]
+        pos += length
+
+        if datagram and len(datagram) + len(record) > mtu:
+            datagrams.append(datagram)
+            datagram = b''
+        datagram += record
+
+    if datagram:
+        datagrams.append(datagram)
+    return datagrams
 
 
 @ffi.callback('int(int, X509_STORE_CTX *)')
@@ -91,59 +167,203 @@ def verify_callback(x, y):
     return 1
 
 
+class RTCDtlsFingerprint:
+    """
+    The RTCDtlsFingerprint dictionary includes the hash function algorithm
+    and certificate fingerprint.
+    """
+    def __init__(self, algorithm, value):
+        self.algorithm = algorithm
+        self.value = value
+
+
+class RTCCertificate:
+    """
+    The RTCCertificate interface enables the certificates used by an
+    RTCPeerConnection's DTLS sessions.
+
+    Use :meth:`generateCertificate` to create one.
+    """
+    def __init__(self, key, cert):
+        self._key = key
+        self._cert = cert
+        self.__context = None
+        self.__fingerprint = None
+
+    @property
+    def expires(self):
+        """
+        The date and time after which the certificate will be considered invalid.
+        """
+        return datetime.datetime.strptime(
+            self._cert.get_notAfter().decode('ascii'),
+            '%Y%m%d%H%M%SZ').replace(tzinfo=datetime.timezone.utc)
+
+    def getFingerprints(self):
+        """
+        Returns the list of certificate fingerprints, one of which is computed
+        with the digest algorithm used in the certificate signature.
+        """
+        if self.__fingerprint is None:
+            self.__fingerprint = certificate_digest(self._cert._x509)
+        return [RTCDtlsFingerprint(algorithm='sha-256', value=self.__fingerprint)]
+
+    @classmethod
+    def generateCertificate(cls, lifetime=CERTIFICATE_LIFETIME):
+        """
+        Create and return an X.509 certificate and corresponding private key,
+        valid for `lifetime`.
+        """
+        key = generate_key()
+        cert = generate_certificate(key, lifetime=lifetime)
+        return cls(key=key, cert=cert)
+
+    def _get_context(self):
+        """
+        Return the :class:`DtlsSrtpContext` using this certificate, which is
+        created once and shared by all the sessions.
+        """
+        if self.__context is None:
+            self.__context = DtlsSrtpContext(certificate=self)
+        return self.__context
+
+
+class CertificatePool:
+    """
+    Hands out a certificate shared by peer connections, which is replaced
+    once it is about to expire.
+    """
+    def __init__(self, lifetime=CERTIFICATE_LIFETIME, renewal=CERTIFICATE_RENEWAL):
+        self.lifetime = lifetime
+        self.renewal = renewal
+        self._certificate = None
+
+    def get(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if self._certificate is None or self._certificate.expires - now < self.renewal:
+            self._certificate = RTCCertificate.generateCertificate(lifetime=self.lifetime)
+        return self._certificate
+
+
+certificate_pool = CertificatePool()
+
+
 class DtlsSrtpContext:
-    def __init__(self):
-        ctx = lib.SSL_CTX_new(lib.DTLSv1_method())
+    def __init__(self, certificate=None):
+        ctx = lib.SSL_CTX_new(lib.DTLS_method())
         self.ctx = ffi.gc(ctx, lib.SSL_CTX_free)
 
+        # only allow DTLS 1.2
+        lib.SSL_CTX_set_options(self.ctx, lib.SSL_OP_NO_DTLSv1)
+
         lib.SSL_CTX_set_verify(self.ctx, lib.SSL_VERIFY_PEER | lib.SSL_VERIFY_FAIL_IF_NO_PEER_CERT,
                                verify_callback)
 
         # generate key and certificate
-        key = generate_key()
-        cert = generate_certificate(key)
-
-        _openssl_assert(lib.SSL_CTX_use_certificate(self.ctx, cert._x509) == 1)
-        _openssl_assert(lib.SSL_CTX_use_PrivateKey(self.ctx, key._pkey) == 1)
-        _openssl_assert(lib.SSL_CTX_set_cipher_list(self.ctx, b'HIGH:!CAMELLIA:!aNULL') == 1)
-        _openssl_assert(lib.SSL_CTX_set_tlsext_use_srtp(self.ctx, b'SRTP_AES128_CM_SHA1_80') == 0)
+        if certificate is None:
+            certificate = RTCCertificate.generateCertificate()
+        self.certificate = certificate
+
+        _openssl_assert(lib.SSL_CTX_use_certificate(self.ctx, certificate._cert._x509) == 1)
+        _openssl_assert(lib.SSL_CTX_use_PrivateKey(self.ctx, certificate._key._pkey) == 1)
+        _openssl_assert(lib.SSL_CTX_set_cipher_list(self.ctx, DTLS_CIPHERS) == 1)
+        _openssl_assert(lib.SSL_CTX_set_ecdh_auto(self.ctx, 1) == 1)
+        _openssl_assert(lib.SSL_CTX_set_tlsext_use_srtp(
+            self.ctx, b':'.join(x.openssl_profile for x in SRTP_PROFILES)) == 0)
         _openssl_assert(lib.SSL_CTX_set_read_ahead(self.ctx, 1) == 0)
 
+        # allow sessions to be resumed
+        _openssl_assert(lib.SSL_CTX_set_session_id_context(
+            self.ctx, SESSION_ID_CONTEXT, len(SESSION_ID_CONTEXT)) == 1)
+        self.sessions = OrderedDict()
+
+    def get_session(self, fingerprint):
+        """
+        Return the session to resume with the remote party whose certificate
+        has the given fingerprint, or `None`.
+        """
+        return self.sessions.get(fingerprint.upper())
+
+    def store_session(self, fingerprint, session):
+        """
+        Remember a client session for resumption, evicting the oldest one
+        once the cache is full.
+        """
+        fingerprint = fingerprint.upper()
+        self.sessions.pop(fingerprint, None)
+        self.sessions[fingerprint] = ffi.gc(session, lib.SSL_SESSION_free)
+        while len(self.sessions) > SESSION_CACHE_SIZE:
+            self.sessions.popitem(last=False)
+
 
 class Channel:
-    def __init__(self, closed, queue, send):
+    def __init__(self, closed, queue, send, send_batch=None):
         self.closed = closed
+        self.handler = None
         self.queue = queue
         self.send = send
+        if send_batch is not None:
+            self.send_batch = send_batch
 
     async def recv(self):
-        data = await first_completed(self.queue.get(), self.closed.wait())
-        if data is True:
-            raise ConnectionError
-        return data
+        return await self.queue.get()
+
+    async def send_batch(self, batch):
+        for data in batch:
+            await self.send(data)
+
+    def set_handler(self, handler):
+        """
+        Deliver received datagrams by calling `handler(data)` directly,
+        instead of queueing them for :meth:`recv`. Datagrams which are
+        already queued are delivered first.
+
+        Pass `None` to go back to queueing.
+        """
+        self.handler = handler
+        while handler is not None and not self.queue.empty():
+            self._deliver(self.queue.get_nowait())
+
+    def _deliver(self, data):
+        if self.handler is None:
+            self.queue.put_nowait(data)
+            return
+
+        # the handler runs inside the receive loop, a bad packet must not
+        # tear down the session
+        try:
+            self.handler(data)
+        except Exception:
+            logger.exception('Error handling received datagram')
 
 
 class DtlsSrtpSession:
     def __init__(self, context, is_server, transport):
         self.closed = asyncio.Event()
         self.encrypted = False
+        self.instrumentation = NULL_INSTRUMENTATION
         self.is_server = is_server
         self.remote_fingerprint = None
+        self.resumed = False
         self.role = self.is_server and 'server' or 'client'
+        self.srtp_profile = None
         self.state = self.State.CLOSED
         self.transport = transport
+        self._context = context
+        self._run_task = None
 
-        self.data_queue = asyncio.Queue()
+        self.data_queue = ClosableQueue()
         self.data = Channel(
             closed=self.closed,
             queue=self.data_queue,
             send=self._send_data)
 
-        self.rtp_queue = asyncio.Queue()
+        self.rtp_queue = ClosableQueue()
         self.rtp = Channel(
             closed=self.closed,
             queue=self.rtp_queue,
-            send=self._send_rtp)
+            send=self._send_rtp,
+            send_batch=self._send_rtp_batch)
 
         ssl = lib.SSL_new(context.ctx)
         self.ssl = ffi.gc(ssl, lib.SSL_free)
@@ -151,28 +371,39 @@ class DtlsSrtpSession:
         self.read_bio = lib.BIO_new(lib.BIO_s_mem())
         self.read_cdata = ffi.new('char[]', 1500)
         self.write_bio = lib.BIO_new(lib.BIO_s_mem())
-        self.write_cdata = ffi.new('char[]', 1500)
+        self.write_cdata = ffi.new('char[]', DTLS_MTU)
         lib.SSL_set_bio(self.ssl, self.read_bio, self.write_bio)
 
+        # memory BIOs cannot be queried for the MTU, so set it explicitly
+        lib.SSL_set_options(self.ssl, lib.SSL_OP_NO_QUERY_MTU)
+        _openssl_assert(lib.DTLS_set_link_mtu(self.ssl, DTLS_MTU) == 1)
+
         if self.is_server:
             lib.SSL_set_accept_state(self.ssl)
         else:
             lib.SSL_set_connect_state(self.ssl)
 
         # local fingerprint
-        x509 = lib.SSL_get_certificate(self.ssl)
-        self.local_fingerprint = certificate_digest(x509)
+        self.local_fingerprint = context.certificate.getFingerprints()[0].value
 
     async def close(self):
         if self.state != self.State.CLOSED:
             lib.SSL_shutdown(self.ssl)
             await self._write_ssl()
             logger.debug('%s - DTLS shutdown complete', self.role)
-            self.closed.set()
+            self._set_closed()
+            if self._run_task is not None:
+                self._run_task.cancel()
 
     async def connect(self):
         assert self.state == self.State.CLOSED
 
+        # try to resume our previous session with the remote party
+        if not self.is_server:
+            session = self._context.get_session(self.remote_fingerprint)
+            if session is not None:
+                _openssl_assert(lib.SSL_set_session(self.ssl, session) == 1)
+
         self._set_state(self.State.CONNECTING)
         while not self.encrypted:
             result = lib.SSL_do_handshake(self.ssl)
@@ -184,7 +415,13 @@ class DtlsSrtpSession:
 
             error = lib.SSL_get_error(self.ssl, result)
             if error == lib.SSL_ERROR_WANT_READ:
-                await self._recv_next()
+                try:
+                    await asyncio.wait_for(self._recv_next(), timeout=self._get_timeout())
+                except asyncio.TimeoutError:
+                    # retransmit our last flight
+                    logger.debug('%s - DTLS handshake timeout', self.role)
+                    if lib.DTLSv1_handle_timeout(self.ssl) < 0:
+                        raise DtlsError('DTLS handshake timed out')
             else:
                 raise DtlsError('DTLS handshake failed (error %d)' % error)
 
@@ -194,63 +431,114 @@ class DtlsSrtpSession:
         if remote_fingerprint != self.remote_fingerprint.upper():
             raise DtlsError('DTLS fingerprint does not match')
 
+        self.resumed = bool(lib.SSL_session_reused(self.ssl))
+        if not self.is_server:
+            self._context.store_session(self.remote_fingerprint, lib.SSL_get1_session(self.ssl))
+
+        # find negotiated SRTP profile
+        selected = lib.SSL_get_selected_srtp_profile(self.ssl)
+        if selected == ffi.NULL:
+            raise DtlsError('DTLS handshake did not negotiate an SRTP profile')
+        name = ffi.string(selected.name)
+        for srtp_profile in SRTP_PROFILES:
+            if srtp_profile.openssl_profile == name:
+                self.srtp_profile = srtp_profile
+                break
+        else:
+            raise DtlsError('DTLS handshake negotiated an unsupported SRTP profile')
+
         # generate keying material
-        buf = ffi.new('unsigned char[]', 2 * (SRTP_KEY_LEN + SRTP_SALT_LEN))
+        buf = ffi.new('unsigned char[]', 2 * (srtp_profile.key_length + srtp_profile.salt_length))
         extractor = b'EXTRACTOR-dtls_srtp'
         _openssl_assert(lib.SSL_export_keying_material(
             self.ssl, buf, len(buf), extractor, len(extractor), ffi.NULL, 0, 0) == 1)
 
         view = ffi.buffer(buf)
         if self.is_server:
-            srtp_tx_key = get_srtp_key_salt(view, 1)
-            srtp_rx_key = get_srtp_key_salt(view, 0)
+            srtp_tx_key = srtp_profile.get_key_and_salt(view, 1)
+            srtp_rx_key = srtp_profile.get_key_and_salt(view, 0)
         else:
-            srtp_tx_key = get_srtp_key_salt(view, 0)
-            srtp_rx_key = get_srtp_key_salt(view, 1)
+            srtp_tx_key = srtp_profile.get_key_and_salt(view, 0)
+            srtp_rx_key = srtp_profile.get_key_and_salt(view, 1)
 
-        rx_policy = Policy(key=srtp_rx_key, ssrc_type=Policy.SSRC_ANY_INBOUND)
+        rx_policy = Policy(key=srtp_rx_key, ssrc_type=Policy.SSRC_ANY_INBOUND,
+                           srtp_profile=srtp_profile.libsrtp_profile)
         self._rx_srtp = Session(rx_policy)
-        tx_policy = Policy(key=srtp_tx_key, ssrc_type=Policy.SSRC_ANY_OUTBOUND)
+        tx_policy = Policy(key=srtp_tx_key, ssrc_type=Policy.SSRC_ANY_OUTBOUND,
+                           srtp_profile=srtp_profile.libsrtp_profile)
         self._tx_srtp = Session(tx_policy)
 
         # start data pump
-        logger.debug('%s - DTLS handshake complete', self.role)
+        logger.debug('%s - DTLS handshake complete%s', self.role,
+                     self.resumed and ' (resumed)' or '')
         self._set_state(self.State.CONNECTED)
-        asyncio.ensure_future(self.__run())
+        self._run_task = asyncio.ensure_future(self.__run())
 
     async def __run(self):
         try:
+            # the loop is cancelled by close() rather than racing each
+            # datagram against the closed event
             while True:
-                await self._recv_next()
-        except ConnectionError:
+                transport = self.transport
+                try:
+                    data = await transport.recv()
+                except ConnectionError:
+                    if transport is self.transport:
+                        raise
+
+                    # the transport was replaced, for instance by an ICE
+                    # restart, keep the association and carry on
+                    logger.debug('%s - DTLS transport replaced', self.role)
+                    continue
+                await self._handle_datagram(data)
+        except (asyncio.CancelledError, ConnectionError):
             pass
         finally:
             self._set_state(self.State.CLOSED)
-            self.closed.set()
+            self._set_closed()
 
     async def _recv_next(self):
         data = await first_completed(self.transport.recv(), self.closed.wait())
         if data is True:
             # session was closed
             raise ConnectionError
+        await self._handle_datagram(data)
 
+    async def _handle_datagram(self, data):
         first_byte = data[0]
         if first_byte > 19 and first_byte < 64:
             # DTLS
-            lib.BIO_write(self.read_bio, data, len(data))
-            result = lib.SSL_read(self.ssl, self.read_cdata, len(self.read_cdata))
+            with self.instrumentation.measure('recv'):
+                lib.BIO_write(self.read_bio, data, len(data))
+
+                # a datagram may contain several records
+                records = []
+                while True:
+                    result = lib.SSL_read(self.ssl, self.read_cdata, len(self.read_cdata))
+                    if result <= 0:
+                        break
+                    records.append(ffi.buffer(self.read_cdata)[0:result])
+
+            # send any retransmission triggered by the remote party
+            await self._write_ssl()
+
+            for record in records:
+                self.data._deliver(record)
             if result == 0:
                 logger.debug('%s - DTLS shutdown by remote party' % self.role)
                 raise ConnectionError
-            elif result > 0:
-                await self.data_queue.put(ffi.buffer(self.read_cdata)[0:result])
         elif first_byte > 127 and first_byte < 192:
             # SRTP / SRTCP
-            if is_rtcp(data):
-                data = self._rx_srtp.unprotect_rtcp(data)
-            else:
-                data = self._rx_srtp.unprotect(data)
-            await self.rtp_queue.put(data)
+            with self.instrumentation.measure('unprotect'):
+                try:
+                    if is_rtcp(data):
+                        data = self._rx_srtp.unprotect_rtcp(data)
+                    else:
+                        data = self._rx_srtp.unprotect(data)
+                except Error as exc:
+                    logger.debug('%s - dropping SRTP packet: %s', self.role, exc)
+                    return
+            self.rtp._deliver(data)
 
     async def _send_data(self, data):
         if self.state != self.State.CONNECTED:
@@ -263,11 +551,45 @@ class DtlsSrtpSession:
         if self.state != self.State.CONNECTED:
             raise ConnectionError('Cannot send encrypted RTP, not connected')
 
-        if is_rtcp(data):
-            data = self._tx_srtp.protect_rtcp(data)
-        else:
-            data = self._tx_srtp.protect(data)
-        await self.transport.send(data)
+        with self.instrumentation.measure('protect'):
+            if is_rtcp(data):
+                data = self._tx_srtp.protect_rtcp(data)
+            else:
+                data = self._tx_srtp.protect(data)
+        with self.instrumentation.measure('send'):
+            await self.transport.send(data)
+
+    async def _send_rtp_batch(self, batch):
+        """
+        Protect several RTP / RTCP packets, such as those of a video frame,
+        in a single pass before handing them to the transport.
+        """
+        if self.state != self.State.CONNECTED:
+            raise ConnectionError('Cannot send encrypted RTP, not connected')
+
+        protect = self._tx_srtp.protect
+        protect_rtcp = self._tx_srtp.protect_rtcp
+        with self.instrumentation.measure('protect'):
+            batch = [protect_rtcp(data) if is_rtcp(data) else protect(data) for data in batch]
+        with self.instrumentation.measure('send'):
+            for data in batch:
+                await self.transport.send(data)
+
+    def _get_timeout(self):
+        """
+        Return the number of seconds until OpenSSL's DTLS retransmission
+        timer expires, or `None` if it is not running.
+        """
+        ptv_sec = ffi.new('time_t *')
+        ptv_usec = ffi.new('long *')
+        if lib.Cryptography_DTLSv1_get_timeout(self.ssl, ptv_sec, ptv_usec):
+            return ptv_sec[0] + (ptv_usec[0] / 1000000)
+        return None
+
+    def _set_closed(self):
+        self.closed.set()
+        self.data_queue.close()
+        self.rtp_queue.close()
 
     def _set_state(self, state):
         if state != self.state:
@@ -277,11 +599,18 @@ class DtlsSrtpSession:
     async def _write_ssl(self):
         """
         Flush outgoing data which OpenSSL put in our BIO to the transport.
+
+        The BIO is drained completely, and the records it contains are
+        coalesced into datagrams of up to `DTLS_MTU` bytes.
         """
         pending = lib.BIO_ctrl_pending(self.write_bio)
         if pending > 0:
-            result = lib.BIO_read(self.write_bio, self.write_cdata, len(self.write_cdata))
-            await self.transport.send(ffi.buffer(self.write_cdata)[0:result])
+            if pending > len(self.write_cdata):
+                self.write_cdata = ffi.new('char[]', pending)
+            result = lib.BIO_read(self.write_bio, self.write_cdata, pending)
+            data = ffi.buffer(self.write_cdata)[0:result]
+            for datagram in coalesce_records(data, DTLS_MTU):
+                await self.transport.send(datagram)
 
     class State(enum.Enum):
         CLOSED = 0
@@ -0,0 +1,179 @@
+"""
+Opt-in instrumentation of the media pipeline.
+
+The time spent in each pipeline stage is recorded in histograms, so that a
+stage which blocks the event loop can be identified. The stages are:
+
+- ``recv``: reading DTLS records from a datagram received from ICE
+- ``unprotect``: SRTP / SRTCP decryption
+- ``parse``: RTP / RTCP parsing
+- ``jitter``: jitter buffer insertion and frame assembly
+- ``decode``: audio / video decoding
+- ``encode``: audio / video encoding
+- ``protect``: SRTP / SRTCP encryption
+- ``send``: handing a datagram to ICE
+"""
+import asyncio
+import bisect
+import time
+
+STAGES = ['recv', 'unprotect', 'parse', 'jitter', 'decode', 'encode', 'protect', 'send']
+
+# histogram bucket upper bounds in seconds, from 1 microsecond to ~ 1 second
+BUCKET_BOUNDS = [0.000001 * 2 ** i for i in range(21)]
+
+LOOP_LAG_INTERVAL = 0.1
+
+clock = time.perf_counter
+
+
+class Histogram:
+    """
+    A histogram of durations in seconds, with fixed exponential buckets.
+    """
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {
+            'buckets': list(zip(BUCKET_BOUNDS + [float('inf')], self.buckets)),
+            'count': self.count,
+            'sum': self.sum,
+        }
+
+
+class Timer:
+    """
+    Context manager which records the time spent in its body.
+    """
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = clock()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(clock() - self.started)
+
+
+class NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Instrumentation:
+    """
+    Per peer connection pipeline timings and event loop lag.
+    """
+    def __init__(self, label):
+        self.label = label
+        self.loop_lag = Histogram()
+        self.stages = dict((stage, Histogram()) for stage in STAGES)
+        self._lag_task = None
+
+    def measure(self, stage):
+        """
+        Return a context manager which records the time spent in `stage`.
+        """
+        return Timer(self.stages[stage])
+
+    def snapshot(self):
+        """
+        Return the recorded histograms as a dictionary.
+        """
+        return {
+            'label': self.label,
+            'loop_lag': self.loop_lag.snapshot(),
+            'stages': dict((stage, histogram.snapshot())
+                           for stage, histogram in self.stages.items()),
+        }
+
+    def start(self):
+        """
+        Start sampling the event loop lag.
+        """
+        if self._lag_task is None:
+            self._lag_task = asyncio.ensure_future(self.__sample_loop_lag())
+
+    def stop(self):
+        """
+        Stop sampling the event loop lag.
+        """
+        if self._lag_task is not None:
+            self._lag_task.cancel()
+            self._lag_task = None
+
+    async def __sample_loop_lag(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            expected = loop.time() + LOOP_LAG_INTERVAL
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag.observe(max(0, loop.time() - expected))
+
+
+class NullInstrumentation:
+    """
+    Instrumentation which records nothing, used when it is not enabled.
+    """
+    def measure(self, stage):
+        return NULL_TIMER
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+def _format_histogram(lines, name, labels, histogram):
+    label_text = ','.join('%s="%s"' % item for item in labels)
+    cumulative = 0
+    for bound, count in zip(BUCKET_BOUNDS + [None], histogram.buckets):
+        cumulative += count
+        le = '+Inf' if bound is None else repr(bound)
+        lines.append('%s_bucket{%s,le="%s"} %d' % (name, label_text, le, cumulative))
+    lines.append('%s_sum{%s} %r' % (name, label_text, float(histogram.sum)))
+    lines.append('%s_count{%s} %d' % (name, label_text, histogram.count))
+
+
+def prometheus_text(instrumentations):
+    """
+    Render the histograms of several :class:`Instrumentation` in the
+    Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP aiortc_stage_seconds Time spent in each media pipeline stage.',
+        '# TYPE aiortc_stage_seconds histogram',
+    ]
+    for instrumentation in instrumentations:
+        for stage in STAGES:
+            _format_histogram(
+                lines, 'aiortc_stage_seconds',
+                [('connection', instrumentation.label), ('stage', stage)],
+                instrumentation.stages[stage])
+
+    lines += [
+        '# HELP aiortc_loop_lag_seconds Delay with which event loop timers fire.',
+        '# TYPE aiortc_loop_lag_seconds histogram',
+    ]
+    for instrumentation in instrumentations:
+        _format_histogram(
+            lines, 'aiortc_loop_lag_seconds',
+            [('connection', instrumentation.label)],
+            instrumentation.loop_lag)
+
+    return '\n'.join(lines) + '\n'
@@ -1,14 +1,27 @@
 import asyncio
+import logging
+import mmap
+import time
+from collections import deque
 from struct import pack, unpack
 
 from pyee import EventEmitter
 
+from .utils import first_completed
+
+logger = logging.getLogger('datachannel')
+
 # message types
 DATA_CHANNEL_ACK = 2
 DATA_CHANNEL_OPEN = 3
 
 # channel types
-DATA_CHANNEL_RELIABLE = 0
+DATA_CHANNEL_RELIABLE = 0x00
+DATA_CHANNEL_PARTIAL_RELIABLE_REXMIT = 0x01
+DATA_CHANNEL_PARTIAL_RELIABLE_TIMED = 0x02
+DATA_CHANNEL_RELIABLE_UNORDERED = 0x80
+DATA_CHANNEL_PARTIAL_RELIABLE_REXMIT_UNORDERED = 0x81
+DATA_CHANNEL_PARTIAL_RELIABLE_TIMED_UNORDERED = 0x82
 
 WEBRTC_DCEP = 50
 WEBRTC_STRING = 51
@@ -16,59 +29,149 @@ WEBRTC_BINARY = 53
 WEBRTC_STRING_EMPTY = 56
 WEBRTC_BINARY_EMPTY = 57
 
+# file transfers are split into messages of this size
+FILE_MESSAGE_SIZE = 65536
+
+# file transfers pause when this many bytes are buffered, and resume
+# once half of them have been acknowledged
+FILE_BUFFER_SIZE = 1048576
+
+# received messages beyond this many bytes per channel hold back the SCTP
+# receive window until they are read
+RECV_BUFFER_SIZE = 65536
+
 
 class DataChannelManager:
     def __init__(self, pc, endpoint):
         self.channels = {}
         self.endpoint = endpoint
+        self.endpoint.data_released_callback = self._data_released
         self.pc = pc
-        if endpoint.is_server:
-            self.stream_id = 0
+
+    def create_channel(self, label, protocol, ordered=True, maxPacketLifeTime=None,
+                       maxRetransmits=None, negotiated=False, id=None):
+        if maxPacketLifeTime is not None and maxRetransmits is not None:
+            raise ValueError('Cannot specify both maxPacketLifeTime and maxRetransmits')
+        if negotiated:
+            if id is None:
+                raise ValueError('Negotiated data channels require an id')
+            if id < 0 or id > 65534:
+                raise ValueError('Data channel id must be in range 0 - 65534')
+            if id in self.channels:
+                raise ValueError('Data channel id %d is already in use' % id)
         else:
-            self.stream_id = 1
+            id = self._allocate_stream_id()
 
-    def create_channel(self, label, protocol):
         # register channel
-        channel = RTCDataChannel(id=self.stream_id, label=label, protocol=protocol,
-                                 manager=self, readyState='connecting')
+        channel = RTCDataChannel(id=id, label=label, protocol=protocol,
+                                 manager=self, readyState='connecting', ordered=ordered,
+                                 maxPacketLifeTime=maxPacketLifeTime,
+                                 maxRetransmits=maxRetransmits, negotiated=negotiated)
         self.channels[channel.id] = channel
-        self.stream_id += 2
+
+        # the remote party creates the channel too, skip the open handshake
+        if negotiated:
+            if self.endpoint.established.is_set():
+                channel._setReadyState('open')
+            return channel
+
+        # determine channel type
+        if maxPacketLifeTime is not None:
+            channel_type = DATA_CHANNEL_PARTIAL_RELIABLE_TIMED
+            reliability = maxPacketLifeTime
+        elif maxRetransmits is not None:
+            channel_type = DATA_CHANNEL_PARTIAL_RELIABLE_REXMIT
+            reliability = maxRetransmits
+        else:
+            channel_type = DATA_CHANNEL_RELIABLE
+            reliability = 0
+        if not ordered:
+            channel_type |= 0x80
 
         # open channel
-        data = pack('!BBHLHH', DATA_CHANNEL_OPEN, DATA_CHANNEL_RELIABLE,
-                    0, 0, len(label), len(protocol))
+        data = pack('!BBHLHH', DATA_CHANNEL_OPEN, channel_type,
+                    0, reliability, len(label), len(protocol))
         data += label.encode('utf8')
         data += protocol.encode('utf8')
-        asyncio.ensure_future(self.endpoint.send(channel.id, WEBRTC_DCEP, data))
+        self.endpoint.send_nowait(channel.id, WEBRTC_DCEP, data)
 
         return channel
 
+    def close_channel(self, channel):
+        if channel.readyState in ['closing', 'closed']:
+            return
+
+        if self.endpoint.remote_reconfig:
+            # the channel is closed once the remote party resets its stream
+            channel._setReadyState('closing')
+            self.endpoint.reset_stream(channel.id)
+        else:
+            channel._setReadyState('closed')
+
     def send(self, channel, data):
         if data == '':
-            asyncio.ensure_future(self.endpoint.send(channel.id, WEBRTC_STRING_EMPTY, b'\x00'))
+            pp_id, user_data = WEBRTC_STRING_EMPTY, b'\x00'
         elif isinstance(data, str):
-            asyncio.ensure_future(self.endpoint.send(channel.id, WEBRTC_STRING,
-                                                     data.encode('utf8')))
+            pp_id, user_data = WEBRTC_STRING, data.encode('utf8')
         elif data == b'':
-            asyncio.ensure_future(self.endpoint.send(channel.id, WEBRTC_BINARY_EMPTY, b'\x00'))
-        elif isinstance(data, bytes):
-            asyncio.ensure_future(self.endpoint.send(channel.id, WEBRTC_BINARY, data))
+            pp_id, user_data = WEBRTC_BINARY_EMPTY, b'\x00'
+        elif isinstance(data, (bytes, memoryview)):
+            pp_id, user_data = WEBRTC_BINARY, data
         else:
             raise ValueError('Cannot send unsupported data type: %s' % type(data))
 
+        if channel.maxPacketLifeTime is not None:
+            expiry = time.time() + channel.maxPacketLifeTime / 1000
+        else:
+            expiry = None
+        self.endpoint.send_nowait(
+            channel.id, pp_id, user_data,
+            ordered=channel.ordered,
+            max_retransmits=channel.maxRetransmits,
+            expiry=expiry)
+
+        # only count messages which were accepted for sending
+        channel._addBufferedAmount(len(user_data))
+
     async def run(self, endpoint):
         self.endpoint = endpoint
+        self.endpoint.data_released_callback = self._data_released
+
+        # negotiated channels open along with the association
+        await first_completed(self.endpoint.established.wait(), self.endpoint.closed.wait())
+        if self.endpoint.established.is_set():
+            for channel in self.channels.values():
+                if channel.negotiated and channel.readyState == 'connecting':
+                    channel._setReadyState('open')
+
         while True:
             try:
                 stream_id, pp_id, data = await self.endpoint.recv()
             except ConnectionError:
+                for channel in self.channels.values():
+                    channel._setReadyState('closed')
                 return
-            if pp_id == WEBRTC_DCEP and len(data):
+            if pp_id is None:
+                # the remote party reset its outgoing stream
+                channel = self.channels.pop(stream_id, None)
+                if channel is not None:
+                    if channel.readyState != 'closing':
+                        self.endpoint.reset_stream(stream_id)
+                    channel._setReadyState('closed')
+            elif pp_id == WEBRTC_DCEP and len(data):
                 msg_type = unpack('!B', data[0:1])[0]
                 if msg_type == DATA_CHANNEL_OPEN and len(data) >= 12:
                     # one side should be using even IDs, the other odd IDs
-                    assert (stream_id % 2) != (self.stream_id % 2)
-                    assert stream_id not in self.channels
+                    if (stream_id % 2) == self._stream_id_parity():
+                        logger.warning('Ignoring DATA_CHANNEL_OPEN with local stream id %d',
+                                       stream_id)
+                        continue
+
+                    # the id may already be taken by a negotiated channel
+                    if stream_id in self.channels:
+                        logger.warning('Ignoring DATA_CHANNEL_OPEN for stream id %d in use',
+                                       stream_id)
+                        continue
 
                     (msg_type, channel_type, priority, reliability,
                      label_length, protocol_length) = unpack('!BBHLHH', data[0:12])
@@ -77,9 +180,19 @@ class DataChannelManager:
                     pos += label_length
                     protocol = data[pos:pos + protocol_length].decode('utf8')
 
+                    max_packet_lifetime = None
+                    max_retransmits = None
+                    if (channel_type & 0x03) == DATA_CHANNEL_PARTIAL_RELIABLE_REXMIT:
+                        max_retransmits = reliability
+                    elif (channel_type & 0x03) == DATA_CHANNEL_PARTIAL_RELIABLE_TIMED:
+                        max_packet_lifetime = reliability
+
                     # register channel
                     channel = RTCDataChannel(id=stream_id, label=label, protocol=protocol,
-                                             manager=self, readyState='open')
+                                             manager=self, readyState='open',
+                                             ordered=not (channel_type & 0x80),
+                                             maxPacketLifeTime=max_packet_lifetime,
+                                             maxRetransmits=max_retransmits)
                     self.channels[stream_id] = channel
 
                     # send ack
@@ -88,21 +201,59 @@ class DataChannelManager:
                     # emit channel
                     self.pc.emit('datachannel', channel)
                 elif msg_type == DATA_CHANNEL_ACK:
-                    assert stream_id in self.channels
-                    channel = self.channels[stream_id]
+                    channel = self.channels.get(stream_id)
+                    if channel is None:
+                        logger.warning('Ignoring DATA_CHANNEL_ACK for unknown stream id %d',
+                                       stream_id)
+                        continue
                     channel._setReadyState('open')
             elif pp_id == WEBRTC_STRING and stream_id in self.channels:
-                # emit message
-                self.channels[stream_id].emit('message', data.decode('utf8'))
+                self._deliver(self.channels[stream_id], data.decode('utf8'), len(data))
             elif pp_id == WEBRTC_STRING_EMPTY and stream_id in self.channels:
-                # emit message
-                self.channels[stream_id].emit('message', '')
+                self._deliver(self.channels[stream_id], '', len(data))
             elif pp_id == WEBRTC_BINARY and stream_id in self.channels:
-                # emit message
-                self.channels[stream_id].emit('message', data)
+                self._deliver(self.channels[stream_id], data, len(data))
             elif pp_id == WEBRTC_BINARY_EMPTY and stream_id in self.channels:
-                # emit message
-                self.channels[stream_id].emit('message', b'')
+                self._deliver(self.channels[stream_id], b'', len(data))
+
+    def _allocate_stream_id(self):
+        """
+        Return the lowest stream identifier which is neither in use nor
+        still being reset.
+        """
+        stream_id = self._stream_id_parity()
+        while stream_id in self.channels or self.endpoint.is_stream_resetting(stream_id):
+            stream_id += 2
+        return stream_id
+
+    def _stream_id_parity(self):
+        return 0 if self.endpoint.is_server else 1
+
+    def _deliver(self, channel, message, length):
+        """
+        Emit a message, or queue it for :meth:`RTCDataChannel.recv` if nobody
+        listens for `message` events.
+
+        Each channel queues up to `RECV_BUFFER_SIZE` bytes without affecting
+        the other channels. Messages queued beyond that are held against the
+        SCTP receive window until they are read, so a slow reader throttles
+        the remote sender. The receive window is shared by the whole
+        association, so once it closes every channel is throttled.
+        """
+        if channel.listeners('message'):
+            channel.emit('message', message)
+        else:
+            held = channel._recvBuffered >= RECV_BUFFER_SIZE
+            if held:
+                self.endpoint.hold_recv(length)
+            channel._addMessage(message, length, held)
+
+    def _message_consumed(self, length):
+        self.endpoint.release_recv(length)
+
+    def _data_released(self, stream_id, pp_id, length):
+        if pp_id != WEBRTC_DCEP and stream_id in self.channels:
+            self.channels[stream_id]._addBufferedAmount(-length)
 
 
 class RTCDataChannel(EventEmitter):
@@ -111,13 +262,49 @@ class RTCDataChannel(EventEmitter):
     for bidirectional peer-to-peer transfers of arbitrary data.
     """
 
-    def __init__(self, id, label, protocol, manager, readyState):
+    def __init__(self, id, label, protocol, manager, readyState, ordered=True,
+                 maxPacketLifeTime=None, maxRetransmits=None, negotiated=False):
         super().__init__()
+        self.__bufferedAmount = 0
+        self.__bufferedAmountReleased = asyncio.Event()
+        self.__bufferedAmountLowThreshold = 0
         self.__id = id
         self.__label = label
         self.__manager = manager
+        self.__maxPacketLifeTime = maxPacketLifeTime
+        self.__maxRetransmits = maxRetransmits
+        self.__negotiated = negotiated
+        self.__ordered = ordered
         self.__protocol = protocol
         self.__readyState = readyState
+        self.__recvBuffered = 0
+        self.__recvEvent = asyncio.Event()
+        self.__recvQueue = deque()
+
+    @property
+    def bufferedAmount(self):
+        """
+        The number of bytes of data currently queued to be sent over the data
+        channel, including data which was sent but not yet acknowledged.
+        """
+        return self.__bufferedAmount
+
+    @property
+    def bufferedAmountLowThreshold(self):
+        """
+        The number of bytes of buffered outgoing data that is considered "low".
+
+        When :attr:`bufferedAmount` decreases to this value or below, a
+        `bufferedamountlow` event is emitted.
+        """
+        return self.__bufferedAmountLowThreshold
+
+    @bufferedAmountLowThreshold.setter
+    def bufferedAmountLowThreshold(self, value):
+        if value < 0 or value > 4294967295:
+            raise ValueError('bufferedAmountLowThreshold must be in range 0 - 4294967295')
+        self.__bufferedAmountLowThreshold = value
+        self.__bufferedAmountReleased.set()
 
     @property
     def id(self):
@@ -135,6 +322,37 @@ class RTCDataChannel(EventEmitter):
         """
         return self.__label
 
+    @property
+    def maxPacketLifeTime(self):
+        """
+        The maximum time in milliseconds during which transmissions are
+        attempted, or `None` if the channel is not limited by time.
+        """
+        return self.__maxPacketLifeTime
+
+    @property
+    def maxRetransmits(self):
+        """
+        The maximum number of retransmissions which are attempted, or
+        `None` if the channel is not limited by retransmissions.
+        """
+        return self.__maxRetransmits
+
+    @property
+    def negotiated(self):
+        """
+        Indicates whether the data channel was negotiated by the application
+        rather than using the in-band open handshake.
+        """
+        return self.__negotiated
+
+    @property
+    def ordered(self):
+        """
+        Indicates whether messages are guaranteed to arrive in order.
+        """
+        return self.__ordered
+
     @property
     def protocol(self):
         """
@@ -152,8 +370,84 @@ class RTCDataChannel(EventEmitter):
     def close(self):
         """
         Close the data channel.
+
+        Messages which are already queued are still sent, then the underlying
+        stream is reset so that its identifier can be reused.
+        """
+        self.__manager.close_channel(self)
+
+    async def drain(self):
+        """
+        Wait until :attr:`bufferedAmount` is at or below
+        :attr:`bufferedAmountLowThreshold`, or the data channel is closed.
+
+        This allows producers to send large amounts of data without
+        buffering all of it in memory.
+        """
+        await self.__waitBufferedAmount(self.__bufferedAmountLowThreshold)
+
+    async def recv(self):
+        """
+        Receive the next message from the remote peer.
+
+        Messages are only queued for :meth:`recv` while no `message` event
+        handler is registered, messages emitted to a handler are never
+        queued. The data channel can also be iterated with `async for`.
+
+        Up to 64 KiB of unread messages are queued per channel, beyond that
+        the remote party is throttled using the SCTP receive window, which
+        affects all the channels of the connection.
+
+        Raises :class:`ConnectionError` once the data channel is closed and
+        all queued messages have been received.
+        """
+        while not self.__recvQueue:
+            if self.__readyState == 'closed':
+                raise ConnectionError
+            self.__recvEvent.clear()
+            await self.__recvEvent.wait()
+
+        message, length, held = self.__recvQueue.popleft()
+        self.__recvBuffered -= length
+        if held:
+            self.__manager._message_consumed(length)
+        return message
+
+    async def recv_into_file(self, path, size):
+        """
+        Receive `size` bytes of binary messages into the file at `path`.
+
+        The file is created with its final size and memory-mapped, each
+        message is written at its offset as it arrives. Receiving is not
+        zero-copy: SCTP reassembles each message into a bytes object, which
+        is then copied into the mapping.
+
+        Messages are written in the order they are received, so the data
+        channel must be ordered and reliable.
         """
-        self._setReadyState('closed')
+        if (not self.__ordered or self.__maxPacketLifeTime is not None or
+           self.__maxRetransmits is not None):
+            raise ValueError('Cannot receive file on an unordered or partially reliable channel')
+
+        with open(path, 'w+b') as f:
+            f.truncate(size)
+            if not size:
+                return
+            sink = mmap.mmap(f.fileno(), size)
+
+        try:
+            offset = 0
+            while offset < size:
+                message = await self.recv()
+                if not isinstance(message, bytes):
+                    raise ValueError('Cannot write string message to file')
+                if offset + len(message) > size:
+                    raise ValueError('Received more than %d bytes' % size)
+                sink[offset:offset + len(message)] = message
+                offset += len(message)
+            sink.flush()
+        finally:
+            sink.close()
 
     def send(self, data):
         """
@@ -161,6 +455,74 @@ class RTCDataChannel(EventEmitter):
         """
         self.__manager.send(self, data)
 
+    async def send_file(self, path):
+        """
+        Send the contents of the file at `path` as binary messages.
+
+        The file is memory-mapped and sent as slices of the mapping, so it is
+        never read into memory as a whole. Sending pauses once 1 MiB is
+        buffered, and resumes when half of it has been acknowledged so the
+        association never runs dry.
+
+        Returns the number of bytes sent.
+        """
+        with open(path, 'rb') as f:
+            size = f.seek(0, 2)
+            if not size:
+                return 0
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # the mapping is released once the last slice has been sent
+        view = memoryview(source)
+        for offset in range(0, size, FILE_MESSAGE_SIZE):
+            if self.__bufferedAmount >= FILE_BUFFER_SIZE:
+                await self.__waitBufferedAmount(FILE_BUFFER_SIZE // 2)
+            if self.__readyState == 'closed':
+                raise ConnectionError
+            self.send(view[offset:offset + FILE_MESSAGE_SIZE])
+        return size
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except ConnectionError:
+            raise StopAsyncIteration
+
+    @property
+    def _recvBuffered(self):
+        return self.__recvBuffered
+
+    def _addMessage(self, message, length, held):
+        self.__recvBuffered += length
+        self.__recvQueue.append((message, length, held))
+        self.__recvEvent.set()
+
+    def _addBufferedAmount(self, amount):
+        crossed_threshold = (
+            self.__bufferedAmount > self.__bufferedAmountLowThreshold and
+            self.__bufferedAmount + amount <= self.__bufferedAmountLowThreshold)
+        self.__bufferedAmount += amount
+        if amount < 0:
+            self.__bufferedAmountReleased.set()
+        if crossed_threshold:
+            self.emit('bufferedamountlow')
+
     def _setReadyState(self, state):
         if state != self.__readyState:
             self.__readyState = state
+            if state == 'closed':
+                self.__bufferedAmountReleased.set()
+                self.__recvEvent.set()
+                self.emit('close')
+
+    async def __waitBufferedAmount(self, threshold):
+        """
+        Wait until :attr:`bufferedAmount` is at or below `threshold`, or the
+        data channel is closed.
+        """
+        while self.__bufferedAmount > threshold and self.__readyState != 'closed':
+            self.__bufferedAmountReleased.clear()
+            await self.__bufferedAmountReleased.wait()
@@ -1,5 +1,6 @@
 import asyncio
 import datetime
+import logging
 import uuid
 
 import aioice
@@ -7,9 +8,10 @@ from pyee import EventEmitter
 
 from . import dtls, rtp, sctp, sdp
 from .exceptions import InternalError, InvalidAccessError, InvalidStateError
+from .instrumentation import Instrumentation
 from .rtcdatachannel import DataChannelManager
 from .rtcrtptransceiver import (RemoteStreamTrack, RTCRtpReceiver,
-                                RTCRtpSender, RTCRtpTransceiver)
+                                RTCRtpSender, RTCRtpTransceiver, RtpRouter)
 from .rtcsctptransport import RTCSctpTransport
 from .rtcsessiondescription import RTCSessionDescription
 
@@ -29,6 +31,10 @@ MEDIA_CODECS = [
 ]
 MEDIA_KINDS = ['audio', 'video']
 
+BUNDLE_POLICIES = ['max-bundle', 'max-compat']
+
+logger = logging.getLogger('pc')
+
 
 def find_common_codecs(local_codecs, remote_media):
     common = []
@@ -76,12 +82,47 @@ class RTCPeerConnection(EventEmitter):
     """
     The RTCPeerConnection interface represents a WebRTC connection between
     the local computer and a remote peer.
+
+    `certificates` is a list of :class:`RTCCertificate`, of which the first
+    one is used for DTLS. If it is omitted, a certificate shared by all the
+    peer connections in the process is used.
+
+    `bundlePolicy` controls how media and data are carried when offering.
+    With `'max-bundle'` they all share a single ICE / DTLS transport using
+    BUNDLE, while `'max-compat'` uses a transport for each of them, for
+    remote parties which do not support BUNDLE. When answering, BUNDLE is
+    used if the remote offer requested it.
+
+    Each transport connects on its own. Whenever the state of one of them
+    changes, a `transportstatechange` event is emitted with the list of
+    media ids it carries and its new state: `'checking'` while ICE connects,
+    `'connecting'` during the DTLS handshake, then `'connected'` or
+    `'failed'`.
+
+    If `instrument` is true, the time spent in each stage of the media
+    pipeline and the event loop lag are recorded in :attr:`instrumentation`.
     """
-    def __init__(self, loop=None):
+    def __init__(self, loop=None, instrument=False, certificates=None,
+                 bundlePolicy='max-bundle'):
         super().__init__(loop=loop)
+        if bundlePolicy not in BUNDLE_POLICIES:
+            raise ValueError('Unsupported bundle policy "%s"' % bundlePolicy)
+
+        if certificates:
+            certificate = certificates[0]
+        else:
+            certificate = dtls.certificate_pool.get()
+
+        self.__bundle = None
+        self.__bundlePolicy = bundlePolicy
         self.__cname = '{%s}' % uuid.uuid4()
         self.__datachannelManager = None
-        self.__dtlsContext = dtls.DtlsSrtpContext()
+        self.__dtlsContext = certificate._get_context()
+        self.__iceRestarts = {}
+        if instrument:
+            self.__instrumentation = Instrumentation(label=self.__cname[1:-1])
+        else:
+            self.__instrumentation = None
         self.__sctp = None
         self.__transceivers = []
 
@@ -101,6 +142,14 @@ class RTCPeerConnection(EventEmitter):
     def iceGatheringState(self):
         return self.__iceGatheringState
 
+    @property
+    def instrumentation(self):
+        """
+        The :class:`~aiortc.instrumentation.Instrumentation` recording
+        pipeline timings, or `None` if it is not enabled.
+        """
+        return self.__instrumentation
+
     @property
     def localDescription(self):
         """
@@ -147,6 +196,7 @@ class RTCPeerConnection(EventEmitter):
         transceiver = self.__createTransceiver(
             kind=track.kind,
             controlling=True,
+            bundle=(self.__bundlePolicy == 'max-bundle'),
             sender_track=track)
         return transceiver.sender
 
@@ -158,14 +208,17 @@ class RTCPeerConnection(EventEmitter):
             return
         self.__isClosed = True
         self.__setSignalingState('closed')
+        if self.__instrumentation:
+            self.__instrumentation.stop()
         for transceiver in self.__transceivers:
             await transceiver.stop()
-            await transceiver._dtlsSession.close()
-            await transceiver._iceConnection.close()
         if self.__sctp:
             await self.__sctpEndpoint.close()
-            await self.__sctp._dtlsSession.close()
-            await self.__sctp._iceConnection.close()
+        for iceConnection, dtlsSession in self.__transports():
+            await dtlsSession.close()
+            await iceConnection.close()
+        for iceConnection in self.__iceRestarts.values():
+            await iceConnection.close()
         self.__setIceConnectionState('closed')
 
     async def createAnswer(self):
@@ -185,22 +238,39 @@ class RTCPeerConnection(EventEmitter):
             sdp=self.__createSdp(),
             type='answer')
 
-    def createDataChannel(self, label, protocol=''):
+    def createDataChannel(self, label, protocol='', ordered=True, maxPacketLifeTime=None,
+                          maxRetransmits=None, negotiated=False, id=None):
         """
         Create a data channel with the given label.
 
+        By default messages are delivered reliably and in order. Partial
+        reliability can be requested using either `maxPacketLifeTime` (in
+        milliseconds) or `maxRetransmits`.
+
+        If `negotiated` is True, the application is responsible for creating
+        a data channel with the same `id` on the remote party, and no open
+        handshake takes place.
+
         :rtype: :class:`RTCDataChannel`
         """
         if not self.__sctp:
-            self.__createSctp(controlling=True)
+            self.__createSctp(controlling=True, bundle=(self.__bundlePolicy == 'max-bundle'))
 
-        return self.__datachannelManager.create_channel(label=label, protocol=protocol)
+        return self.__datachannelManager.create_channel(
+            label=label, protocol=protocol, ordered=ordered,
+            maxPacketLifeTime=maxPacketLifeTime, maxRetransmits=maxRetransmits,
+            negotiated=negotiated, id=id)
 
-    async def createOffer(self):
+    async def createOffer(self, iceRestart=False):
         """
         Create an SDP offer for the purpose of starting a new WebRTC
         connection to a remote peer.
 
+        If `iceRestart` is true, new ICE connections with new credentials
+        are negotiated, for instance after a network change. The existing
+        DTLS sessions, and so the SRTP keys and the data channels, are kept
+        and move over to the new ICE connections.
+
         :rtype: :class:`RTCSessionDescription`
         """
         # check state is valid
@@ -209,6 +279,12 @@ class RTCPeerConnection(EventEmitter):
         if not self.__sctp and not self.__transceivers:
             raise InternalError('Cannot create an offer with no media and no data channels')
 
+        if iceRestart:
+            if self.iceConnectionState != 'completed':
+                raise InvalidStateError('Cannot restart ICE in ICE connection state "%s"' %
+                                        self.iceConnectionState)
+            self.__restartIce(self.__transports())
+
         # offer codecs
         dynamic_pt = rtp.DYNAMIC_PAYLOAD_TYPES.start
         for transceiver in self.__transceivers:
@@ -222,6 +298,16 @@ class RTCPeerConnection(EventEmitter):
                         codecs.append(codec)
             transceiver._codecs = codecs
 
+        # assign media identifiers
+        mids = set(media._mid for media in self.__media())
+        for media in self.__media():
+            if media._mid is None:
+                mid = 0
+                while str(mid) in mids:
+                    mid += 1
+                media._mid = str(mid)
+                mids.add(media._mid)
+
         return RTCSessionDescription(
             sdp=self.__createSdp(),
             type='offer')
@@ -273,6 +359,11 @@ class RTCPeerConnection(EventEmitter):
 
         # parse description
         parsedRemoteDescription = sdp.SessionDescription.parse(sessionDescription.sdp)
+        bundle = parsedRemoteDescription.bundle
+        if (sessionDescription.type == 'answer' and self.__bundle is not None and
+           not bundle and len(parsedRemoteDescription.media) > 1):
+            raise InternalError('Remote party does not support BUNDLE, use the '
+                                '"max-compat" bundle policy')
 
         # apply description
         for media in parsedRemoteDescription.media:
@@ -285,18 +376,18 @@ class RTCPeerConnection(EventEmitter):
                 if transceiver is None:
                     transceiver = self.__createTransceiver(
                         kind=media.kind,
-                        controlling=False)
+                        controlling=False,
+                        bundle=(media.mid in bundle))
+                if transceiver._mid is None:
+                    transceiver._mid = media.mid
 
                 # negotiate codecs
                 common = find_common_codecs(MEDIA_CODECS, media)
                 assert len(common)
                 transceiver._codecs = common
+                transceiver._remote_ssrcs = media.ssrc
 
-                # configure transport
-                transceiver._iceConnection.remote_candidates = media.ice_candidates
-                transceiver._iceConnection.remote_username = media.ice_ufrag
-                transceiver._iceConnection.remote_password = media.ice_pwd
-                transceiver._dtlsSession.remote_fingerprint = media.dtls_fingerprint
+                self.__configureTransport(transceiver, media, bundle)
 
                 if not transceiver.receiver._track:
                     transceiver.receiver._track = RemoteStreamTrack(kind=media.kind)
@@ -304,13 +395,15 @@ class RTCPeerConnection(EventEmitter):
 
             elif media.kind == 'application':
                 if not self.__sctp:
-                    self.__createSctp(controlling=False)
+                    self.__createSctp(controlling=False, bundle=(media.mid in bundle))
+                if self.__sctp._mid is None:
+                    self.__sctp._mid = media.mid
+
+                self.__configureTransport(self.__sctp, media, bundle)
 
-                # configure transport
-                self.__sctp._iceConnection.remote_candidates = media.ice_candidates
-                self.__sctp._iceConnection.remote_username = media.ice_ufrag
-                self.__sctp._iceConnection.remote_password = media.ice_pwd
-                self.__sctp._dtlsSession.remote_fingerprint = media.dtls_fingerprint
+                # configure maximum message size
+                if media.max_message_size is not None:
+                    self.__sctpEndpoint.remote_max_message_size = media.max_message_size
 
         # connect
         asyncio.ensure_future(self.__connect())
@@ -324,36 +417,124 @@ class RTCPeerConnection(EventEmitter):
         self.__currentRemoteDescription = sessionDescription
 
     async def __connect(self):
-        for iceConnection, dtlsSession in self.__transports():
+        transports = self.__transports()
+        for iceConnection, dtlsSession in transports:
             if (not iceConnection.local_candidates or not iceConnection.remote_candidates):
                 return
 
         if self.iceConnectionState == 'new':
             self.__setIceConnectionState('checking')
-            for iceConnection, dtlsSession in self.__transports():
-                await iceConnection.connect()
-                await dtlsSession.connect()
-            for transceiver in self.__transceivers:
-                asyncio.ensure_future(transceiver._run(transceiver._dtlsSession.rtp))
-            if self.__sctp:
-                asyncio.ensure_future(self.__sctpEndpoint.run())
-                asyncio.ensure_future(self.__datachannelManager.run(self.__sctpEndpoint))
+            if self.__instrumentation:
+                self.__instrumentation.start()
+
+            # connect all the transports at once, each one starts carrying
+            # media and data as soon as it is ready
+            await self.__connectAll([
+                self.__connectTransport(iceConnection, dtlsSession)
+                for iceConnection, dtlsSession in transports])
+        elif self.__iceRestarts:
+            restarts, self.__iceRestarts = self.__iceRestarts, {}
+            self.__setIceConnectionState('checking')
+            await self.__connectAll([
+                self.__restartTransport(iceConnection, dtlsSession, restarts[dtlsSession])
+                for iceConnection, dtlsSession in transports
+                if dtlsSession in restarts])
+
+    async def __connectAll(self, coros):
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        if self.__isClosed:
+            return
+
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            for error in errors:
+                logger.warning('Transport failed to connect: %r', error)
+            self.__setIceConnectionState('failed')
+        else:
             self.__setIceConnectionState('completed')
 
+    async def __connectTransport(self, iceConnection, dtlsSession):
+        try:
+            self.__setTransportState(dtlsSession, 'checking')
+            await iceConnection.connect()
+            self.__setTransportState(dtlsSession, 'connecting')
+            await dtlsSession.connect()
+        except Exception:
+            self.__setTransportState(dtlsSession, 'failed')
+            raise
+        if self.__isClosed:
+            return
+        self.__setTransportState(dtlsSession, 'connected')
+
+        # route RTP when several transceivers share the transport
+        transceivers = [t for t in self.__transceivers if t._dtlsSession is dtlsSession]
+        if len(transceivers) > 1:
+            router = RtpRouter(dtlsSession.rtp)
+            for transceiver in transceivers:
+                asyncio.ensure_future(transceiver._run(router.register(
+                    payload_types=[codec.pt for codec in transceiver._codecs],
+                    ssrcs=transceiver._remote_ssrcs)))
+            dtlsSession.rtp.set_handler(router.data_received)
+        elif transceivers:
+            asyncio.ensure_future(transceivers[0]._run(dtlsSession.rtp))
+
+        if self.__sctp and self.__sctp._dtlsSession is dtlsSession:
+            asyncio.ensure_future(self.__sctpEndpoint.run())
+            asyncio.ensure_future(self.__datachannelManager.run(self.__sctpEndpoint))
+
     async def __gather(self):
         if self.__iceGatheringState == 'new':
             self.__setIceGatheringState('gathering')
-            for iceConnection, dtlsSession in self.__transports():
-                await iceConnection.gather_candidates()
+            await asyncio.gather(*[iceConnection.gather_candidates()
+                                   for iceConnection, dtlsSession in self.__transports()
+                                   if not iceConnection.local_candidates])
             self.__setIceGatheringState('complete')
 
+    async def __restartTransport(self, iceConnection, dtlsSession, oldIceConnection):
+        """
+        Connect the new ICE connection of a restarted transport, then move
+        its DTLS session over without a new handshake.
+        """
+        try:
+            self.__setTransportState(dtlsSession, 'checking')
+            await iceConnection.connect()
+        except Exception:
+            self.__setTransportState(dtlsSession, 'failed')
+            raise
+        dtlsSession.transport = iceConnection
+        await oldIceConnection.close()
+        self.__setTransportState(dtlsSession, 'connected')
+
     def __assertNotClosed(self):
         if self.__isClosed:
             raise InvalidStateError('RTCPeerConnection is closed')
 
-    def __createSctp(self, controlling):
+    def __configureTransport(self, media, remote_media, bundle):
+        """
+        Apply the remote ICE and DTLS parameters to the transport of `media`.
+
+        A shared transport is configured from the first media in the BUNDLE
+        group, as the others may not carry any candidates.
+        """
+        if self.__bundle is not None and media._dtlsSession is self.__bundle[1]:
+            if bundle and remote_media.mid != bundle[0]:
+                return
+
+        # the remote party restarted ICE
+        remote_username = media._iceConnection.remote_username
+        if (remote_username is not None and remote_username != remote_media.ice_ufrag and
+           self.iceConnectionState == 'completed'):
+            self.__restartIce([(media._iceConnection, media._dtlsSession)])
+
+        media._iceConnection.remote_candidates = remote_media.ice_candidates
+        media._iceConnection.remote_username = remote_media.ice_ufrag
+        media._iceConnection.remote_password = remote_media.ice_pwd
+        media._dtlsSession.remote_fingerprint = remote_media.dtls_fingerprint
+
+    def __createSctp(self, controlling, bundle):
         self.__sctp = RTCSctpTransport()
-        self.__createTransport(self.__sctp, controlling=controlling)
+        self.__sctp._mid = None
+        self.__createTransport(self.__sctp, controlling=controlling, bundle=bundle)
         self.__sctpEndpoint = sctp.Endpoint(
             is_server=not controlling,
             transport=self.__sctp._dtlsSession.data)
@@ -367,6 +548,11 @@ class RTCPeerConnection(EventEmitter):
             's=-',
             't=0 0',
         ]
+        if self.__bundle is not None:
+            mids = [media._mid for media in self.__media()
+                    if media._dtlsSession is self.__bundle[1] and media._mid is not None]
+            if mids:
+                sdp += ['a=group:BUNDLE %s' % ' '.join(mids)]
 
         for transceiver in self.__transceivers:
             iceConnection = transceiver._iceConnection
@@ -384,6 +570,8 @@ class RTCPeerConnection(EventEmitter):
             ]
             sdp += transport_sdp(iceConnection, transceiver._dtlsSession)
             sdp += ['a=%s' % transceiver.direction]
+            if transceiver._mid is not None:
+                sdp += ['a=mid:%s' % transceiver._mid]
             sdp += ['a=ssrc:%d cname:%s' % (transceiver.sender._ssrc, self.__cname)]
 
             for codec in transceiver._codecs:
@@ -399,26 +587,69 @@ class RTCPeerConnection(EventEmitter):
                 'c=IN IP4 %s' % default_candidate.host,
             ]
             sdp += transport_sdp(iceConnection, self.__sctp._dtlsSession)
+            if self.__sctp._mid is not None:
+                sdp += ['a=mid:%s' % self.__sctp._mid]
             sdp += ['a=sctpmap:5000 webrtc-datachannel 256']
+            sdp += ['a=max-message-size:%d' % self.__sctpEndpoint.max_message_size]
 
         return '\r\n'.join(sdp) + '\r\n'
 
-    def __createTransceiver(self, controlling, kind, sender_track=None):
+    def __createTransceiver(self, controlling, kind, bundle, sender_track=None):
         transceiver = RTCRtpTransceiver(
             sender=RTCRtpSender(kind=kind),
             receiver=RTCRtpReceiver(kind=kind))
         transceiver._kind = kind
+        transceiver._mid = None
+        transceiver._remote_ssrcs = []
         transceiver.sender._track = sender_track
-        self.__createTransport(transceiver, controlling=controlling)
+        if self.__instrumentation:
+            transceiver.receiver._instrumentation = self.__instrumentation
+            transceiver.sender._instrumentation = self.__instrumentation
+        self.__createTransport(transceiver, controlling=controlling, bundle=bundle)
         self.__transceivers.append(transceiver)
         return transceiver
 
-    def __createTransport(self, transceiver, controlling):
-        transceiver._iceConnection = aioice.Connection(ice_controlling=controlling)
-        transceiver._dtlsSession = dtls.DtlsSrtpSession(
+    def __createTransport(self, media, controlling, bundle):
+        if bundle and self.__bundle is not None:
+            media._iceConnection, media._dtlsSession = self.__bundle
+            return
+
+        media._iceConnection = aioice.Connection(ice_controlling=controlling)
+        media._dtlsSession = dtls.DtlsSrtpSession(
             self.__dtlsContext,
             is_server=controlling,
-            transport=transceiver._iceConnection)
+            transport=media._iceConnection)
+        if self.__instrumentation:
+            media._dtlsSession.instrumentation = self.__instrumentation
+        if bundle:
+            self.__bundle = (media._iceConnection, media._dtlsSession)
+
+    def __media(self):
+        for transceiver in self.__transceivers:
+            yield transceiver
+        if self.__sctp:
+            yield self.__sctp
+
+    def __restartIce(self, transports):
+        """
+        Give each of the transports a new ICE connection, keeping its DTLS
+        session. The new connections are gathered and connected during the
+        following offer / answer exchange.
+        """
+        for iceConnection, dtlsSession in transports:
+            newIceConnection = aioice.Connection(ice_controlling=iceConnection.ice_controlling)
+            for media in self.__media():
+                if media._dtlsSession is dtlsSession:
+                    media._iceConnection = newIceConnection
+            if self.__bundle is not None and self.__bundle[1] is dtlsSession:
+                self.__bundle = (newIceConnection, dtlsSession)
+
+            if dtlsSession in self.__iceRestarts:
+                # an earlier restart did not complete, drop its connection
+                asyncio.ensure_future(iceConnection.close())
+            else:
+                self.__iceRestarts[dtlsSession] = iceConnection
+        self.__setIceGatheringState('new')
 
     def __setIceConnectionState(self, state):
         self.__iceConnectionState = state
@@ -432,8 +663,16 @@ class RTCPeerConnection(EventEmitter):
         self.__signalingState = state
         self.emit('signalingstatechange')
 
+    def __setTransportState(self, dtlsSession, state):
+        if self.__isClosed:
+            return
+        mids = [media._mid for media in self.__media() if media._dtlsSession is dtlsSession]
+        logger.debug('transport(%s) - %s', ','.join(map(str, mids)), state)
+        self.emit('transportstatechange', mids, state)
+
     def __transports(self):
-        for transceiver in self.__transceivers:
-            yield transceiver._iceConnection, transceiver._dtlsSession
-        if self.__sctp:
-            yield self.__sctp._iceConnection, self.__sctp._dtlsSession
+        transports = []
+        for media in self.__media():
+            if not [t for t in transports if t[1] is media._dtlsSession]:
+                transports.append((media._iceConnection, media._dtlsSession))
+        return transports
@@ -1,11 +1,13 @@
 import asyncio
 import logging
+from struct import unpack_from
 
 from .codecs import get_decoder, get_encoder
+from .instrumentation import NULL_INSTRUMENTATION
 from .jitterbuffer import JitterBuffer
 from .mediastreams import MediaStreamTrack
 from .rtp import RtcpPacket, RtpPacket, is_rtcp
-from .utils import first_completed, random32
+from .utils import ClosableQueue, first_completed, random32
 
 logger = logging.getLogger('rtp')
 
@@ -19,38 +21,146 @@ class RemoteStreamTrack(MediaStreamTrack):
         return await self._queue.get()
 
 
+class RoutedTransport:
+    """
+    The view of a shared transport given to one transceiver by :class:`RtpRouter`.
+    """
+    def __init__(self, transport):
+        self._handler = None
+        self._queue = ClosableQueue()
+        self._transport = transport
+
+    @property
+    def closed(self):
+        return self._transport.closed
+
+    async def recv(self):
+        return await self._queue.get()
+
+    async def send(self, data):
+        await self._transport.send(data)
+
+    async def send_batch(self, batch):
+        await self._transport.send_batch(batch)
+
+    def set_handler(self, handler):
+        """
+        Deliver packets by calling `handler(data)` directly, instead of
+        queueing them for :meth:`recv`. Packets which are already queued
+        are delivered first.
+
+        Pass `None` to go back to queueing.
+        """
+        self._handler = handler
+        while handler is not None and not self._queue.empty():
+            self._deliver(self._queue.get_nowait())
+
+    def _deliver(self, data):
+        if self._handler is None:
+            self._queue.put_nowait(data)
+            return
+
+        # a bad packet must not stop delivery to the other transceivers
+        try:
+            self._handler(data)
+        except Exception:
+            logger.exception('router - error handling packet')
+
+
+class RtpRouter:
+    """
+    Route the RTP and RTCP packets received on a transport shared by several
+    transceivers using BUNDLE.
+
+    RTP packets are routed on their SSRC, which is either announced in the
+    remote description or learnt from the first packet carrying one of the
+    transceiver's payload types. RTCP packets are delivered to all
+    transceivers.
+
+    Packets are pushed to :meth:`data_received` by a transport handler.
+    """
+    def __init__(self, transport):
+        self.payload_types = {}
+        self.routes = []
+        self.ssrcs = {}
+        self.transport = transport
+
+    def register(self, payload_types, ssrcs=[]):
+        """
+        Return a :class:`RoutedTransport` receiving the packets with the given
+        payload types and SSRCs.
+        """
+        route = RoutedTransport(self.transport)
+        for payload_type in payload_types:
+            self.payload_types.setdefault(payload_type, route)
+        for ssrc in ssrcs:
+            self.ssrcs[ssrc] = route
+        self.routes.append(route)
+        return route
+
+    def data_received(self, data):
+        """
+        Route a packet received on the shared transport.
+        """
+        if is_rtcp(data):
+            for route in self.routes:
+                route._deliver(data)
+        elif len(data) >= 12:
+            ssrc = unpack_from('!L', data, 8)[0]
+            route = self.ssrcs.get(ssrc)
+            if route is None:
+                route = self.payload_types.get(data[1] & 0x7f)
+                if route is None:
+                    logger.debug('router - no route for SSRC %d' % ssrc)
+                    return
+                self.ssrcs[ssrc] = route
+            route._deliver(data)
+
+
 class RTCRtpReceiver:
     def __init__(self, kind):
+        self._decoder = None
+        self._instrumentation = NULL_INSTRUMENTATION
         self._kind = kind
         self._jitter_buffer = JitterBuffer(capacity=32)
+        self._payload_type = None
         self._track = None
 
-    async def _run(self, transport, decoder, payload_type):
-        while True:
-            try:
-                data = await transport.recv()
-            except ConnectionError:
-                logger.debug('receiver(%s) - finished' % self._kind)
-                return
-
-            # skip RTCP for now
-            if is_rtcp(data):
-                for packet in RtcpPacket.parse(data):
-                    logger.debug('receiver(%s) < %s' % (self._kind, packet))
-
-            # for now, we discard decoded data
-            try:
+    def _attach(self, transport, decoder, payload_type):
+        """
+        Handle the packets received on `transport` as soon as they arrive.
+        """
+        self._decoder = decoder
+        self._payload_type = payload_type
+        transport.set_handler(self._handle_rtp_data)
+
+    def _handle_rtp_data(self, data):
+        measure = self._instrumentation.measure
+
+        # skip RTCP for now
+        if is_rtcp(data):
+            with measure('parse'):
+                packets = RtcpPacket.parse(data)
+            for packet in packets:
+                logger.debug('receiver(%s) < %s' % (self._kind, packet))
+
+        # for now, we discard decoded data
+        try:
+            with measure('parse'):
                 packet = RtpPacket.parse(data)
-            except ValueError:
-                continue
-            logger.debug('receiver(%s) < %s' % (self._kind, packet))
-            if packet.payload_type == payload_type:
+        except ValueError:
+            return
+        logger.debug('receiver(%s) < %s' % (self._kind, packet))
+        if packet.payload_type == self._payload_type:
+            with measure('jitter'):
                 self._jitter_buffer.add(packet.payload, packet.sequence_number, packet.timestamp)
 
-                if self._kind == 'audio':
-                    audio_frame = decoder.decode(packet.payload)
-                    await self._track._queue.put(audio_frame)
-                else:
+            if self._kind == 'audio':
+                with measure('decode'):
+                    audio_frame = self._decoder.decode(packet.payload)
+                self._track._queue.put_nowait(audio_frame)
+            else:
+                with measure('jitter'):
                     payloads = []
                     got_frame = False
                     last_timestamp = None
@@ -64,15 +174,19 @@ class RTCRtpReceiver:
                             got_frame = True
                             break
                         payloads.append(frame.payload)
-
                     if got_frame:
                         self._jitter_buffer.remove(count)
-                        for video_frame in decoder.decode(*payloads):
-                            await self._track._queue.put(video_frame)
+
+                if got_frame:
+                    with measure('decode'):
+                        video_frames = self._decoder.decode(*payloads)
+                    for video_frame in video_frames:
+                        self._track._queue.put_nowait(video_frame)
 
 
 class RTCRtpSender:
     def __init__(self, kind):
+        self._instrumentation = NULL_INSTRUMENTATION
         self._kind = kind
         self._ssrc = random32()
         self._track = None
@@ -82,24 +196,28 @@ class RTCRtpSender:
         return self._track
 
     async def _run(self, transport, encoder, payload_type):
+        measure = self._instrumentation.measure
         packet = RtpPacket(payload_type=payload_type)
         while True:
             if self._track:
                 frame = await self._track.recv()
                 packet.ssrc = self._ssrc
-                payloads = encoder.encode(frame)
+                with measure('encode'):
+                    payloads = encoder.encode(frame)
                 if not isinstance(payloads, list):
                     payloads = [payloads]
+                batch = []
                 for i, payload in enumerate(payloads):
                     packet.payload = payload
                     packet.marker = (i == len(payloads) - 1) and 1 or 0
-                    try:
-                        logger.debug('sender(%s) > %s' % (self._kind, packet))
-                        await transport.send(bytes(packet))
-                    except ConnectionError:
-                        logger.debug('sender(%s) - finished' % self._kind)
-                        return
+                    logger.debug('sender(%s) > %s' % (self._kind, packet))
+                    batch.append(bytes(packet))
                     packet.sequence_number += 1
+                try:
+                    await transport.send_batch(batch)
+                except ConnectionError:
+                    logger.debug('sender(%s) - finished' % self._kind)
+                    return
                 packet.timestamp += encoder.timestamp_increment
             else:
                 await asyncio.sleep(0.02)
@@ -151,7 +269,11 @@ class RTCRtpTransceiver:
         decoder = get_decoder(codec)
         encoder = get_encoder(codec)
 
-        await first_completed(
-            self.receiver._run(transport, decoder=decoder, payload_type=codec.pt),
-            self.sender._run(transport, encoder=encoder, payload_type=codec.pt),
-            self.__stopped.wait())
+        self.receiver._attach(transport, decoder=decoder, payload_type=codec.pt)
+        try:
+            await first_completed(
+                self.sender._run(transport, encoder=encoder, payload_type=codec.pt),
+                transport.closed.wait(),
+                self.__stopped.wait())
+        finally:
+            transport.set_handler(None)
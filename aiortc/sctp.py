@@ -2,14 +2,14 @@ import asyncio
 import enum
 import hmac
 import logging
-import math
 import os
 import time
+from collections import deque
 from struct import pack, unpack
 
 import crcmod.predefined
 
-from .utils import first_completed, random32
+from .utils import ClosableQueue, random32
 
 crc32c = crcmod.predefined.mkPredefinedCrcFun('crc-32c')
 logger = logging.getLogger('sctp')
@@ -17,17 +17,57 @@ logger = logging.getLogger('sctp')
 # local constants
 COOKIE_LENGTH = 24
 COOKIE_LIFETIME = 60
+MAX_MESSAGE_SIZE = 262144
 USERDATA_MAX_LENGTH = 1200
 
+# maximum size of an SCTP packet carrying a full DATA chunk
+SCTP_MTU = USERDATA_MAX_LENGTH + 28
+
+# default maximum message size when the remote party does not signal one
+DEFAULT_MAX_MESSAGE_SIZE = 65536
+
 # protocol constants
+SCTP_CWND_INITIAL = min(4 * SCTP_MTU, max(2 * SCTP_MTU, 4380))
+SCTP_HB_INTERVAL = 30
+SCTP_MAX_ASSOCIATION_RETRANS = 10
+SCTP_RTO_ALPHA = 1 / 8
+SCTP_RTO_BETA = 1 / 4
+SCTP_RTO_INITIAL = 3
+SCTP_RTO_MAX = 60
+SCTP_RTO_MIN = 1
+
 SCTP_DATA_LAST_FRAG = 0x01
 SCTP_DATA_FIRST_FRAG = 0x02
+SCTP_DATA_UNORDERED = 0x04
 SCTP_SEQ_MODULO = 2 ** 16
 SCTP_TSN_MODULO = 2 ** 32
 
 STALE_COOKIE_ERROR = 3
 
+HEARTBEAT_INFO = 0x0001
 STATE_COOKIE = 0x0007
+SUPPORTED_CHUNK_EXT = 0x8008
+FORWARD_TSN_SUPPORTED = 0xC000
+
+# chunk types of extensions
+IDATA_CHUNK = 64
+RECONFIG_CHUNK = 130
+FORWARD_TSN_CHUNK = 192
+IFORWARD_TSN_CHUNK = 194
+
+# stream reconfiguration parameters (RFC 6525)
+RECONFIG_PARAM_OUTGOING_RESET = 13
+RECONFIG_PARAM_RESPONSE = 16
+RECONFIG_PARAM_ADD_OUT_STREAMS = 17
+
+RECONFIG_RESULT_SUCCESS_NOP = 0
+RECONFIG_RESULT_SUCCESS_PERFORMED = 1
+RECONFIG_RESULT_DENIED = 2
+RECONFIG_RESULT_BAD_SEQUENCE = 5
+RECONFIG_RESULT_IN_PROGRESS = 6
+
+# maximum number of streams in an association
+SCTP_MAX_STREAMS = 65535
 
 
 def decode_params(body):
@@ -51,6 +91,28 @@ def encode_params(params):
     return body
 
 
+def tsn_gt(a, b):
+    """
+    Return True if TSN `a` is newer than TSN `b`, using serial number arithmetic.
+    """
+    return a != b and ((a - b) % SCTP_TSN_MODULO) < SCTP_TSN_MODULO // 2
+
+
+def tsn_minus_one(a):
+    return (a - 1) % SCTP_TSN_MODULO
+
+
+def tsn_plus_one(a):
+    return (a + 1) % SCTP_TSN_MODULO
+
+
+def seq_gt(a, b):
+    """
+    Return True if stream sequence number `a` is newer than `b`.
+    """
+    return a != b and ((a - b) % SCTP_SEQ_MODULO) < SCTP_SEQ_MODULO // 2
+
+
 def padl(l):
     return 4 * ((l + 3) // 4) - l
 
@@ -153,10 +215,139 @@ class BaseInitChunk(Chunk):
         return body
 
 
+class ForwardTsnChunk(Chunk):
+    def __init__(self, flags=0, body=b''):
+        self.flags = flags
+        self.streams = []
+        if body:
+            self.cumulative_tsn = unpack('!L', body[0:4])[0]
+            pos = 4
+            while pos < len(body):
+                self.streams.append(unpack('!HH', body[pos:pos + 4]))
+                pos += 4
+        else:
+            self.cumulative_tsn = 0
+
+    @property
+    def body(self):
+        body = pack('!L', self.cumulative_tsn)
+        for stream_id, stream_seq in self.streams:
+            body += pack('!HH', stream_id, stream_seq)
+        return body
+
+    def __repr__(self):
+        return 'ForwardTsnChunk(cumulative_tsn=%d, streams=%s)' % (
+            self.cumulative_tsn, self.streams)
+
+
+class BaseHeartbeatChunk(Chunk):
+    def __init__(self, flags=0, body=b''):
+        self.flags = flags
+        if body:
+            self.params = decode_params(body)
+        else:
+            self.params = []
+
+    @property
+    def body(self):
+        return encode_params(self.params)
+
+
+class HeartbeatChunk(BaseHeartbeatChunk):
+    pass
+
+
+class HeartbeatAckChunk(BaseHeartbeatChunk):
+    pass
+
+
+class IDataChunk(Chunk):
+    """
+    A DATA chunk carrying a message identifier and a fragment sequence
+    number, allowing fragments of different messages to be interleaved
+    (RFC 8260).
+    """
+    def __init__(self, flags=0, body=b''):
+        self.flags = flags
+        if body:
+            (self.tsn, self.stream_id, _, self.message_id, ppid_fsn) = unpack(
+                '!LHHLL', body[0:16])
+            if flags & SCTP_DATA_FIRST_FRAG:
+                self.fsn = 0
+                self.protocol = ppid_fsn
+            else:
+                self.fsn = ppid_fsn
+                self.protocol = 0
+            self.user_data = body[16:]
+        else:
+            self.tsn = 0
+            self.stream_id = 0
+            self.message_id = 0
+            self.fsn = 0
+            self.protocol = 0
+            self.user_data = b''
+
+    @property
+    def body(self):
+        if self.flags & SCTP_DATA_FIRST_FRAG:
+            ppid_fsn = self.protocol
+        else:
+            ppid_fsn = self.fsn
+        body = pack('!LHHLL', self.tsn, self.stream_id, 0, self.message_id, ppid_fsn)
+        body += self.user_data
+        return body
+
+    def __repr__(self):
+        return 'IDataChunk(flags=%d, tsn=%d, stream_id=%d, message_id=%d, fsn=%d)' % (
+            self.flags, self.tsn, self.stream_id, self.message_id, self.fsn)
+
+
+class IForwardTsnChunk(Chunk):
+    def __init__(self, flags=0, body=b''):
+        self.flags = flags
+        self.streams = []
+        if body:
+            self.cumulative_tsn = unpack('!L', body[0:4])[0]
+            pos = 4
+            while pos < len(body):
+                stream_id, reserved, message_id = unpack('!HHL', body[pos:pos + 8])
+                self.streams.append((stream_id, bool(reserved & 1), message_id))
+                pos += 8
+        else:
+            self.cumulative_tsn = 0
+
+    @property
+    def body(self):
+        body = pack('!L', self.cumulative_tsn)
+        for stream_id, unordered, message_id in self.streams:
+            body += pack('!HHL', stream_id, int(unordered), message_id)
+        return body
+
+    def __repr__(self):
+        return 'IForwardTsnChunk(cumulative_tsn=%d, streams=%s)' % (
+            self.cumulative_tsn, self.streams)
+
+
 class InitChunk(BaseInitChunk):
     pass
 
 
+class ReconfigChunk(Chunk):
+    def __init__(self, flags=0, body=b''):
+        self.flags = flags
+        if body:
+            self.params = decode_params(body)
+        else:
+            self.params = []
+
+    @property
+    def body(self):
+        return encode_params(self.params)
+
+    def __repr__(self):
+        return 'ReconfigChunk(params=%s)' % [k for k, v in self.params]
+
+
 class InitAckChunk(BaseInitChunk):
     pass
 
@@ -169,6 +360,13 @@ class SackChunk(Chunk):
         if body:
             self.cumulative_tsn, self.advertised_rwnd, nb_gaps, nb_duplicates = unpack(
                 '!LLHH', body[0:12])
+            pos = 12
+            for i in range(nb_gaps):
+                self.gaps.append(unpack('!HH', body[pos:pos + 4]))
+                pos += 4
+            for i in range(nb_duplicates):
+                self.duplicates.append(unpack('!L', body[pos:pos + 4])[0])
+                pos += 4
         else:
             self.cumulative_tsn = 0
             self.advertised_rwnd = 0
@@ -177,11 +375,15 @@ class SackChunk(Chunk):
     def body(self):
         body = pack('!LLHH', self.cumulative_tsn, self.advertised_rwnd,
                     len(self.gaps), len(self.duplicates))
+        for gap in self.gaps:
+            body += pack('!HH', *gap)
+        for tsn in self.duplicates:
+            body += pack('!L', tsn)
         return body
 
     def __repr__(self):
-        return 'SackChunk(flags=%d, advertised_rwnd=%d, cumulative_tsn=%d)' % (
-            self.flags, self.advertised_rwnd, self.cumulative_tsn)
+        return 'SackChunk(flags=%d, advertised_rwnd=%d, cumulative_tsn=%d, gaps=%s)' % (
+            self.flags, self.advertised_rwnd, self.cumulative_tsn, self.gaps)
 
 
 class ShutdownChunk(Chunk):
@@ -210,6 +412,8 @@ CHUNK_TYPES = {
     1: InitChunk,
     2: InitAckChunk,
     3: SackChunk,
+    4: HeartbeatChunk,
+    5: HeartbeatAckChunk,
     6: AbortChunk,
     7: ShutdownChunk,
     8: ShutdownAckChunk,
@@ -217,6 +421,71 @@ CHUNK_TYPES = {
     10: CookieEchoChunk,
     11: CookieAckChunk,
     14: ShutdownCompleteChunk,
+    64: IDataChunk,
+    130: ReconfigChunk,
+    192: ForwardTsnChunk,
+    194: IForwardTsnChunk,
+}
+
+
+class StreamResetOutgoingParam:
+    def __init__(self, request_sequence, response_sequence, last_tsn, streams):
+        self.request_sequence = request_sequence
+        self.response_sequence = response_sequence
+        self.last_tsn = last_tsn
+        self.streams = streams
+
+    def __bytes__(self):
+        data = pack('!LLL', self.request_sequence, self.response_sequence, self.last_tsn)
+        for stream in self.streams:
+            data += pack('!H', stream)
+        return data
+
+    @classmethod
+    def parse(cls, data):
+        request_sequence, response_sequence, last_tsn = unpack('!LLL', data[0:12])
+        streams = []
+        for pos in range(12, len(data) - 1, 2):
+            streams.append(unpack('!H', data[pos:pos + 2])[0])
+        return cls(
+            request_sequence=request_sequence,
+            response_sequence=response_sequence,
+            last_tsn=last_tsn,
+            streams=streams)
+
+
+class StreamAddOutgoingParam:
+    def __init__(self, request_sequence, new_streams):
+        self.request_sequence = request_sequence
+        self.new_streams = new_streams
+
+    def __bytes__(self):
+        return pack('!LHH', self.request_sequence, self.new_streams, 0)
+
+    @classmethod
+    def parse(cls, data):
+        request_sequence, new_streams, reserved = unpack('!LHH', data[0:8])
+        return cls(request_sequence=request_sequence, new_streams=new_streams)
+
+
+class StreamResetResponseParam:
+    def __init__(self, response_sequence, result):
+        self.response_sequence = response_sequence
+        self.result = result
+
+    def __bytes__(self):
+        return pack('!LL', self.response_sequence, self.result)
+
+    @classmethod
+    def parse(cls, data):
+        response_sequence, result = unpack('!LL', data[0:8])
+        return cls(response_sequence=response_sequence, result=result)
+
+
+RECONFIG_PARAM_TYPES = {
+    RECONFIG_PARAM_OUTGOING_RESET: StreamResetOutgoingParam,
+    RECONFIG_PARAM_RESPONSE: StreamResetResponseParam,
+    RECONFIG_PARAM_ADD_OUT_STREAMS: StreamAddOutgoingParam,
 }
 
 
@@ -273,53 +542,486 @@ class Packet:
         return packet
 
 
+class InboundFragments:
+    """
+    The contiguous fragments received so far for one message sent using
+    DATA chunks, starting with its first fragment.
+    """
+    def __init__(self, chunk):
+        self.count = 0
+        self.discarded = False
+        self.first_tsn = chunk.tsn
+        self.next_tsn = chunk.tsn
+        self.ordered = not (chunk.flags & SCTP_DATA_UNORDERED)
+        self.size = 0
+        self.stream_seq = chunk.stream_seq
+
+    def accepts(self, chunk):
+        return (chunk.tsn == self.next_tsn and
+                not (chunk.flags & SCTP_DATA_FIRST_FRAG) and
+                self.ordered == (not (chunk.flags & SCTP_DATA_UNORDERED)))
+
+
+class InboundStream:
+    """
+    Reassembly queue for one incoming stream.
+
+    Chunks are kept by TSN. Each message being reassembled keeps track of
+    the next TSN it expects, so every chunk is only examined when it arrives
+    or when the gap in front of it is filled. Ordered messages are released
+    in stream sequence number order, unordered messages as soon as they are
+    complete.
+    """
+    def __init__(self, max_message_size=MAX_MESSAGE_SIZE):
+        self.chunks = {}
+        self.max_message_size = max_message_size
+        self.ordered = {}
+        self.partial = {}
+        self.sequence_number = 0
+        self.unordered = deque()
+
+    def add_chunk(self, chunk):
+        fragments = self.partial.get(chunk.tsn)
+        if fragments is not None and fragments.discarded and fragments.accepts(chunk):
+            # trailing fragment of a message we discarded, it is dropped below
+            pass
+        else:
+            # drop ordered chunks for messages which were already delivered
+            if (not (chunk.flags & SCTP_DATA_UNORDERED) and
+               seq_gt(self.sequence_number, chunk.stream_seq)):
+                return
+
+            if chunk.tsn in self.chunks:
+                return
+            self.chunks[chunk.tsn] = chunk
+
+            if chunk.flags & SCTP_DATA_FIRST_FRAG:
+                fragments = InboundFragments(chunk)
+            elif fragments is None or not fragments.accepts(chunk):
+                # wait for the preceding fragment
+                return
+
+        # consume this chunk and any following chunks which were waiting
+        while True:
+            self._extend(fragments, chunk)
+            if fragments.next_tsn is None:
+                break
+            chunk = self.chunks.get(fragments.next_tsn)
+            if chunk is None or not fragments.accepts(chunk):
+                self.partial[fragments.next_tsn] = fragments
+                break
+
+    def pop_messages(self):
+        """
+        Yield the (stream_id, protocol, user_data) tuples of all the messages
+        which can be delivered.
+        """
+        while self.unordered:
+            yield self._pop(self.unordered.popleft())
+
+        while self.sequence_number in self.ordered:
+            fragments = self.ordered.pop(self.sequence_number)
+            self.sequence_number = (self.sequence_number + 1) % SCTP_SEQ_MODULO
+            if not fragments.discarded:
+                yield self._pop(fragments)
+
+    def prune_chunks(self, tsn):
+        """
+        Remove chunks up to and including `tsn`, they will never be completed.
+        """
+        def pruned(t):
+            return not tsn_gt(t, tsn)
+
+        for t in [t for t in self.chunks if pruned(t)]:
+            del self.chunks[t]
+        for key, fragments in list(self.partial.items()):
+            if pruned(fragments.first_tsn):
+                del self.partial[key]
+        for key, fragments in list(self.ordered.items()):
+            if pruned(fragments.first_tsn):
+                del self.ordered[key]
+        self.unordered = deque(f for f in self.unordered if not pruned(f.first_tsn))
+
+    def _extend(self, fragments, chunk):
+        """
+        Append `chunk` to the message being reassembled.
+        """
+        self.partial.pop(fragments.next_tsn, None)
+        fragments.count += 1
+        fragments.size += len(chunk.user_data)
+        if fragments.discarded:
+            self.chunks.pop(chunk.tsn, None)
+        elif fragments.size > self.max_message_size:
+            logger.warning('Message size exceeds %d bytes, discarding', self.max_message_size)
+            self._discard(fragments, chunk.tsn)
+            if fragments.ordered:
+                self.ordered[fragments.stream_seq] = fragments
+
+        if not (chunk.flags & SCTP_DATA_LAST_FRAG):
+            fragments.next_tsn = tsn_plus_one(chunk.tsn)
+            return
+
+        fragments.next_tsn = None
+        if not fragments.discarded:
+            if fragments.ordered:
+                self.ordered[fragments.stream_seq] = fragments
+            else:
+                self.unordered.append(fragments)
+
+    def _discard(self, fragments, last_tsn):
+        """
+        Remove the chunks received so far for `fragments`.
+        """
+        fragments.discarded = True
+        tsn = fragments.first_tsn
+        while True:
+            self.chunks.pop(tsn, None)
+            if tsn == last_tsn:
+                break
+            tsn = tsn_plus_one(tsn)
+
+    def _pop(self, fragments):
+        user_data = []
+        tsn = fragments.first_tsn
+        for i in range(fragments.count):
+            chunk = self.chunks.pop(tsn)
+            user_data.append(chunk.user_data)
+            tsn = tsn_plus_one(tsn)
+        return (chunk.stream_id, chunk.protocol, b''.join(user_data))
+
+
+class InboundMessage:
+    """
+    The fragments received so far for one message sent using I-DATA chunks.
+    """
+    def __init__(self):
+        self.fragments = {}
+        self.last_fsn = None
+        self.size = 0
+
+    @property
+    def complete(self):
+        return self.last_fsn is not None and len(self.fragments) == self.last_fsn + 1
+
+
+class InterleavedInboundStream:
+    """
+    Reassembly queue for one incoming stream using I-DATA chunks.
+
+    Fragments are grouped by message identifier, so fragments of different
+    messages may arrive interleaved. Ordered messages are released in message
+    identifier order, unordered messages as soon as they are complete.
+    """
+    def __init__(self, max_message_size=MAX_MESSAGE_SIZE):
+        self.discarded = set()
+        self.max_message_size = max_message_size
+        self.messages = {}
+        self.sequence_number = 0
+        self.unordered_skipped = None
+
+    def add_chunk(self, chunk):
+        unordered = bool(chunk.flags & SCTP_DATA_UNORDERED)
+        key = (unordered, chunk.message_id)
+
+        # drop fragments of messages which were delivered, discarded or skipped
+        if key in self.discarded:
+            return
+        if unordered:
+            if (self.unordered_skipped is not None and
+               not tsn_gt(chunk.message_id, self.unordered_skipped)):
+                return
+        elif tsn_gt(self.sequence_number, chunk.message_id):
+            return
+
+        message = self.messages.get(key)
+        if message is None:
+            message = InboundMessage()
+            self.messages[key] = message
+        if chunk.fsn in message.fragments:
+            return
+        message.fragments[chunk.fsn] = chunk
+        message.size += len(chunk.user_data)
+        if chunk.flags & SCTP_DATA_LAST_FRAG:
+            message.last_fsn = chunk.fsn
+
+        if message.size > self.max_message_size:
+            logger.warning('Message size exceeds %d bytes, discarding', self.max_message_size)
+            del self.messages[key]
+            self.discarded.add(key)
+
+    def pop_messages(self):
+        """
+        Yield the (stream_id, protocol, user_data) tuples of all the messages
+        which can be delivered.
+        """
+        for key in [k for k, m in self.messages.items() if k[0] and m.complete]:
+            yield self._pop(key)
+
+        while True:
+            key = (False, self.sequence_number)
+            if key in self.discarded:
+                self.discarded.remove(key)
+                message = None
+            elif key in self.messages and self.messages[key].complete:
+                message = self._pop(key)
+            else:
+                break
+            self.sequence_number = tsn_plus_one(self.sequence_number)
+            if message is not None:
+                yield message
+
+    def skip_messages(self, unordered, message_id):
+        """
+        Forget all messages up to and including `message_id`, they were
+        abandoned by the sender.
+        """
+        def skipped(key):
+            return key[0] == unordered and not tsn_gt(key[1], message_id)
+
+        for key in [k for k in self.messages if skipped(k)]:
+            del self.messages[key]
+        self.discarded = set(k for k in self.discarded if not skipped(k))
+        if unordered:
+            self.unordered_skipped = message_id
+        elif not tsn_gt(self.sequence_number, message_id):
+            self.sequence_number = tsn_plus_one(message_id)
+
+    def _pop(self, key):
+        message = self.messages.pop(key)
+        first = message.fragments[0]
+        user_data = b''.join([message.fragments[fsn].user_data
+                              for fsn in range(len(message.fragments))])
+        return (first.stream_id, first.protocol, user_data)
+
+
+class OutboundMessage:
+    """
+    A message waiting to be fragmented into DATA chunks.
+    """
+    def __init__(self, stream_id, protocol, user_data, ordered, max_retransmits, expiry):
+        self.abandoned = False
+        self.expiry = expiry
+        self.fsn = 0
+        self.max_retransmits = max_retransmits
+        self.ordered = ordered
+        self.pos = 0
+        self.protocol = protocol
+        self.stream_id = stream_id
+        self.stream_seq = None
+        self.user_data = user_data
+
+    @property
+    def remaining(self):
+        return len(self.user_data) - self.pos
+
+
 class Endpoint:
-    def __init__(self, is_server, transport):
+    def __init__(self, is_server, transport, max_message_size=MAX_MESSAGE_SIZE):
         self.is_server = is_server
-        self.recv_queue = asyncio.Queue()
-        self.send_queue = []
+        self.recv_queue = ClosableQueue()
         self.role = is_server and 'server' or 'client'
         self.state = self.State.CLOSED
         self.transport = transport
         self.closed = asyncio.Event()
+        self.established = asyncio.Event()
+        self._receive_task = None
+        self._receiving = False
 
         self.hmac_key = os.urandom(16)
         self.advertised_rwnd = 131072
         self.outbound_streams = 256
         self.inbound_streams = 2048
-        self.stream_frags = {}
+        self.max_message_size = max_message_size
+        self.remote_max_message_size = DEFAULT_MAX_MESSAGE_SIZE
+        self.inbound = {}
         self.stream_seq = {}
+        self.unordered_stream_seq = {}
 
         self.local_tsn = random32()
         self.local_verification_tag = random32()
 
-        self.remote_tsn = None
+        # message interleaving is used if both parties support it
+        self.interleaving = False
+        self.interleaving_supported = True
+
+        self.remote_partial_reliability = False
+        self.remote_reconfig = False
         self.remote_verification_tag = 0
 
+        # outbound queues, one per stream, served round-robin
+        self.outbound_order = deque()
+        self.outbound_queues = {}
+        self.outbound_streams_count = self.outbound_streams
+        self._send_event = asyncio.Event()
+        self._send_task = None
+
+        # outbound TSN tracking
+        self.advanced_peer_ack_tsn = tsn_minus_one(self.local_tsn)
+        self.forward_tsn_needed = False
+        self.forward_tsn_streams = {}
+        self.last_sacked_tsn = tsn_minus_one(self.local_tsn)
+        self.sent_queue = deque()
+        self._t3_handle = None
+
+        # round-trip time estimation and failure detection
+        self.error_count = 0
+        self.rto = SCTP_RTO_INITIAL
+        self.rttvar = None
+        self.srtt = None
+        self._hb_handle = None
+        self._hb_info = None
+        self._rtt_chunk = None
+
+        # congestion control
+        self.cwnd = SCTP_CWND_INITIAL
+        self.fast_recovery_exit = None
+        self.flight_size = 0
+        self.partial_bytes_acked = 0
+        self.peer_rwnd = 0
+        self.ssthresh = None
+
+        # called with each DATA chunk which is acknowledged or abandoned
+        self.data_released_callback = None
+
+        # stream reconfiguration
+        self.reconfig_needed = False
+        self.reconfig_pending = None
+        self.reconfig_queue = []
+        self.reconfig_request = None
+        self.reconfig_request_seq = self.local_tsn
+        self.reconfig_response = None
+        self.reconfig_response_seq = 0
+        self._reconfig_handle = None
+
+        # received data which was not consumed yet, shrinks the receive window
+        self.last_advertised_rwnd = self.advertised_rwnd
+        self.recv_buffered = 0
+
+        # inbound TSN tracking
+        self.last_received_tsn = None
+        self.sack_duplicates = []
+        self.sack_misordered = set()
+        self.sack_needed = False
+
     async def abort(self):
         chunk = AbortChunk()
         await self._send_chunk(chunk)
         self._set_state(self.State.CLOSED)
 
     async def close(self):
+        """
+        Gracefully shut down the association.
+
+        Messages which were already queued are delivered first, the SHUTDOWN
+        is only sent once all outstanding data is acknowledged.
+        """
         if self.state == self.State.CLOSED:
-            self.closed.set()
+            self._set_closed()
             return
 
-        chunk = ShutdownChunk()
-        await self._send_chunk(chunk)
-        self._set_state(self.State.SHUTDOWN_SENT)
+        if self.state == self.State.ESTABLISHED:
+            self._set_state(self.State.SHUTDOWN_PENDING)
+            self._send_event.set()
+        elif self.state in (self.State.COOKIE_WAIT, self.State.COOKIE_ECHOED):
+            await self._send_shutdown()
         await self.closed.wait()
 
+    def is_stream_resetting(self, stream_id):
+        """
+        Return True if an outgoing reset of the given stream has not completed.
+        """
+        return stream_id in self.reconfig_queue or (
+            isinstance(self.reconfig_request, StreamResetOutgoingParam) and
+            stream_id in self.reconfig_request.streams)
+
     async def recv(self):
-        data = await first_completed(self.recv_queue.get(), self.closed.wait())
-        if data is True:
-            raise ConnectionError
+        """
+        Receive the next (stream_id, protocol, user_data) message.
+
+        A `None` protocol and user data signal that the remote party reset
+        the stream.
+        """
+        data = await self.recv_queue.get()
+        if data[2] is not None:
+            self.release_recv(len(data[2]))
         return data
 
-    async def send(self, stream_id, protocol, user_data):
-        self.send_queue.append((stream_id, protocol, user_data))
-        await self._flush()
+    def hold_recv(self, length):
+        """
+        Count `length` bytes of received data as still buffered by the
+        application, which shrinks the advertised receive window.
+        """
+        self.recv_buffered += length
+
+    def release_recv(self, length):
+        """
+        Report that `length` bytes of buffered received data were consumed.
+
+        If the receive window had closed, a window update is sent once it
+        has reopened by half.
+        """
+        self.recv_buffered -= length
+        if (self.state == self.State.ESTABLISHED and
+           self.last_advertised_rwnd < SCTP_MTU and
+           self._receive_window() >= self.advertised_rwnd // 2):
+            self.last_advertised_rwnd = self._receive_window()
+            asyncio.ensure_future(self._send_sack())
+
+    def reset_stream(self, stream_id):
+        """
+        Reset an outgoing stream once all the messages queued on it are sent,
+        so that its identifier can be reused (RFC 6525).
+        """
+        if self.remote_reconfig and not self.is_stream_resetting(stream_id):
+            self.reconfig_queue.append(stream_id)
+            self._send_event.set()
+
+    async def send(self, stream_id, protocol, user_data, ordered=True,
+                   max_retransmits=None, expiry=None):
+        """
+        Send a message on the given stream.
+
+        See :meth:`send_nowait` for details.
+        """
+        self.send_nowait(stream_id, protocol, user_data, ordered=ordered,
+                         max_retransmits=max_retransmits, expiry=expiry)
+
+    def send_nowait(self, stream_id, protocol, user_data, ordered=True,
+                    max_retransmits=None, expiry=None):
+        """
+        Queue a message on the given stream, it is transmitted by the
+        association's send scheduler as the congestion window allows.
+
+        If the remote party supports partial reliability, the message is
+        abandoned after `max_retransmits` retransmissions or once the
+        `expiry` time has passed.
+
+        Raises :class:`ConnectionError` once the association is shutting down.
+        """
+        if self.closed.is_set() or self.state not in (
+                self.State.CLOSED, self.State.COOKIE_WAIT, self.State.COOKIE_ECHOED,
+                self.State.ESTABLISHED):
+            raise ConnectionError('Cannot send data, association is closed')
+        if self.remote_max_message_size and len(user_data) > self.remote_max_message_size:
+            raise ValueError('Message size %d exceeds maximum message size %d' % (
+                len(user_data), self.remote_max_message_size))
+        if not self.remote_partial_reliability:
+            max_retransmits = None
+            expiry = None
+
+        queue = self.outbound_queues.get(stream_id)
+        if queue is None:
+            queue = deque()
+            self.outbound_queues[stream_id] = queue
+            self.outbound_order.append(stream_id)
+        queue.append(OutboundMessage(
+            stream_id=stream_id,
+            protocol=protocol,
+            user_data=memoryview(user_data),
+            ordered=ordered,
+            max_retransmits=max_retransmits,
+            expiry=expiry))
+        self._send_event.set()
 
     async def run(self):
         if not self.is_server:
@@ -329,13 +1031,26 @@ class Endpoint:
             chunk.outbound_streams = self.outbound_streams
             chunk.inbound_streams = self.inbound_streams
             chunk.initial_tsn = self.local_tsn
+            self._set_local_extensions(chunk.params)
             await self._send_chunk(chunk)
             self._set_state(self.State.COOKIE_WAIT)
 
-        while True:
-            data = await first_completed(self.transport.recv(), self.closed.wait())
-            if data is True:
-                break
+        # the receive loop is cancelled if the association closes while it
+        # waits for a packet, rather than racing each packet against the
+        # closed event
+        self._receive_task = asyncio.ensure_future(self._receive_loop())
+        try:
+            await self._receive_task
+        except asyncio.CancelledError:
+            pass
+
+    async def _receive_loop(self):
+        while not self.closed.is_set():
+            self._receiving = True
+            try:
+                data = await self.transport.recv()
+            finally:
+                self._receiving = False
 
             try:
                 packet = Packet.parse(data)
@@ -359,35 +1074,250 @@ class Endpoint:
             for chunk in packet.chunks:
                 await self._receive_chunk(chunk)
 
-    async def _flush(self):
-        if self.state != self.State.ESTABLISHED:
-            return
+            # acknowledge received data
+            if self.sack_needed:
+                await self._send_sack()
+
+    def _next_chunk(self):
+        """
+        Cut the next DATA chunk from the outbound queues, serving streams
+        in a round-robin fashion.
+
+        Streams take turns one message at a time, or one fragment at a time
+        when message interleaving is in use.
+        """
+        now = time.time()
+        skipped = 0
+        while skipped < len(self.outbound_order):
+            stream_id = self.outbound_order[0]
+            queue = self.outbound_queues[stream_id]
+            message = queue[0]
+
+            # wait for the remote party to accept additional streams
+            if self.remote_reconfig and stream_id >= self.outbound_streams_count:
+                self.outbound_order.rotate(-1)
+                skipped += 1
+                continue
 
-        for stream_id, protocol, user_data in self.send_queue:
-            stream_seq = self.stream_seq.get(stream_id, 0)
+            # drop messages which were abandoned or expired
+            if message.abandoned or (
+               message.pos == 0 and message.expiry is not None and message.expiry < now):
+                self._data_released(message.stream_id, message.protocol, message.remaining)
+                self._pop_message(stream_id)
+                skipped = 0
+                continue
 
-            fragments = math.ceil(len(user_data) / USERDATA_MAX_LENGTH)
-            pos = 0
-            for fragment in range(0, fragments):
+            # assign stream sequence number or message identifier
+            if message.pos == 0:
+                if self.interleaving:
+                    seqs = self.stream_seq if message.ordered else self.unordered_stream_seq
+                    message.stream_seq = seqs.get(stream_id, 0)
+                    seqs[stream_id] = tsn_plus_one(message.stream_seq)
+                elif message.ordered:
+                    message.stream_seq = self.stream_seq.get(stream_id, 0)
+                    self.stream_seq[stream_id] = (message.stream_seq + 1) % SCTP_SEQ_MODULO
+
+            if self.interleaving:
+                chunk = IDataChunk()
+                chunk.message_id = message.stream_seq
+                chunk.fsn = message.fsn
+                message.fsn += 1
+            else:
                 chunk = DataChunk()
-                chunk.flags = 0
-                if fragment == 0:
-                    chunk.flags |= SCTP_DATA_FIRST_FRAG
-                if fragment == fragments - 1:
-                    chunk.flags |= SCTP_DATA_LAST_FRAG
-                chunk.tsn = self.local_tsn
-                chunk.stream_id = stream_id
-                chunk.stream_seq = stream_seq
-                chunk.protocol = protocol
-                chunk.user_data = user_data[pos:pos + USERDATA_MAX_LENGTH]
+                chunk.stream_seq = message.stream_seq or 0
+            chunk.flags = 0
+            if not message.ordered:
+                chunk.flags |= SCTP_DATA_UNORDERED
+            if message.pos == 0:
+                chunk.flags |= SCTP_DATA_FIRST_FRAG
+            if message.remaining <= USERDATA_MAX_LENGTH:
+                chunk.flags |= SCTP_DATA_LAST_FRAG
+            chunk.tsn = self.local_tsn
+            chunk.stream_id = stream_id
+            chunk.protocol = message.protocol
+            chunk.user_data = message.user_data[message.pos:message.pos + USERDATA_MAX_LENGTH]
+            chunk._abandoned = False
+            chunk._acked = False
+            chunk._fast_retransmit = False
+            chunk._in_flight = False
+            chunk._message = message
+            chunk._misses = 0
+            chunk._retransmit = False
+            chunk._sent_count = 0
+
+            self.local_tsn = tsn_plus_one(self.local_tsn)
+            message.pos += len(chunk.user_data)
+            if not message.remaining:
+                self._pop_message(stream_id)
+            elif self.interleaving:
+                self.outbound_order.rotate(-1)
+            return chunk
+
+    def _pop_message(self, stream_id):
+        """
+        Remove the message at the head of a stream's queue and move on to the
+        next stream.
+        """
+        queue = self.outbound_queues[stream_id]
+        queue.popleft()
+        if queue:
+            self.outbound_order.rotate(-1)
+        else:
+            self.outbound_order.popleft()
+            del self.outbound_queues[stream_id]
+
+    async def _send_loop(self):
+        """
+        The association's send scheduler.
+        """
+        while self.state in (self.State.ESTABLISHED, self.State.SHUTDOWN_PENDING):
+            self._send_event.clear()
+            await self._transmit()
+
+            # all queued data is acknowledged (RFC 4960 section 9.2)
+            if (self.state == self.State.SHUTDOWN_PENDING and
+               not self.outbound_queues and not self.sent_queue):
+                await self._send_shutdown()
+                break
 
-                pos += USERDATA_MAX_LENGTH
-                self.local_tsn = (self.local_tsn + 1) % SCTP_TSN_MODULO
-                await self._send_chunk(chunk)
+            await self._send_event.wait()
+
+    async def _transmit(self):
+        """
+        Send as much queued data as the congestion window and the receiver
+        window allow, bundling chunks into packets.
+        """
+        chunks = []
+
+        # FORWARD-TSN
+        if self.forward_tsn_needed:
+            streams = sorted(self.forward_tsn_streams.items())
+            if self.interleaving:
+                chunk = IForwardTsnChunk()
+                chunk.streams = [(stream_id, unordered, message_id)
+                                 for (stream_id, unordered), message_id in streams]
+            else:
+                chunk = ForwardTsnChunk()
+                chunk.streams = [(stream_id, stream_seq)
+                                 for (stream_id, unordered), stream_seq in streams]
+            chunk.cumulative_tsn = self.advanced_peer_ack_tsn
+            chunks.append(chunk)
+            self.forward_tsn_needed = False
+
+        # RE-CONFIG
+        if self.reconfig_request is None:
+            self._prepare_reconfig_request()
+        if self.reconfig_needed:
+            chunk = ReconfigChunk()
+            if isinstance(self.reconfig_request, StreamResetOutgoingParam):
+                param_type = RECONFIG_PARAM_OUTGOING_RESET
+            else:
+                param_type = RECONFIG_PARAM_ADD_OUT_STREAMS
+            chunk.params.append((param_type, bytes(self.reconfig_request)))
+            chunks.append(chunk)
+            self.reconfig_needed = False
+            self._reconfig_start()
+
+        # retransmissions, fast retransmissions ignore the congestion window
+        for chunk in self.sent_queue:
+            if chunk._retransmit and not chunk._abandoned:
+                if self.flight_size >= self.cwnd and not chunk._fast_retransmit:
+                    continue
+                chunk._fast_retransmit = False
+                chunk._retransmit = False
+                self._flight_size_increase(chunk)
+                chunks.append(chunk)
+
+        # new data
+        while self.flight_size < self.cwnd and (
+              not self.flight_size or self.peer_rwnd >= USERDATA_MAX_LENGTH):
+            chunk = self._next_chunk()
+            if chunk is None:
+                break
+            if self._rtt_chunk is None:
+                chunk._sent_time = time.time()
+                self._rtt_chunk = chunk
+            self.peer_rwnd = max(0, self.peer_rwnd - len(chunk.user_data))
+            self.sent_queue.append(chunk)
+            self._flight_size_increase(chunk)
+            chunks.append(chunk)
+
+        if chunks:
+            await self._send_chunks(chunks)
+            if self.sent_queue or tsn_gt(self.advanced_peer_ack_tsn, self.last_sacked_tsn):
+                self._t3_start()
+
+                # the association is not idle
+                self._hb_restart()
+
+    def _prepare_reconfig_request(self):
+        """
+        Build the next stream reconfiguration request, if any.
+
+        Streams are only reset once all their queued messages have been cut
+        into DATA chunks, and streams are added when messages are queued on
+        identifiers the remote party does not accept yet.
+        """
+        streams = [x for x in self.reconfig_queue if x not in self.outbound_queues]
+        if streams:
+            for stream_id in streams:
+                self.reconfig_queue.remove(stream_id)
+            self.reconfig_request = StreamResetOutgoingParam(
+                request_sequence=self.reconfig_request_seq,
+                response_sequence=tsn_minus_one(self.reconfig_response_seq),
+                last_tsn=tsn_minus_one(self.local_tsn),
+                streams=streams)
+        elif self.remote_reconfig and self.outbound_queues:
+            needed = max(self.outbound_queues.keys()) + 1 - self.outbound_streams_count
+            if needed <= 0 or self.outbound_streams_count >= SCTP_MAX_STREAMS:
+                return
+            self.reconfig_request = StreamAddOutgoingParam(
+                request_sequence=self.reconfig_request_seq,
+                new_streams=min(max(needed, 16), SCTP_MAX_STREAMS - self.outbound_streams_count))
+        else:
+            return
+        self.reconfig_request_seq = tsn_plus_one(self.reconfig_request_seq)
+        self.reconfig_needed = True
+
+    def _count_misses(self, highest_newly_acked):
+        """
+        Count a missing report for each outstanding chunk below the highest
+        TSN acknowledged by a SACK, and fast retransmit the chunks reported
+        missing three times (RFC 4960 section 7.2.4).
+        """
+        for chunk in self.sent_queue:
+            if not tsn_gt(highest_newly_acked, chunk.tsn):
+                break
+            if chunk._acked or chunk._retransmit or chunk._misses >= 3:
+                continue
+            chunk._misses += 1
+            if chunk._misses < 3 or self._maybe_abandon(chunk):
+                continue
+
+            chunk._fast_retransmit = True
+            chunk._retransmit = True
+            self._flight_size_decrease(chunk)
 
-            self.stream_seq[stream_id] = (stream_seq + 1) % SCTP_SEQ_MODULO
+            # adjust congestion window once per recovery
+            if self.fast_recovery_exit is None:
+                self.fast_recovery_exit = tsn_minus_one(self.local_tsn)
+                self.ssthresh = max(self.cwnd // 2, 4 * SCTP_MTU)
+                self.cwnd = self.ssthresh
+                self.partial_bytes_acked = 0
 
-        self.send_queue = []
+    def _data_released(self, stream_id, protocol, length):
+        if self.data_released_callback is not None:
+            self.data_released_callback(stream_id, protocol, length)
+
+    def _flight_size_decrease(self, chunk):
+        if chunk._in_flight:
+            chunk._in_flight = False
+            self.flight_size -= len(chunk.user_data)
+
+    def _flight_size_increase(self, chunk):
+        chunk._in_flight = True
+        chunk._sent_count += 1
+        self.flight_size += len(chunk.user_data)
 
     def _get_timestamp(self):
         return int(time.time())
@@ -397,8 +1327,13 @@ class Endpoint:
 
         # server
         if isinstance(chunk, InitChunk) and self.is_server:
-            self.remote_tsn = chunk.initial_tsn
+            self.last_received_tsn = tsn_minus_one(chunk.initial_tsn)
+            self.outbound_streams_count = min(self.outbound_streams, chunk.inbound_streams)
+            self.reconfig_response_seq = chunk.initial_tsn
+            self.peer_rwnd = chunk.advertised_rwnd
             self.remote_verification_tag = chunk.initiate_tag
+            self.ssthresh = chunk.advertised_rwnd
+            self._set_extensions(chunk.params)
 
             ack = InitAckChunk()
             ack.initiate_tag = self.local_verification_tag
@@ -406,6 +1341,7 @@ class Endpoint:
             ack.outbound_streams = self.outbound_streams
             ack.inbound_streams = self.inbound_streams
             ack.initial_tsn = self.local_tsn
+            self._set_local_extensions(ack.params)
 
             # generate state cookie
             cookie = pack('!L', self._get_timestamp())
@@ -435,8 +1371,13 @@ class Endpoint:
 
         # client
         if isinstance(chunk, InitAckChunk) and not self.is_server:
-            self.remote_tsn = chunk.initial_tsn
+            self.last_received_tsn = tsn_minus_one(chunk.initial_tsn)
+            self.outbound_streams_count = min(self.outbound_streams, chunk.inbound_streams)
+            self.reconfig_response_seq = chunk.initial_tsn
+            self.peer_rwnd = chunk.advertised_rwnd
             self.remote_verification_tag = chunk.initiate_tag
+            self.ssthresh = chunk.advertised_rwnd
+            self._set_extensions(chunk.params)
 
             echo = CookieEchoChunk()
             for k, v in chunk.params:
@@ -454,23 +1395,44 @@ class Endpoint:
             return
 
         # common
-        elif isinstance(chunk, DataChunk):
-            sack = SackChunk()
-            sack.cumulative_tsn = chunk.tsn
-            sack.advertised_rwnd = self.advertised_rwnd
-            await self._send_chunk(sack)
+        elif isinstance(chunk, (DataChunk, IDataChunk)):
+            self.sack_needed = True
+
+            # drop new data while the receive window is closed (RFC 4960 section 6.2)
+            if (not self._receive_window() and
+               tsn_gt(chunk.tsn, self.last_received_tsn) and
+               not [x for x in self.sack_misordered if tsn_gt(x, chunk.tsn)]):
+                return
+
+            # mark as received
+            if self._mark_received(chunk.tsn):
+                return
+
+            # find stream
+            inbound_stream = self._get_inbound_stream(chunk.stream_id)
 
             # defragment data
-            if chunk.flags & SCTP_DATA_FIRST_FRAG:
-                self.stream_frags[chunk.stream_id] = chunk.user_data
-            else:
-                self.stream_frags[chunk.stream_id] += chunk.user_data
-            if chunk.flags & SCTP_DATA_LAST_FRAG:
-                user_data = self.stream_frags.pop(chunk.stream_id)
-                await self.recv_queue.put((chunk.stream_id, chunk.protocol, user_data))
+            inbound_stream.add_chunk(chunk)
+            for message in inbound_stream.pop_messages():
+                await self._deliver(message)
+
+            # perform a deferred stream reset
+            await self._receive_reconfig_pending()
         elif isinstance(chunk, SackChunk):
-            # TODO
-            pass
+            await self._receive_sack_chunk(chunk)
+        elif isinstance(chunk, HeartbeatChunk):
+            ack = HeartbeatAckChunk()
+            ack.params = chunk.params
+            await self._send_chunk(ack)
+        elif isinstance(chunk, HeartbeatAckChunk):
+            self._receive_heartbeat_ack_chunk(chunk)
+        elif isinstance(chunk, (ForwardTsnChunk, IForwardTsnChunk)):
+            await self._receive_forward_tsn_chunk(chunk)
+        elif isinstance(chunk, ReconfigChunk):
+            for param_type, param_value in chunk.params:
+                param_cls = RECONFIG_PARAM_TYPES.get(param_type)
+                if param_cls:
+                    await self._receive_reconfig_param(param_cls.parse(param_value))
         elif isinstance(chunk, AbortChunk):
             logger.warning('Association was aborted by remote party')
             self._set_state(self.State.CLOSED)
@@ -487,6 +1449,280 @@ class Endpoint:
         elif isinstance(chunk, ShutdownCompleteChunk):
             self._set_state(self.State.CLOSED)
 
+    def _abandon(self, chunk):
+        """
+        Abandon all the fragments of the message `chunk` belongs to.
+        """
+        chunk._message.abandoned = True
+        for c in self.sent_queue:
+            if c._message is chunk._message and not c._abandoned:
+                c._abandoned = True
+                self._flight_size_decrease(c)
+
+    def _maybe_abandon(self, chunk):
+        """
+        Check whether a chunk has exceeded its reliability parameters.
+        """
+        if chunk._abandoned:
+            return True
+        message = chunk._message
+        if ((message.max_retransmits is not None and
+             chunk._sent_count > message.max_retransmits) or
+           (message.expiry is not None and message.expiry < time.time())):
+            self._abandon(chunk)
+            return True
+        return False
+
+    def _update_advanced_peer_ack_point(self):
+        """
+        Skip over abandoned chunks at the head of the sent queue (RFC 3758).
+        """
+        if tsn_gt(self.last_sacked_tsn, self.advanced_peer_ack_tsn):
+            self.advanced_peer_ack_tsn = self.last_sacked_tsn
+            self.forward_tsn_streams.clear()
+
+        while self.sent_queue and self.sent_queue[0]._abandoned:
+            chunk = self.sent_queue.popleft()
+            if chunk is self._rtt_chunk:
+                self._rtt_chunk = None
+            self._data_released(chunk.stream_id, chunk.protocol, len(chunk.user_data))
+            self.advanced_peer_ack_tsn = chunk.tsn
+            unordered = bool(chunk.flags & SCTP_DATA_UNORDERED)
+            if self.interleaving:
+                self.forward_tsn_streams[(chunk.stream_id, unordered)] = chunk.message_id
+            elif not unordered:
+                self.forward_tsn_streams[(chunk.stream_id, unordered)] = chunk.stream_seq
+
+        if tsn_gt(self.advanced_peer_ack_tsn, self.last_sacked_tsn):
+            self.forward_tsn_needed = True
+            self._send_event.set()
+
+    async def _deliver(self, message):
+        self.hold_recv(len(message[2]))
+        await self.recv_queue.put(message)
+
+    def _get_inbound_stream(self, stream_id):
+        inbound_stream = self.inbound.get(stream_id)
+        if inbound_stream is None:
+            if self.interleaving:
+                inbound_stream = InterleavedInboundStream(max_message_size=self.max_message_size)
+            else:
+                inbound_stream = InboundStream(max_message_size=self.max_message_size)
+            self.inbound[stream_id] = inbound_stream
+        return inbound_stream
+
+    def _mark_received(self, tsn):
+        """
+        Record that we received the given TSN, return True if it is a duplicate.
+        """
+        if not tsn_gt(tsn, self.last_received_tsn) or tsn in self.sack_misordered:
+            self.sack_duplicates.append(tsn)
+            return True
+
+        self.sack_misordered.add(tsn)
+        while tsn_plus_one(self.last_received_tsn) in self.sack_misordered:
+            self.last_received_tsn = tsn_plus_one(self.last_received_tsn)
+            self.sack_misordered.remove(self.last_received_tsn)
+        return False
+
+    async def _receive_forward_tsn_chunk(self, chunk):
+        self.sack_needed = True
+
+        if not tsn_gt(chunk.cumulative_tsn, self.last_received_tsn):
+            return
+
+        # advance cumulative TSN
+        self.last_received_tsn = chunk.cumulative_tsn
+        self.sack_misordered = set(
+            tsn for tsn in self.sack_misordered if tsn_gt(tsn, self.last_received_tsn))
+        while tsn_plus_one(self.last_received_tsn) in self.sack_misordered:
+            self.last_received_tsn = tsn_plus_one(self.last_received_tsn)
+            self.sack_misordered.remove(self.last_received_tsn)
+
+        # skip over abandoned messages
+        if isinstance(chunk, IForwardTsnChunk):
+            for stream_id, unordered, message_id in chunk.streams:
+                self._get_inbound_stream(stream_id).skip_messages(unordered, message_id)
+        else:
+            for stream_id, stream_seq in chunk.streams:
+                inbound_stream = self._get_inbound_stream(stream_id)
+                if not seq_gt(inbound_stream.sequence_number, stream_seq):
+                    inbound_stream.sequence_number = (stream_seq + 1) % SCTP_SEQ_MODULO
+
+        # deliver messages which are no longer blocked, then drop leftovers
+        for inbound_stream in self.inbound.values():
+            for message in inbound_stream.pop_messages():
+                await self._deliver(message)
+            if isinstance(inbound_stream, InboundStream):
+                inbound_stream.prune_chunks(self.last_received_tsn)
+
+        # perform a deferred stream reset
+        await self._receive_reconfig_pending()
+
+    def _receive_heartbeat_ack_chunk(self, chunk):
+        for k, v in chunk.params:
+            if k == HEARTBEAT_INFO and v == self._hb_info:
+                self._hb_info = None
+                self.error_count = 0
+                self._update_rto(time.time() - unpack('!d', v)[0])
+
+    async def _receive_reconfig_param(self, param):
+        logger.debug('%s < %s', self.role, param.__class__.__name__)
+
+        if isinstance(param, StreamResetResponseParam):
+            request = self.reconfig_request
+            if request is None or param.response_sequence != request.request_sequence:
+                return
+            if param.result == RECONFIG_RESULT_IN_PROGRESS:
+                # the request is retransmitted when the timer expires
+                return
+
+            self._reconfig_cancel()
+            self.reconfig_request = None
+            if param.result in [RECONFIG_RESULT_SUCCESS_NOP, RECONFIG_RESULT_SUCCESS_PERFORMED]:
+                if isinstance(request, StreamResetOutgoingParam):
+                    for stream_id in request.streams:
+                        self.stream_seq.pop(stream_id, None)
+                        self.unordered_stream_seq.pop(stream_id, None)
+                else:
+                    self.outbound_streams_count += request.new_streams
+            else:
+                logger.warning('%s x Stream reconfiguration failed with result %d' % (
+                    self.role, param.result))
+            self._send_event.set()
+            return
+
+        # retransmitted request, repeat our response
+        if (self.reconfig_response is not None and
+           param.request_sequence == self.reconfig_response.response_sequence):
+            await self._send_reconfig_response(self.reconfig_response)
+            return
+        elif param.request_sequence != self.reconfig_response_seq:
+            await self._send_reconfig_response(StreamResetResponseParam(
+                response_sequence=param.request_sequence,
+                result=RECONFIG_RESULT_BAD_SEQUENCE))
+            return
+
+        if isinstance(param, StreamResetOutgoingParam):
+            # wait until we received all the data sent before the request
+            self.reconfig_pending = param
+            await self._receive_reconfig_pending()
+        else:
+            await self._send_reconfig_response(StreamResetResponseParam(
+                response_sequence=param.request_sequence,
+                result=RECONFIG_RESULT_SUCCESS_PERFORMED))
+
+    async def _receive_reconfig_pending(self):
+        """
+        Reset incoming streams once all the data which was sent on them
+        before the reset request has been received.
+        """
+        param = self.reconfig_pending
+        if param is None or tsn_gt(param.last_tsn, self.last_received_tsn):
+            return
+
+        self.reconfig_pending = None
+        for stream_id in param.streams:
+            self.inbound.pop(stream_id, None)
+            await self.recv_queue.put((stream_id, None, None))
+        await self._send_reconfig_response(StreamResetResponseParam(
+            response_sequence=param.request_sequence,
+            result=RECONFIG_RESULT_SUCCESS_PERFORMED))
+
+    async def _receive_sack_chunk(self, chunk):
+        if tsn_gt(self.last_sacked_tsn, chunk.cumulative_tsn):
+            return
+
+        flight_size = self.flight_size
+        bytes_acked = 0
+        highest_newly_acked = None
+
+        # remove cumulatively acknowledged chunks
+        cumulative_acked = False
+        while self.sent_queue and not tsn_gt(self.sent_queue[0].tsn, chunk.cumulative_tsn):
+            acked = self.sent_queue.popleft()
+            if acked is self._rtt_chunk:
+                # Karn's algorithm, only sample chunks which were sent once
+                if acked._sent_count == 1:
+                    self._update_rto(time.time() - acked._sent_time)
+                self._rtt_chunk = None
+            if not acked._acked:
+                bytes_acked += len(acked.user_data)
+            self._flight_size_decrease(acked)
+            self._data_released(acked.stream_id, acked.protocol, len(acked.user_data))
+            cumulative_acked = True
+            highest_newly_acked = acked.tsn
+        self.last_sacked_tsn = chunk.cumulative_tsn
+        if cumulative_acked:
+            self.error_count = 0
+
+        # mark chunks acknowledged by gap blocks
+        for gap_start, gap_end in chunk.gaps:
+            for c in self.sent_queue:
+                offset = (c.tsn - chunk.cumulative_tsn) % SCTP_TSN_MODULO
+                if offset >= gap_start and offset <= gap_end and not c._acked:
+                    bytes_acked += len(c.user_data)
+                    c._acked = True
+                    c._retransmit = False
+                    self._flight_size_decrease(c)
+                    if highest_newly_acked is None or tsn_gt(c.tsn, highest_newly_acked):
+                        highest_newly_acked = c.tsn
+
+        # leave fast recovery once the data outstanding when it started is acknowledged
+        if (self.fast_recovery_exit is not None and
+           not tsn_gt(self.fast_recovery_exit, chunk.cumulative_tsn)):
+            self.fast_recovery_exit = None
+
+        # update congestion window (RFC 4960 section 7.2)
+        if cumulative_acked and flight_size >= self.cwnd and self.fast_recovery_exit is None:
+            if self.cwnd <= self.ssthresh:
+                self.cwnd += min(bytes_acked, SCTP_MTU)
+            else:
+                self.partial_bytes_acked += bytes_acked
+                if self.partial_bytes_acked >= self.cwnd:
+                    self.partial_bytes_acked -= self.cwnd
+                    self.cwnd += SCTP_MTU
+        self.peer_rwnd = max(0, chunk.advertised_rwnd - self.flight_size)
+
+        # count missing reports (RFC 4960 section 7.2.4)
+        if highest_newly_acked is not None:
+            self._count_misses(highest_newly_acked)
+
+        # update retransmission timer
+        if not self.sent_queue:
+            self._t3_cancel()
+        elif cumulative_acked:
+            self._t3_restart()
+
+        # partial reliability
+        self._update_advanced_peer_ack_point()
+
+        # the window may have opened
+        self._send_event.set()
+
+    async def _send_chunks(self, chunks):
+        """
+        Send chunks, bundling as many as possible into each packet.
+        """
+        packet = None
+        size = 0
+        for chunk in chunks:
+            data = bytes(chunk)
+            if packet is not None and size + len(data) > SCTP_MTU:
+                await self.transport.send(bytes(packet))
+                packet = None
+            if packet is None:
+                packet = Packet(
+                    source_port=5000,
+                    destination_port=5000,
+                    verification_tag=self.remote_verification_tag)
+                size = 12
+            logger.debug('%s > %s', self.role, repr(chunk))
+            packet.chunks.append(chunk)
+            size += len(data)
+        if packet is not None:
+            await self.transport.send(bytes(packet))
+
     async def _send_chunk(self, chunk):
         logger.debug('%s > %s', self.role, repr(chunk))
         packet = Packet(
@@ -496,14 +1732,196 @@ class Endpoint:
         packet.chunks.append(chunk)
         await self.transport.send(bytes(packet))
 
+    async def _send_heartbeat(self):
+        self._hb_info = pack('!d', time.time())
+        chunk = HeartbeatChunk()
+        chunk.params.append((HEARTBEAT_INFO, self._hb_info))
+        await self._send_chunk(chunk)
+
+    async def _send_reconfig_response(self, param):
+        if param.result != RECONFIG_RESULT_BAD_SEQUENCE:
+            self.reconfig_response = param
+            self.reconfig_response_seq = tsn_plus_one(param.response_sequence)
+
+        chunk = ReconfigChunk()
+        chunk.params.append((RECONFIG_PARAM_RESPONSE, bytes(param)))
+        await self._send_chunk(chunk)
+
+    async def _send_shutdown(self):
+        chunk = ShutdownChunk()
+        await self._send_chunk(chunk)
+        self._set_state(self.State.SHUTDOWN_SENT)
+
+    async def _send_sack(self):
+        gaps = []
+        gap_next = None
+        for tsn in sorted(self.sack_misordered,
+                          key=lambda x: (x - self.last_received_tsn) % SCTP_TSN_MODULO):
+            pos = (tsn - self.last_received_tsn) % SCTP_TSN_MODULO
+            if tsn == gap_next:
+                gaps[-1][1] = pos
+            else:
+                gaps.append([pos, pos])
+            gap_next = tsn_plus_one(tsn)
+
+        sack = SackChunk()
+        sack.cumulative_tsn = self.last_received_tsn
+        sack.advertised_rwnd = self._receive_window()
+        sack.duplicates = self.sack_duplicates[:]
+        sack.gaps = [tuple(x) for x in gaps]
+        await self._send_chunk(sack)
+
+        self.last_advertised_rwnd = sack.advertised_rwnd
+        self.sack_duplicates.clear()
+        self.sack_needed = False
+
+    def _receive_window(self):
+        return max(0, self.advertised_rwnd - self.recv_buffered)
+
+    def _set_extensions(self, params):
+        """
+        Record the extensions supported by the remote party.
+        """
+        for k, v in params:
+            if k == FORWARD_TSN_SUPPORTED:
+                self.remote_partial_reliability = True
+            elif k == SUPPORTED_CHUNK_EXT:
+                self.interleaving = self.interleaving_supported and IDATA_CHUNK in v
+                self.remote_partial_reliability |= FORWARD_TSN_CHUNK in v
+                self.remote_reconfig = RECONFIG_CHUNK in v
+
+    def _set_local_extensions(self, params):
+        """
+        Advertise the extensions we support.
+        """
+        extensions = [RECONFIG_CHUNK, FORWARD_TSN_CHUNK]
+        if self.interleaving_supported:
+            extensions += [IDATA_CHUNK, IFORWARD_TSN_CHUNK]
+        params.append((FORWARD_TSN_SUPPORTED, b''))
+        params.append((SUPPORTED_CHUNK_EXT, bytes(extensions)))
+
     def _set_state(self, state):
         if state != self.state:
             logger.debug('%s - %s -> %s' % (self.role, self.state, state))
             self.state = state
             if state == self.State.ESTABLISHED:
-                asyncio.ensure_future(self._flush())
+                self.established.set()
+                self._hb_restart()
+                self._send_task = asyncio.ensure_future(self._send_loop())
             elif state == self.State.CLOSED:
-                self.closed.set()
+                self._hb_cancel()
+                self._reconfig_cancel()
+                self._t3_cancel()
+                self._send_event.set()
+                self._set_closed()
+
+    def _set_closed(self):
+        self.closed.set()
+        self.recv_queue.close()
+
+        # stop waiting for packets, but let a packet being processed finish
+        if self._receiving:
+            self._receive_task.cancel()
+
+    def _hb_cancel(self):
+        if self._hb_handle is not None:
+            self._hb_handle.cancel()
+            self._hb_handle = None
+
+    def _hb_expired(self):
+        self._hb_handle = None
+        if self._hb_info is not None:
+            # the previous heartbeat went unanswered
+            self.rto = min(self.rto * 2, SCTP_RTO_MAX)
+            if self._increment_error_count():
+                return
+        asyncio.ensure_future(self._send_heartbeat())
+        self._hb_restart()
+
+    def _hb_restart(self):
+        """
+        Send a heartbeat once the association has been idle for
+        `SCTP_HB_INTERVAL` plus the RTO.
+        """
+        self._hb_cancel()
+        self._hb_handle = asyncio.get_event_loop().call_later(
+            self.rto + SCTP_HB_INTERVAL, self._hb_expired)
+
+    def _increment_error_count(self):
+        """
+        Count a retransmission timeout or an unanswered heartbeat, and close
+        the association if the peer looks unreachable.
+
+        Returns True if the association was closed.
+        """
+        self.error_count += 1
+        if self.error_count > SCTP_MAX_ASSOCIATION_RETRANS:
+            logger.warning('%s x Remote party is unreachable, closing association' % self.role)
+            self._set_state(self.State.CLOSED)
+            return True
+        return False
+
+    def _reconfig_cancel(self):
+        if self._reconfig_handle is not None:
+            self._reconfig_handle.cancel()
+            self._reconfig_handle = None
+
+    def _reconfig_expired(self):
+        self._reconfig_handle = None
+        self.reconfig_needed = True
+        self._send_event.set()
+
+    def _reconfig_start(self):
+        self._reconfig_cancel()
+        self._reconfig_handle = asyncio.get_event_loop().call_later(
+            self.rto, self._reconfig_expired)
+
+    def _t3_cancel(self):
+        if self._t3_handle is not None:
+            self._t3_handle.cancel()
+            self._t3_handle = None
+
+    def _t3_expired(self):
+        self._t3_handle = None
+        self.rto = min(self.rto * 2, SCTP_RTO_MAX)
+        self._rtt_chunk = None
+        if self._increment_error_count():
+            return
+
+        # mark outstanding chunks for retransmission
+        for chunk in self.sent_queue:
+            if not chunk._acked and not self._maybe_abandon(chunk):
+                chunk._retransmit = True
+                self._flight_size_decrease(chunk)
+
+        # adjust congestion window (RFC 4960 section 7.2.3)
+        self.fast_recovery_exit = None
+        self.ssthresh = max(self.cwnd // 2, 4 * SCTP_MTU)
+        self.cwnd = SCTP_MTU
+        self.partial_bytes_acked = 0
+
+        self._update_advanced_peer_ack_point()
+        self._send_event.set()
+
+    def _t3_restart(self):
+        self._t3_cancel()
+        self._t3_start()
+
+    def _t3_start(self):
+        if self._t3_handle is None:
+            self._t3_handle = asyncio.get_event_loop().call_later(self.rto, self._t3_expired)
+
+    def _update_rto(self, rtt):
+        """
+        Update the RTO using a round-trip time measurement (RFC 4960 section 6.3.1).
+        """
+        if self.srtt is None:
+            self.rttvar = rtt / 2
+            self.srtt = rtt
+        else:
+            self.rttvar = (1 - SCTP_RTO_BETA) * self.rttvar + SCTP_RTO_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - SCTP_RTO_ALPHA) * self.srtt + SCTP_RTO_ALPHA * rtt
+        self.rto = max(SCTP_RTO_MIN, min(self.srtt + 4 * self.rttvar, SCTP_RTO_MAX))
 
     class State(enum.Enum):
         CLOSED = 1
@@ -24,6 +24,15 @@ def ipaddress_to_sdp(addr):
     return 'IN IP%d %s' % (version, addr)
 
 
+class GroupDescription:
+    def __init__(self, semantic, items):
+        self.semantic = semantic
+        self.items = items
+
+    def __str__(self):
+        return '%s %s' % (self.semantic, ' '.join(self.items))
+
+
 class MediaDescription:
     def __init__(self, kind, port, profile, fmt):
         # rtp
@@ -32,6 +41,8 @@ class MediaDescription:
         self.host = None
         self.profile = profile
         self.direction = None
+        self.mid = None
+        self.ssrc = []
 
         # rtcp
         self.rtcp_port = None
@@ -43,6 +54,9 @@ class MediaDescription:
         self.rtpmap = {}
         self.sctpmap = {}
 
+        # SCTP
+        self.max_message_size = None
+
         # DTLS
         self.dtls_fingerprint = None
         self.dtls_setup = None
@@ -63,12 +77,17 @@ class MediaDescription:
         lines.append('c=%s' % ipaddress_to_sdp(self.host))
         if self.direction is not None:
             lines.append('a=' + self.direction)
+        if self.mid is not None:
+            lines.append('a=mid:' + self.mid)
 
         if self.rtcp_port is not None and self.rtcp_host is not None:
             lines.append('a=rtcp:%d %s' % (self.rtcp_port, ipaddress_to_sdp(self.rtcp_host)))
         if self.rtcp_mux:
             lines.append('a=rtcp-mux')
 
+        if self.max_message_size is not None:
+            lines.append('a=max-message-size:%d' % self.max_message_size)
+
         # ice
         for candidate in self.ice_candidates:
             lines.append('a=candidate:' + candidate.to_sdp())
@@ -88,8 +107,19 @@ class MediaDescription:
 
 class SessionDescription:
     def __init__(self):
+        self.group = []
         self.media = []
 
+    @property
+    def bundle(self):
+        """
+        The media identifiers of the BUNDLE group, if any.
+        """
+        for group in self.group:
+            if group.semantic == 'BUNDLE':
+                return group.items
+        return []
+
     @classmethod
     def parse(cls, sdp):
         current_media = None
@@ -134,6 +164,10 @@ class SessionDescription:
                         current_media.ice_ufrag = value
                     elif attr == 'ice-pwd':
                         current_media.ice_pwd = value
+                    elif attr == 'max-message-size':
+                        current_media.max_message_size = int(value)
+                    elif attr == 'mid':
+                        current_media.mid = value
                     elif attr == 'rtcp':
                         port, rest = value.split(' ', 1)
                         current_media.rtcp_port = int(port)
@@ -142,6 +176,10 @@ class SessionDescription:
                         current_media.rtcp_mux = True
                     elif attr == 'setup':
                         current_media.dtls_setup = value
+                    elif attr == 'ssrc':
+                        ssrc = int(value.split(' ', 1)[0])
+                        if ssrc not in current_media.ssrc:
+                            current_media.ssrc.append(ssrc)
                     elif attr in DIRECTIONS:
                         current_media.direction = attr
                     elif attr in ['rtpmap', 'sctpmap']:
@@ -153,5 +191,8 @@ class SessionDescription:
                         algo, fingerprint = value.split()
                         assert algo == 'sha-256'
                         dtls_fingerprint = fingerprint
+                    elif attr == 'group':
+                        bits = value.split()
+                        session.group.append(GroupDescription(semantic=bits[0], items=bits[1:]))
 
         return session
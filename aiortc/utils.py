@@ -1,5 +1,6 @@
 import asyncio
 import os
+from collections import deque
 from struct import unpack
 
 
@@ -18,3 +19,75 @@ async def first_completed(*coros):
     for task in pending:
         task.cancel()
     return done.pop().result()
+
+
+class ClosableQueue:
+    """
+    An unbounded FIFO queue which can be closed.
+
+    Once the queue is closed and the items it holds have been consumed,
+    :meth:`get` raises :class:`ConnectionError`, including in coroutines
+    which were already waiting. This avoids racing every `get()` against
+    an event with :func:`first_completed`, which creates two tasks.
+    """
+    def __init__(self):
+        self._closed = False
+        self._items = deque()
+        self._waiters = deque()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def empty(self):
+        return not self._items
+
+    def qsize(self):
+        return len(self._items)
+
+    async def get(self):
+        while not self._items:
+            if self._closed:
+                raise ConnectionError
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # pass on the wakeup we may have received
+                if waiter.done() and not waiter.cancelled():
+                    self._wakeup_next()
+                raise
+        return self._items.popleft()
+
+    def get_nowait(self):
+        if self._items:
+            return self._items.popleft()
+        elif self._closed:
+            raise ConnectionError
+        raise asyncio.QueueEmpty
+
+    async def put(self, item):
+        self.put_nowait(item)
+
+    def put_nowait(self, item):
+        """
+        Add an item to the queue, items put on a closed queue are dropped.
+        """
+        if not self._closed:
+            self._items.append(item)
+            self._wakeup_next()
+
+    def _wakeup_next(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
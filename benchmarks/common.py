@@ -0,0 +1,109 @@
+"""
+Helpers shared by the benchmarks.
+"""
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from aiortc.utils import ClosableQueue
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# extra delay applied to reordered packets, in seconds
+REORDER_DELAY = 0.005
+
+
+class LossyTransport:
+    """
+    An in-memory datagram transport which can drop, delay and reorder packets.
+    """
+    def __init__(self, rx_queue, tx_queue, rng, loss=0, delay=0, reorder=0):
+        self.closed = asyncio.Event()
+        self.delay = delay
+        self.loss = loss
+        self.reorder = reorder
+        self.rng = rng
+        self.rx_queue = rx_queue
+        self.tx_queue = tx_queue
+
+    async def close(self):
+        self.closed.set()
+        self.rx_queue.close()
+
+    async def recv(self):
+        return await self.rx_queue.get()
+
+    async def send(self, data):
+        if self.closed.is_set():
+            raise ConnectionError
+        if self.loss and self.rng.random() < self.loss:
+            return
+
+        delay = self.delay
+        if self.reorder and self.rng.random() < self.reorder:
+            delay += REORDER_DELAY
+        if delay:
+            asyncio.get_event_loop().call_later(delay, self.tx_queue.put_nowait, data)
+        else:
+            self.tx_queue.put_nowait(data)
+
+
+def add_network_arguments(parser):
+    parser.add_argument('--loss', type=float, default=0,
+                        help='fraction of packets which are dropped')
+    parser.add_argument('--delay', type=float, default=0,
+                        help='one-way delay in milliseconds')
+    parser.add_argument('--reorder', type=float, default=0,
+                        help='fraction of packets which are reordered')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the loss and reordering decisions')
+    parser.add_argument('--output', help='write the JSON results to this file')
+
+
+def transport_pair(loss=0, delay=0, reorder=0, seed=0):
+    """
+    Return two connected :class:`LossyTransport`, `delay` is in milliseconds.
+    """
+    queue_a = ClosableQueue()
+    queue_b = ClosableQueue()
+    rng = random.Random(seed)
+    kwargs = dict(rng=rng, loss=loss, delay=delay / 1000, reorder=reorder)
+    return (
+        LossyTransport(rx_queue=queue_a, tx_queue=queue_b, **kwargs),
+        LossyTransport(rx_queue=queue_b, tx_queue=queue_a, **kwargs),
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(name, parameters, results, output=None):
+    """
+    Write benchmark results as JSON, along with what is needed to compare
+    them across commits.
+    """
+    document = {
+        'benchmark': name,
+        'commit': git_commit(),
+        'parameters': parameters,
+        'platform': platform.platform(),
+        'python': '%s %s' % (platform.python_implementation(), platform.python_version()),
+        'results': results,
+        'timestamp': int(time.time()),
+    }
+    if output:
+        with open(output, 'w') as fp:
+            json.dump(document, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
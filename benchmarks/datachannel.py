@@ -0,0 +1,115 @@
+"""
+Measure SCTP and data channel throughput over an in-memory transport.
+"""
+import argparse
+import asyncio
+import time
+
+from pyee import EventEmitter
+
+from aiortc import sctp
+from aiortc.rtcdatachannel import DataChannelManager
+from aiortc.utils import first_completed
+from common import add_network_arguments, transport_pair, write_results
+
+DEFAULT_SIZES = [16, 1024, 16384, 65536]
+
+# amount of data sent for each message size
+DEFAULT_VOLUME = 4 * 1024 * 1024
+
+
+async def wait_established(*endpoints):
+    for endpoint in endpoints:
+        await first_completed(endpoint.established.wait(), endpoint.closed.wait())
+        if not endpoint.established.is_set():
+            raise ConnectionError('SCTP association could not be established')
+
+
+async def bench_endpoint(size, count, network):
+    client_transport, server_transport = transport_pair(**network)
+    client = sctp.Endpoint(is_server=False, transport=client_transport)
+    server = sctp.Endpoint(is_server=True, transport=server_transport)
+    asyncio.ensure_future(server.run())
+    asyncio.ensure_future(client.run())
+    await wait_established(client, server)
+
+    message = b'\x00' * size
+    start = time.perf_counter()
+    for i in range(count):
+        client.send_nowait(1, 53, message)
+    for i in range(count):
+        await server.recv()
+    elapsed = time.perf_counter() - start
+
+    await client.abort()
+    await server.abort()
+    return elapsed
+
+
+async def bench_datachannel(size, count, network):
+    client_transport, server_transport = transport_pair(**network)
+    client = DataChannelManager(
+        EventEmitter(), sctp.Endpoint(is_server=False, transport=client_transport))
+    server = DataChannelManager(
+        EventEmitter(), sctp.Endpoint(is_server=True, transport=server_transport))
+    for manager in [client, server]:
+        asyncio.ensure_future(manager.endpoint.run())
+        asyncio.ensure_future(manager.run(manager.endpoint))
+    await wait_established(client.endpoint, server.endpoint)
+
+    client_channel = client.create_channel(label='bench', protocol='', negotiated=True, id=1)
+    server_channel = server.create_channel(label='bench', protocol='', negotiated=True, id=1)
+
+    message = b'\x00' * size
+    start = time.perf_counter()
+    for i in range(count):
+        client_channel.send(message)
+    for i in range(count):
+        await server_channel.recv()
+    elapsed = time.perf_counter() - start
+
+    await client.endpoint.abort()
+    await server.endpoint.abort()
+    return elapsed
+
+
+BENCHMARKS = {
+    'datachannel': bench_datachannel,
+    'endpoint': bench_endpoint,
+}
+
+
+async def main(args):
+    network = dict(loss=args.loss, delay=args.delay, reorder=args.reorder, seed=args.seed)
+    results = []
+    for name in args.layers:
+        for size in args.sizes:
+            count = max(args.min_messages, args.volume // size)
+            elapsed = await BENCHMARKS[name](size, count, network)
+            results.append({
+                'layer': name,
+                'message_size': size,
+                'messages': count,
+                'seconds': elapsed,
+                'messages_per_second': count / elapsed,
+                'megabytes_per_second': count * size / elapsed / 1e6,
+            })
+    return network, results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SCTP / data channel throughput benchmark')
+    parser.add_argument('--layers', nargs='+', choices=sorted(BENCHMARKS.keys()),
+                        default=sorted(BENCHMARKS.keys()), help='layers to benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='message sizes in bytes')
+    parser.add_argument('--volume', type=int, default=DEFAULT_VOLUME,
+                        help='bytes to send for each message size')
+    parser.add_argument('--min-messages', type=int, default=100,
+                        help='minimum number of messages for each message size')
+    add_network_arguments(parser)
+    args = parser.parse_args()
+
+    network, results = asyncio.get_event_loop().run_until_complete(main(args))
+    parameters = dict(network, layers=args.layers, sizes=args.sizes, volume=args.volume)
+    write_results('datachannel', parameters, results, output=args.output)
@@ -0,0 +1,408 @@
+"""
+Measure the cost of hosting peer connections by streaming synthetic media and
+data channel messages between pairs of RTCPeerConnection over localhost.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import struct
+import time
+
+from aiortc import AudioStreamTrack, RTCPeerConnection, VideoStreamTrack
+from aiortc.mediastreams import AudioFrame, VideoFrame
+from common import write_results
+
+AUDIO_PTIME = 0.02
+AUDIO_SAMPLE_RATE = 8000
+
+# the frame number is drawn in the top-left corner of each video frame as
+# MARKER_ROWS x MARKER_COLUMNS squares of BLOCK_SIZE pixels, one per bit,
+# which survives lossy encoding
+BLOCK_SIZE = 16
+MARKER_COLUMNS = 8
+MARKER_ROWS = 2
+MARKER_BITS = MARKER_COLUMNS * MARKER_ROWS
+LUMA_BLACK = 16
+LUMA_WHITE = 235
+
+DATA_HEADER = struct.Struct('!Id')
+
+LAG_INTERVAL = 0.05
+
+
+def resolution(value):
+    try:
+        width, height = [int(x) for x in value.split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('Resolution must be WIDTHxHEIGHT')
+    if (width < MARKER_COLUMNS * BLOCK_SIZE or height < MARKER_ROWS * BLOCK_SIZE or
+       width % 2 or height % 2):
+        raise argparse.ArgumentTypeError(
+            'Resolution must be even and at least %dx%d' % (
+                MARKER_COLUMNS * BLOCK_SIZE, MARKER_ROWS * BLOCK_SIZE))
+    return (width, height)
+
+
+def summary(values):
+    """
+    Return the mean and percentiles of `values`, in milliseconds.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+
+    def percentile(p):
+        return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] * 1000
+
+    return {
+        'max': values[-1] * 1000,
+        'mean': sum(values) / len(values) * 1000,
+        'p50': percentile(50),
+        'p95': percentile(95),
+        'p99': percentile(99),
+    }
+
+
+def write_marker(data, width, number):
+    for bit in range(MARKER_BITS):
+        value = LUMA_WHITE if (number >> bit) & 1 else LUMA_BLACK
+        left = (bit % MARKER_COLUMNS) * BLOCK_SIZE
+        top = (bit // MARKER_COLUMNS) * BLOCK_SIZE
+        row = bytes([value]) * BLOCK_SIZE
+        for y in range(top, top + BLOCK_SIZE):
+            data[y * width + left:y * width + left + BLOCK_SIZE] = row
+
+
+def read_marker(data, width):
+    number = 0
+    threshold = (LUMA_BLACK + LUMA_WHITE) // 2
+    for bit in range(MARKER_BITS):
+        # sample the centre of the square, away from blurred edges
+        x = (bit % MARKER_COLUMNS) * BLOCK_SIZE + BLOCK_SIZE // 2
+        y = (bit // MARKER_COLUMNS) * BLOCK_SIZE + BLOCK_SIZE // 2
+        if data[y * width + x] > threshold:
+            number |= 1 << bit
+    return number
+
+
+class Stats:
+    """
+    Counters for one pair, frames and messages are only sent while
+    `recording` is set, and counted when they arrive.
+    """
+    def __init__(self):
+        self.recording = False
+        self.audio_received = 0
+        self.audio_sent = 0
+        self.data_latencies = []
+        self.data_received = 0
+        self.data_sent = 0
+        self.video_latencies = []
+        self.video_received = set()
+        self.video_sent = {}
+
+
+class Pacer:
+    """
+    Sleep until the next frame is due, without accumulating drift.
+    """
+    def __init__(self, interval):
+        self.count = 0
+        self.interval = interval
+        self.start = None
+
+    async def wait(self):
+        loop = asyncio.get_event_loop()
+        if self.start is None:
+            self.start = loop.time()
+        self.count += 1
+        await asyncio.sleep(max(0, self.start + self.count * self.interval - loop.time()))
+
+
+class SyntheticAudioTrack(AudioStreamTrack):
+    def __init__(self, stats):
+        self.pacer = Pacer(AUDIO_PTIME)
+        self.silence = b'\x00' * (int(AUDIO_SAMPLE_RATE * AUDIO_PTIME) * 2)
+        self.stats = stats
+
+    async def recv(self):
+        await self.pacer.wait()
+        if self.stats.recording:
+            self.stats.audio_sent += 1
+        return AudioFrame(channels=1, data=self.silence, sample_rate=AUDIO_SAMPLE_RATE)
+
+
+class SyntheticVideoTrack(VideoStreamTrack):
+    def __init__(self, width, height, framerate, stats):
+        self.blank = bytes([LUMA_BLACK]) * (width * height) + b'\x80' * (width * height // 2)
+        self.height = height
+        self.number = 0
+        self.pacer = Pacer(1 / framerate)
+        self.stats = stats
+        self.width = width
+
+    async def recv(self):
+        await self.pacer.wait()
+        number = self.number
+        self.number = (self.number + 1) % (1 << MARKER_BITS)
+
+        data = bytearray(self.blank)
+        write_marker(data, self.width, number)
+        if self.stats.recording:
+            self.stats.video_sent[number] = time.perf_counter()
+        return VideoFrame(width=self.width, height=self.height, data=bytes(data))
+
+
+async def consume_audio(track, stats):
+    while True:
+        await track.recv()
+        if stats.recording:
+            stats.audio_received += 1
+
+
+async def consume_video(track, stats):
+    while True:
+        frame = await track.recv()
+        number = read_marker(frame.data, frame.width)
+        sent = stats.video_sent.get(number)
+        if sent is not None and number not in stats.video_received:
+            stats.video_received.add(number)
+            stats.video_latencies.append(time.perf_counter() - sent)
+
+
+async def send_data(channel, stats, interval, size):
+    padding = b'\x00' * max(0, size - DATA_HEADER.size)
+    number = 0
+    while True:
+        await asyncio.sleep(interval)
+        if channel.readyState != 'open':
+            continue
+        if stats.recording:
+            channel.send(DATA_HEADER.pack(number, time.perf_counter()) + padding)
+            stats.data_sent += 1
+            number += 1
+
+
+async def monitor_loop_lag(lags, recording):
+    loop = asyncio.get_event_loop()
+    while True:
+        expected = loop.time() + LAG_INTERVAL
+        await asyncio.sleep(LAG_INTERVAL)
+        if recording():
+            lags.append(loop.time() - expected)
+
+
+async def wait_connected(pc, timeout):
+    connected = asyncio.Event()
+
+    @pc.on('iceconnectionstatechange')
+    def on_iceconnectionstatechange():
+        if pc.iceConnectionState == 'completed':
+            connected.set()
+
+    await asyncio.wait_for(connected.wait(), timeout=timeout)
+
+
+async def create_pair(args):
+    """
+    Connect two peer connections, the first one streams media and data to
+    the second one.
+    """
+    stats = Stats()
+    tasks = []
+    pc1 = RTCPeerConnection()
+    pc2 = RTCPeerConnection()
+
+    @pc2.on('datachannel')
+    def on_datachannel(channel):
+        @channel.on('message')
+        def on_message(message):
+            sent = DATA_HEADER.unpack_from(message)[1]
+            stats.data_latencies.append(time.perf_counter() - sent)
+            stats.data_received += 1
+
+    @pc2.on('track')
+    def on_track(track):
+        if track.kind == 'audio':
+            tasks.append(asyncio.ensure_future(consume_audio(track, stats)))
+        elif track.kind == 'video':
+            tasks.append(asyncio.ensure_future(consume_video(track, stats)))
+
+    if args.audio:
+        pc1.addTrack(SyntheticAudioTrack(stats))
+    if args.video:
+        width, height = args.resolution
+        pc1.addTrack(SyntheticVideoTrack(width, height, args.framerate, stats))
+    if args.data_interval:
+        channel = pc1.createDataChannel('bench')
+        tasks.append(asyncio.ensure_future(
+            send_data(channel, stats, args.data_interval / 1000, args.data_size)))
+
+    connected = asyncio.ensure_future(wait_connected(pc1, args.timeout))
+    await pc1.setLocalDescription(await pc1.createOffer())
+    await pc2.setRemoteDescription(pc1.localDescription)
+    await pc2.setLocalDescription(await pc2.createAnswer())
+    await pc1.setRemoteDescription(pc2.localDescription)
+    await connected
+
+    return pc1, pc2, stats, tasks
+
+
+async def run_pairs(count, args, barrier=None):
+    loop = asyncio.get_event_loop()
+    lags = []
+    pairs = await asyncio.gather(*[create_pair(args) for i in range(count)])
+    all_stats = [pair[2] for pair in pairs]
+    monitor = asyncio.ensure_future(monitor_loop_lag(lags, lambda: all_stats[0].recording))
+
+    # start measuring in all processes at once
+    if barrier is not None:
+        await loop.run_in_executor(None, barrier.wait)
+    await asyncio.sleep(args.warmup)
+
+    cpu_start = time.process_time()
+    for stats in all_stats:
+        stats.recording = True
+    await asyncio.sleep(args.duration)
+    for stats in all_stats:
+        stats.recording = False
+    cpu_seconds = time.process_time() - cpu_start
+
+    # let the frames and messages in flight arrive
+    await asyncio.sleep(args.drain)
+
+    monitor.cancel()
+    for pc1, pc2, stats, tasks in pairs:
+        for task in tasks:
+            task.cancel()
+        await pc1.close()
+        await pc2.close()
+
+    return {
+        'audio_received': sum(s.audio_received for s in all_stats),
+        'audio_sent': sum(s.audio_sent for s in all_stats),
+        'cpu_seconds': cpu_seconds,
+        'data_latencies': sum([s.data_latencies for s in all_stats], []),
+        'data_received': sum(s.data_received for s in all_stats),
+        'data_sent': sum(s.data_sent for s in all_stats),
+        'loop_lags': lags,
+        'pairs': count,
+        'video_latencies': sum([s.video_latencies for s in all_stats], []),
+        'video_received': sum(len(s.video_received) for s in all_stats),
+        'video_sent': sum(len(s.video_sent) for s in all_stats),
+    }
+
+
+def run_worker(count, args, barrier, results):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results.put(loop.run_until_complete(run_pairs(count, args, barrier)))
+
+
+def run(args):
+    counts = [args.pairs // args.processes] * args.processes
+    for i in range(args.pairs % args.processes):
+        counts[i] += 1
+    counts = [count for count in counts if count]
+
+    if len(counts) == 1:
+        return [asyncio.get_event_loop().run_until_complete(run_pairs(counts[0], args))]
+
+    barrier = multiprocessing.Barrier(len(counts))
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=run_worker, args=(count, args, barrier, results))
+        for count in counts
+    ]
+    for worker in workers:
+        worker.start()
+    worker_results = [results.get() for worker in workers]
+    for worker in workers:
+        worker.join()
+    return worker_results
+
+
+def loss(sent, received):
+    return (sent - received) / sent if sent else None
+
+
+def aggregate(args, worker_results):
+    def total(key):
+        return sum(result[key] for result in worker_results)
+
+    def combined(key):
+        return sum([result[key] for result in worker_results], [])
+
+    return {
+        'audio': {
+            'frames_received': total('audio_received'),
+            'frames_sent': total('audio_sent'),
+            'loss': loss(total('audio_sent'), total('audio_received')),
+        },
+        'cpu_percent_per_pair': 100 * total('cpu_seconds') / args.duration / args.pairs,
+        'data': {
+            'latency_ms': summary(combined('data_latencies')),
+            'loss': loss(total('data_sent'), total('data_received')),
+            'messages_received': total('data_received'),
+            'messages_sent': total('data_sent'),
+        },
+        'loop_lag_ms': summary(combined('loop_lags')),
+        'video': {
+            'frames_received': total('video_received'),
+            'frames_sent': total('video_sent'),
+            'latency_ms': summary(combined('video_latencies')),
+            'loss': loss(total('video_sent'), total('video_received')),
+        },
+        'workers': [{
+            'cpu_percent': 100 * result['cpu_seconds'] / args.duration,
+            'loop_lag_ms': summary(result['loop_lags']),
+            'pairs': result['pairs'],
+        } for result in worker_results],
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peer connection loopback benchmark')
+    parser.add_argument('--pairs', type=int, default=1,
+                        help='number of peer connection pairs')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of processes to spread the pairs over')
+    parser.add_argument('--no-audio', dest='audio', action='store_false',
+                        help='do not send audio')
+    parser.add_argument('--no-video', dest='video', action='store_false',
+                        help='do not send video')
+    parser.add_argument('--resolution', type=resolution, default=(320, 240),
+                        help='video resolution, as WIDTHxHEIGHT')
+    parser.add_argument('--framerate', type=float, default=30,
+                        help='video frames per second')
+    parser.add_argument('--data-interval', type=float, default=20,
+                        help='milliseconds between data channel messages, 0 to disable')
+    parser.add_argument('--data-size', type=int, default=1024,
+                        help='size of data channel messages in bytes')
+    parser.add_argument('--duration', type=float, default=10,
+                        help='seconds during which statistics are recorded')
+    parser.add_argument('--warmup', type=float, default=2,
+                        help='seconds to stream before recording statistics')
+    parser.add_argument('--drain', type=float, default=1,
+                        help='seconds to wait for frames in flight after recording')
+    parser.add_argument('--timeout', type=float, default=30,
+                        help='seconds to wait for each pair to connect')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+    if args.pairs < 1 or args.processes < 1:
+        parser.error('--pairs and --processes must be at least 1')
+
+    results = aggregate(args, run(args))
+    parameters = {
+        'audio': args.audio,
+        'data_interval': args.data_interval,
+        'data_size': args.data_size,
+        'duration': args.duration,
+        'framerate': args.framerate,
+        'pairs': args.pairs,
+        'processes': args.processes,
+        'resolution': '%dx%d' % args.resolution,
+        'video': args.video,
+        'warmup': args.warmup,
+    }
+    write_results('loopback', parameters, results, output=args.output)
@@ -0,0 +1,188 @@
+"""
+Measure the per-packet cost of the RTP / RTCP hot paths.
+"""
+import argparse
+import random
+import time
+import tracemalloc
+from struct import pack
+
+from aiortc.codecs.g711 import PcmuDecoder, PcmuEncoder
+from aiortc.codecs.opus import OpusDecoder, OpusEncoder
+from aiortc.codecs.vpx import VpxPayloadDescriptor
+from aiortc.jitterbuffer import JitterBuffer
+from aiortc.mediastreams import AudioFrame
+from aiortc.rtp import RtcpPacket, RtpPacket, is_rtcp
+from common import write_results
+
+AUDIO_PT = 0
+AUDIO_SSRC = 0x11111111
+VIDEO_PT = 100
+VIDEO_SSRC = 0x22222222
+
+# one VP8 frame every 33 ms, keyframes are larger
+VIDEO_FRAME_SIZE = 4000
+VIDEO_KEYFRAME_SIZE = 30000
+VIDEO_PACKET_SIZE = 1200
+
+
+def rtcp_report(ssrc, sender):
+    """
+    Build an RTCP sender or receiver report with one report block.
+    """
+    block = pack('!LLLLLL', AUDIO_SSRC, 0, 0, 0, 0, 0)
+    if sender:
+        return pack('!BBHL', 0x81, 200, 12, ssrc) + pack('!QLLL', 0, 0, 0, 0) + block
+    else:
+        return pack('!BBHL', 0x81, 201, 7, ssrc) + block
+
+
+def synthetic_capture(seconds, loss, reorder, seed):
+    """
+    Build a capture of PCMU audio, VP8 video and RTCP reports, with packets
+    dropped and swapped with their successor using a seeded generator.
+    """
+    rng = random.Random(seed)
+    events = []
+
+    # audio, one packet every 20 ms
+    for i in range(seconds * 50):
+        packet = RtpPacket(payload_type=AUDIO_PT, sequence_number=i & 0xffff,
+                           timestamp=i * 160, ssrc=AUDIO_SSRC)
+        packet.payload = bytes(rng.getrandbits(8) for x in range(160))
+        events.append((i * 0.02, bytes(packet)))
+
+    # video, one frame every 33 ms
+    sequence_number = 0
+    for i in range(seconds * 30):
+        size = VIDEO_KEYFRAME_SIZE if i % 90 == 0 else VIDEO_FRAME_SIZE
+        for pos in range(0, size, VIDEO_PACKET_SIZE):
+            descriptor = VpxPayloadDescriptor(
+                partition_start=int(pos == 0), partition_id=0, picture_id=i & 0x7fff)
+            packet = RtpPacket(payload_type=VIDEO_PT, sequence_number=sequence_number & 0xffff,
+                               timestamp=i * 3000, ssrc=VIDEO_SSRC,
+                               marker=int(pos + VIDEO_PACKET_SIZE >= size))
+            packet.payload = bytes(descriptor) + b'\x00' * min(VIDEO_PACKET_SIZE, size - pos)
+            events.append((i / 30, bytes(packet)))
+            sequence_number += 1
+
+    # RTCP, one report per second and per stream
+    for i in range(seconds):
+        events.append((i, rtcp_report(AUDIO_SSRC, sender=True)))
+        events.append((i + 0.5, rtcp_report(VIDEO_SSRC, sender=False)))
+
+    capture = [data for when, data in sorted(events, key=lambda x: x[0])]
+    capture = [data for data in capture if rng.random() >= loss]
+    for i in range(len(capture) - 1):
+        if rng.random() < reorder:
+            capture[i], capture[i + 1] = capture[i + 1], capture[i]
+    return capture
+
+
+def measure(setup, items, repeat):
+    """
+    Return the best time per item in nanoseconds, and the number and size of
+    the memory blocks allocated per item for the results.
+    """
+    best = None
+    for r in range(repeat):
+        func = setup()
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    # keep the results alive so their allocations are counted
+    func = setup()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    results = [func(item) for item in items]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    stats = after.compare_to(before, 'filename')
+    del results
+
+    return {
+        'allocations_per_packet': sum(x.count_diff for x in stats) / len(items),
+        'allocated_bytes_per_packet': sum(x.size_diff for x in stats) / len(items),
+        'ns_per_packet': best * 1e9 / len(items),
+        'packets': len(items),
+    }
+
+
+def jitter_buffer_setup():
+    jbuffer = JitterBuffer(capacity=32)
+
+    def process(packet):
+        jbuffer.add(packet.payload, packet.sequence_number, packet.timestamp)
+
+        # release the head frame, or skip it if it looks lost
+        if jbuffer.peek(0) is not None or jbuffer.peek(8) is not None:
+            return jbuffer.remove(1)
+
+    return process
+
+
+def run_benchmarks(names, capture, repeat):
+    rtp = [data for data in capture if not is_rtcp(data)]
+    rtcp = [data for data in capture if is_rtcp(data)]
+    packets = [RtpPacket.parse(data) for data in rtp]
+    audio = [p for p in packets if p.payload_type == AUDIO_PT]
+    video = [p for p in packets if p.payload_type == VIDEO_PT]
+    pcm = AudioFrame(channels=1, data=b'\x00\x00' * 160, sample_rate=8000)
+    opus_pcm = AudioFrame(channels=2, data=b'\x00\x00' * 1920, sample_rate=48000)
+
+    # benchmark name -> (function factory, input factory)
+    benchmarks = {
+        'rtp_parse': (lambda: RtpPacket.parse, lambda: rtp),
+        'rtp_serialize': (lambda: bytes, lambda: packets),
+        'rtcp_parse': (lambda: RtcpPacket.parse, lambda: rtcp),
+        'jitterbuffer': (jitter_buffer_setup, lambda: audio),
+        'vpx_descriptor_parse': (lambda: VpxPayloadDescriptor.parse,
+                                 lambda: [p.payload for p in video]),
+        'pcmu_decode': (lambda: PcmuDecoder().decode, lambda: [p.payload for p in audio]),
+        'pcmu_encode': (lambda: PcmuEncoder().encode, lambda: [pcm] * len(audio)),
+        'opus_decode': (lambda: OpusDecoder().decode,
+                        lambda: [OpusEncoder().encode(opus_pcm)] * len(audio)),
+        'opus_encode': (lambda: OpusEncoder().encode, lambda: [opus_pcm] * len(audio)),
+    }
+
+    results = []
+    for name in names:
+        setup, items = benchmarks[name]
+        result = measure(setup, items(), repeat)
+        result['name'] = name
+        results.append(result)
+    return results
+
+
+BENCHMARKS = [
+    'rtp_parse', 'rtp_serialize', 'rtcp_parse', 'jitterbuffer', 'vpx_descriptor_parse',
+    'pcmu_decode', 'pcmu_encode', 'opus_decode', 'opus_encode',
+]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RTP / RTCP microbenchmarks')
+    parser.add_argument('--benchmarks', nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                        help='benchmarks to run')
+    parser.add_argument('--seconds', type=int, default=20,
+                        help='duration of the synthetic capture')
+    parser.add_argument('--loss', type=float, default=0.01,
+                        help='fraction of packets dropped from the capture')
+    parser.add_argument('--reorder', type=float, default=0.01,
+                        help='fraction of packets swapped with their successor')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed for the capture generator')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of timed runs, the best one is kept')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    capture = synthetic_capture(args.seconds, args.loss, args.reorder, args.seed)
+    results = run_benchmarks(args.benchmarks, capture, args.repeat)
+    parameters = dict(seconds=args.seconds, loss=args.loss, reorder=args.reorder,
+                      seed=args.seed, repeat=args.repeat)
+    write_results('rtp', parameters, results, output=args.output)
@@ -1,16 +1,86 @@
 import asyncio
+import datetime
 import logging
-from unittest import TestCase
+from unittest import TestCase, skipUnless
 from unittest.mock import patch
 
-from aiortc.dtls import DtlsError, DtlsSrtpContext, DtlsSrtpSession
-from aiortc.utils import first_completed
+from pylibsrtp import Error
+
+from aiortc.dtls import (SRTP_PROFILES, CertificatePool, DtlsError,
+                         DtlsSrtpContext, DtlsSrtpSession, RTCCertificate,
+                         coalesce_records, ffi, lib)
 
 from .utils import dummy_transport_pair, load, run
 
 RTP = load('rtp.bin')
 RTCP = load('rtcp_sr.bin')
 
+GCM_PROFILES = [x for x in SRTP_PROFILES if x.openssl_profile.startswith(b'SRTP_AEAD_')]
+
+
+class RTCCertificateTest(TestCase):
+    def test_generate(self):
+        certificate = RTCCertificate.generateCertificate()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.assertGreater(certificate.expires, now + datetime.timedelta(days=29))
+        self.assertLess(certificate.expires, now + datetime.timedelta(days=31))
+
+        fingerprints = certificate.getFingerprints()
+        self.assertEqual(len(fingerprints), 1)
+        self.assertEqual(fingerprints[0].algorithm, 'sha-256')
+        self.assertRegex(fingerprints[0].value, '^([0-9A-F]{2}:){31}[0-9A-F]{2}$')
+
+    def test_generate_lifetime(self):
+        certificate = RTCCertificate.generateCertificate(lifetime=datetime.timedelta(hours=1))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.assertLess(certificate.expires, now + datetime.timedelta(hours=2))
+
+    def test_shared_context(self):
+        certificate = RTCCertificate.generateCertificate()
+        context = certificate._get_context()
+        self.assertIs(context.certificate, certificate)
+        self.assertIs(certificate._get_context(), context)
+
+        transport1, transport2 = dummy_transport_pair()
+        session1 = DtlsSrtpSession(context=context, transport=transport1, is_server=True)
+        session2 = DtlsSrtpSession(context=context, transport=transport2, is_server=False)
+        self.assertEqual(session1.local_fingerprint, certificate.getFingerprints()[0].value)
+        self.assertEqual(session2.local_fingerprint, certificate.getFingerprints()[0].value)
+
+
+class CertificatePoolTest(TestCase):
+    def test_reuse(self):
+        pool = CertificatePool()
+        certificate = pool.get()
+        self.assertIs(pool.get(), certificate)
+
+    def test_rotate(self):
+        pool = CertificatePool(
+            lifetime=datetime.timedelta(days=2),
+            renewal=datetime.timedelta(days=1))
+        certificate = pool.get()
+        self.assertIs(pool.get(), certificate)
+
+        # certificate is about to expire
+        pool.renewal = datetime.timedelta(days=3)
+        self.assertIsNot(pool.get(), certificate)
+
+
+class CoalesceRecordsTest(TestCase):
+    def test_coalesce(self):
+        def record(length):
+            return b'\x17\xfe\xfd' + bytes(8) + length.to_bytes(2, 'big') + bytes(length)
+
+        records = [record(100), record(200), record(1100), record(50)]
+        datagrams = coalesce_records(b''.join(records), 1400)
+        self.assertEqual(datagrams, [
+            records[0] + records[1],
+            records[2] + records[3],
+        ])
+
+    def test_empty(self):
+        self.assertEqual(coalesce_records(b'', 1400), [])
+
 
 class DtlsSrtpTest(TestCase):
     @patch('aiortc.dtls.lib.SSL_CTX_use_certificate')
@@ -61,6 +131,129 @@ class DtlsSrtpTest(TestCase):
         with self.assertRaises(ConnectionError):
             run(session1.data.send(b'foo'))
 
+    def test_data_multiple_records(self):
+        transport1, transport2 = dummy_transport_pair()
+
+        context1 = DtlsSrtpContext()
+        session1 = DtlsSrtpSession(
+            context=context1, transport=transport1, is_server=True)
+
+        context2 = DtlsSrtpContext()
+        session2 = DtlsSrtpSession(
+            context=context2, transport=transport2, is_server=False)
+
+        session1.remote_fingerprint = session2.local_fingerprint
+        session2.remote_fingerprint = session1.local_fingerprint
+        run(asyncio.gather(session1.connect(), session2.connect()))
+
+        # queue several records, which fit in a single datagram
+        tx_count = transport1.tx_count
+        messages = [b'ping', b'pong', b'peng']
+        for message in messages:
+            lib.SSL_write(session1.ssl, message, len(message))
+        run(session1._write_ssl())
+        self.assertEqual(transport1.tx_count, tx_count + 1)
+        for message in messages:
+            data = run(session2.data.recv())
+            self.assertEqual(data, message)
+
+        # queue more records than fit in a single datagram
+        tx_count = transport1.tx_count
+        messages = [bytes([i]) * 1000 for i in range(5)]
+        for message in messages:
+            lib.SSL_write(session1.ssl, message, len(message))
+        run(session1._write_ssl())
+        self.assertEqual(transport1.tx_count, tx_count + 5)
+        for message in messages:
+            data = run(session2.data.recv())
+            self.assertEqual(data, message)
+
+        # shutdown
+        run(session1.close())
+        run(asyncio.sleep(0.5))
+        self.assertEqual(session1.state, DtlsSrtpSession.State.CLOSED)
+        self.assertEqual(session2.state, DtlsSrtpSession.State.CLOSED)
+
+    def test_lossy_handshake(self):
+        transport1, transport2 = dummy_transport_pair()
+
+        # lose the first flight in each direction
+        transport1.loss = [0]
+        transport2.loss = [0]
+
+        context1 = DtlsSrtpContext()
+        session1 = DtlsSrtpSession(
+            context=context1, transport=transport1, is_server=True)
+
+        context2 = DtlsSrtpContext()
+        session2 = DtlsSrtpSession(
+            context=context2, transport=transport2, is_server=False)
+
+        session1.remote_fingerprint = session2.local_fingerprint
+        session2.remote_fingerprint = session1.local_fingerprint
+        run(asyncio.gather(session1.connect(), session2.connect()))
+
+        # send encypted data
+        run(session1.data.send(b'ping'))
+        data = run(session2.data.recv())
+        self.assertEqual(data, b'ping')
+
+        # shutdown
+        run(session1.close())
+        run(asyncio.sleep(0.5))
+        self.assertEqual(session1.state, DtlsSrtpSession.State.CLOSED)
+        self.assertEqual(session2.state, DtlsSrtpSession.State.CLOSED)
+
+    def test_resume(self):
+        context1 = DtlsSrtpContext()
+        context2 = DtlsSrtpContext()
+
+        for resumed in [False, True]:
+            transport1, transport2 = dummy_transport_pair()
+            session1 = DtlsSrtpSession(
+                context=context1, transport=transport1, is_server=True)
+            session2 = DtlsSrtpSession(
+                context=context2, transport=transport2, is_server=False)
+
+            session1.remote_fingerprint = session2.local_fingerprint
+            session2.remote_fingerprint = session1.local_fingerprint
+            run(asyncio.gather(session1.connect(), session2.connect()))
+            self.assertEqual(session1.resumed, resumed)
+            self.assertEqual(session2.resumed, resumed)
+            self.assertEqual(list(context2.sessions.keys()), [session1.local_fingerprint])
+
+            # send encypted data
+            run(session1.data.send(b'ping'))
+            data = run(session2.data.recv())
+            self.assertEqual(data, b'ping')
+
+            # shutdown
+            run(session1.close())
+            run(asyncio.sleep(0.5))
+
+    def test_resume_other_party(self):
+        context1 = DtlsSrtpContext()
+        context2 = DtlsSrtpContext()
+        context3 = DtlsSrtpContext()
+
+        # a session is only resumed with the same remote party
+        for server_context in [context1, context3]:
+            transport1, transport2 = dummy_transport_pair()
+            session1 = DtlsSrtpSession(
+                context=server_context, transport=transport1, is_server=True)
+            session2 = DtlsSrtpSession(
+                context=context2, transport=transport2, is_server=False)
+
+            session1.remote_fingerprint = session2.local_fingerprint
+            session2.remote_fingerprint = session1.local_fingerprint
+            run(asyncio.gather(session1.connect(), session2.connect()))
+            self.assertFalse(session1.resumed)
+            self.assertFalse(session2.resumed)
+
+            run(session1.close())
+            run(asyncio.sleep(0.5))
+        self.assertEqual(len(context2.sessions), 2)
+
     def test_rtp(self):
         transport1, transport2 = dummy_transport_pair()
 
@@ -75,6 +268,13 @@ class DtlsSrtpTest(TestCase):
         session1.remote_fingerprint = session2.local_fingerprint
         session2.remote_fingerprint = session1.local_fingerprint
         run(asyncio.gather(session1.connect(), session2.connect()))
+        for session in [session1, session2]:
+            self.assertEqual(ffi.string(lib.SSL_get_version(session.ssl)), b'DTLSv1.2')
+            self.assertEqual(
+                ffi.string(lib.SSL_CIPHER_get_name(lib.SSL_get_current_cipher(session.ssl))),
+                b'ECDHE-ECDSA-AES128-GCM-SHA256')
+        self.assertEqual(session1.srtp_profile, SRTP_PROFILES[0])
+        self.assertEqual(session2.srtp_profile, SRTP_PROFILES[0])
 
         # send RTP
         run(session1.rtp.send(RTP))
@@ -86,6 +286,41 @@ class DtlsSrtpTest(TestCase):
         data = run(session1.rtp.recv())
         self.assertEqual(data, RTCP)
 
+        # send a batch of RTP and RTCP
+        seq = int.from_bytes(RTP[2:4], 'big')
+        packets = [RTP[0:2] + (seq + i).to_bytes(2, 'big') + RTP[4:] for i in range(1, 3)]
+        run(session1.rtp.send_batch(packets + [RTCP]))
+        run(asyncio.sleep(0.1))
+        batch = [run(session2.rtp.recv()) for i in range(3)]
+        self.assertEqual(batch, packets + [RTCP])
+
+        # deliver to a handler, starting with queued packets
+        run(session1.rtp.send(RTP[0:2] + (seq + 3).to_bytes(2, 'big') + RTP[4:]))
+        run(asyncio.sleep(0.1))
+        received = []
+        session2.rtp.set_handler(received.append)
+        self.assertEqual(len(received), 1)
+        run(session1.rtp.send(RTCP))
+        run(asyncio.sleep(0.1))
+        self.assertEqual(received[1], RTCP)
+
+        # an error in the handler does not tear down the session
+        def bogus_handler(data):
+            raise ValueError('bogus')
+
+        session2.rtp.set_handler(bogus_handler)
+        run(session1.rtp.send(RTP[0:2] + (seq + 4).to_bytes(2, 'big') + RTP[4:]))
+        run(asyncio.sleep(0.1))
+
+        # nor does a packet which cannot be unprotected
+        session2.rtp.set_handler(received.append)
+        run(transport1.send(RTP[0:2] + (seq + 5).to_bytes(2, 'big') + RTP[4:]))
+        run(session1.rtp.send(RTCP))
+        run(asyncio.sleep(0.1))
+        self.assertEqual(len(received), 3)
+        self.assertEqual(received[2], RTCP)
+        self.assertEqual(session2.state, DtlsSrtpSession.State.CONNECTED)
+
         # shutdown
         run(session1.close())
         run(asyncio.sleep(0.5))
@@ -103,6 +338,80 @@ class DtlsSrtpTest(TestCase):
         # try sending after close
         with self.assertRaises(ConnectionError):
             run(session1.rtp.send(RTP))
+        with self.assertRaises(ConnectionError):
+            run(session1.rtp.send_batch([RTP]))
+
+    def test_rtp_profiles(self):
+        for srtp_profile in SRTP_PROFILES:
+            transport1, transport2 = dummy_transport_pair()
+
+            context1 = DtlsSrtpContext()
+            session1 = DtlsSrtpSession(
+                context=context1, transport=transport1, is_server=True)
+
+            with patch('aiortc.dtls.SRTP_PROFILES', [srtp_profile]):
+                context2 = DtlsSrtpContext()
+            session2 = DtlsSrtpSession(
+                context=context2, transport=transport2, is_server=False)
+
+            session1.remote_fingerprint = session2.local_fingerprint
+            session2.remote_fingerprint = session1.local_fingerprint
+            run(asyncio.gather(session1.connect(), session2.connect()))
+            self.assertEqual(session1.srtp_profile, srtp_profile)
+            self.assertEqual(session2.srtp_profile, srtp_profile)
+
+            # send RTP
+            run(session1.rtp.send(RTP))
+            data = run(session2.rtp.recv())
+            self.assertEqual(data, RTP)
+
+            # send RTCP
+            run(session2.rtp.send(RTCP))
+            data = run(session1.rtp.recv())
+            self.assertEqual(data, RTCP)
+
+            # shutdown
+            run(session1.close())
+            run(asyncio.sleep(0.5))
+
+    @skipUnless(GCM_PROFILES, 'libsrtp was built without GCM support')
+    def test_rtp_gcm(self):
+        transport1, transport2 = dummy_transport_pair()
+
+        context1 = DtlsSrtpContext()
+        session1 = DtlsSrtpSession(
+            context=context1, transport=transport1, is_server=True)
+
+        context2 = DtlsSrtpContext()
+        session2 = DtlsSrtpSession(
+            context=context2, transport=transport2, is_server=False)
+
+        session1.remote_fingerprint = session2.local_fingerprint
+        session2.remote_fingerprint = session1.local_fingerprint
+        run(asyncio.gather(session1.connect(), session2.connect()))
+        self.assertEqual(session1.srtp_profile.openssl_profile, b'SRTP_AEAD_AES_128_GCM')
+        self.assertEqual(session2.srtp_profile.openssl_profile, b'SRTP_AEAD_AES_128_GCM')
+
+        # send RTP
+        run(session1.rtp.send(RTP))
+        data = run(session2.rtp.recv())
+        self.assertEqual(data, RTP)
+
+        # send RTCP
+        run(session2.rtp.send(RTCP))
+        data = run(session1.rtp.recv())
+        self.assertEqual(data, RTCP)
+
+        # shutdown
+        run(session1.close())
+        run(asyncio.sleep(0.5))
+
+    def test_rtp_profiles_unsupported(self):
+        # profiles libsrtp cannot instantiate are not offered
+        with patch('aiortc.dtls.Session', side_effect=Error('unsupported parameter')):
+            self.assertEqual([x.is_supported() for x in SRTP_PROFILES],
+                             [False] * len(SRTP_PROFILES))
+        self.assertTrue(SRTP_PROFILES[-1].is_supported())
 
     def test_abrupt_disconnect(self):
         transport1, transport2 = dummy_transport_pair()
@@ -120,19 +429,15 @@ class DtlsSrtpTest(TestCase):
         run(asyncio.gather(session1.connect(), session2.connect()))
 
         # break one connection
-        run(first_completed(
-            session1.data.recv(),
-            transport1.close(),
-        ))
-        run(asyncio.sleep(0))
+        run(transport1.close())
+        with self.assertRaises(ConnectionError):
+            run(session1.data.recv())
         self.assertEqual(session1.state, DtlsSrtpSession.State.CLOSED)
 
         # break other connection
-        run(first_completed(
-            session2.data.recv(),
-            transport2.close(),
-        ))
-        run(asyncio.sleep(0))
+        run(transport2.close())
+        with self.assertRaises(ConnectionError):
+            run(session2.data.recv())
         self.assertEqual(session2.state, DtlsSrtpSession.State.CLOSED)
 
         # try closing again
@@ -184,5 +489,26 @@ class DtlsSrtpTest(TestCase):
         run(session1.close())
         run(session2.close())
 
+    @patch('aiortc.dtls.lib.DTLSv1_handle_timeout')
+    def test_handshake_timeout(self, mock_handle_timeout):
+        mock_handle_timeout.return_value = -1
+
+        transport1, transport2 = dummy_transport_pair()
+
+        # lose everything the client sends
+        transport2.loss = range(10)
+
+        context = DtlsSrtpContext()
+        session = DtlsSrtpSession(
+            context=context, transport=transport2, is_server=False)
+        session.remote_fingerprint = 'bogus_fingerprint'
+
+        with self.assertRaises(DtlsError) as cm:
+            run(session.connect())
+        self.assertEqual(str(cm.exception), 'DTLS handshake timed out')
+        self.assertEqual(mock_handle_timeout.call_count, 1)
+
+        run(session.close())
+
 
 logging.basicConfig(level=logging.DEBUG)
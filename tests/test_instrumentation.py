@@ -0,0 +1,92 @@
+import asyncio
+from unittest import TestCase
+from unittest.mock import patch
+
+from aiortc import instrumentation
+from aiortc.instrumentation import (BUCKET_BOUNDS, NULL_INSTRUMENTATION,
+                                    Histogram, Instrumentation,
+                                    prometheus_text)
+
+from .utils import run
+
+
+class HistogramTest(TestCase):
+    def test_observe(self):
+        histogram = Histogram()
+        histogram.observe(0)
+        histogram.observe(0.000001)
+        histogram.observe(0.0000015)
+        histogram.observe(10)
+
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 10.0000025)
+        self.assertEqual(histogram.buckets[0], 2)
+        self.assertEqual(histogram.buckets[1], 1)
+        self.assertEqual(histogram.buckets[-1], 1)
+        self.assertEqual(sum(histogram.buckets), 4)
+
+    def test_snapshot(self):
+        histogram = Histogram()
+        histogram.observe(0.5)
+
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 1)
+        self.assertEqual(snapshot['sum'], 0.5)
+        self.assertEqual(len(snapshot['buckets']), len(BUCKET_BOUNDS) + 1)
+        self.assertEqual(snapshot['buckets'][-1], (float('inf'), 0))
+
+
+class InstrumentationTest(TestCase):
+    def test_measure(self):
+        instr = Instrumentation(label='foo')
+        with patch('aiortc.instrumentation.clock', side_effect=[1, 1.25]):
+            with instr.measure('decode'):
+                pass
+
+        self.assertEqual(instr.stages['decode'].count, 1)
+        self.assertEqual(instr.stages['decode'].sum, 0.25)
+        self.assertEqual(instr.stages['encode'].count, 0)
+
+        snapshot = instr.snapshot()
+        self.assertEqual(snapshot['label'], 'foo')
+        self.assertEqual(snapshot['stages']['decode']['count'], 1)
+
+    def test_measure_unknown_stage(self):
+        instr = Instrumentation(label='foo')
+        with self.assertRaises(KeyError):
+            instr.measure('bogus')
+
+    def test_null(self):
+        with NULL_INSTRUMENTATION.measure('decode'):
+            pass
+
+    def test_loop_lag(self):
+        instr = Instrumentation(label='foo')
+        with patch.object(instrumentation, 'LOOP_LAG_INTERVAL', 0.01):
+            instr.start()
+            run(asyncio.sleep(0.1))
+            instr.stop()
+        self.assertGreater(instr.loop_lag.count, 0)
+
+        count = instr.loop_lag.count
+        run(asyncio.sleep(0.05))
+        self.assertEqual(instr.loop_lag.count, count)
+
+    def test_prometheus_text(self):
+        instr = Instrumentation(label='foo')
+        instr.stages['parse'].observe(0.000001)
+        instr.stages['parse'].observe(0.5)
+
+        lines = prometheus_text([instr]).splitlines()
+        self.assertEqual(lines[0], '# HELP aiortc_stage_seconds Time spent in each media '
+                                   'pipeline stage.')
+        self.assertEqual(lines[1], '# TYPE aiortc_stage_seconds histogram')
+        self.assertIn(
+            'aiortc_stage_seconds_bucket{connection="foo",stage="parse",le="1e-06"} 1', lines)
+        self.assertIn(
+            'aiortc_stage_seconds_bucket{connection="foo",stage="parse",le="+Inf"} 2', lines)
+        self.assertIn('aiortc_stage_seconds_sum{connection="foo",stage="parse"} 0.500001', lines)
+        self.assertIn('aiortc_stage_seconds_count{connection="foo",stage="parse"} 2', lines)
+        self.assertIn('aiortc_stage_seconds_count{connection="foo",stage="send"} 0', lines)
+        self.assertIn('# TYPE aiortc_loop_lag_seconds histogram', lines)
+        self.assertIn('aiortc_loop_lag_seconds_count{connection="foo"} 0', lines)
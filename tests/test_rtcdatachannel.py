@@ -0,0 +1,383 @@
+import asyncio
+import os
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+
+from pyee import EventEmitter
+
+from aiortc import sctp
+from aiortc.rtcdatachannel import DATA_CHANNEL_ACK, WEBRTC_DCEP, DataChannelManager
+
+from .utils import dummy_transport_pair, run
+
+
+def manager_pair():
+    client_transport, server_transport = dummy_transport_pair()
+    client = sctp.Endpoint(is_server=False, transport=client_transport)
+    server = sctp.Endpoint(is_server=True, transport=server_transport)
+    client_manager = DataChannelManager(EventEmitter(), client)
+    server_manager = DataChannelManager(EventEmitter(), server)
+    return client_manager, server_manager
+
+
+def start(*managers):
+    for manager in managers:
+        asyncio.ensure_future(manager.endpoint.run())
+        asyncio.ensure_future(manager.run(manager.endpoint))
+
+
+def stop(*managers):
+    for manager in managers:
+        run(manager.endpoint.close())
+
+
+class DataChannelManagerTest(TestCase):
+    def test_partial_reliability(self):
+        client_manager, server_manager = manager_pair()
+        server_channels = []
+        server_manager.pc.on('datachannel', server_channels.append)
+
+        # create channels
+        rexmit = client_manager.create_channel(
+            label='rexmit', protocol='', ordered=False, maxRetransmits=0)
+        timed = client_manager.create_channel(
+            label='timed', protocol='', maxPacketLifeTime=500)
+        self.assertFalse(rexmit.ordered)
+        self.assertEqual(rexmit.maxRetransmits, 0)
+        self.assertIsNone(rexmit.maxPacketLifeTime)
+        self.assertTrue(timed.ordered)
+        self.assertIsNone(timed.maxRetransmits)
+        self.assertEqual(timed.maxPacketLifeTime, 500)
+
+        with self.assertRaises(ValueError) as cm:
+            client_manager.create_channel(
+                label='bogus', protocol='', maxPacketLifeTime=500, maxRetransmits=0)
+        self.assertEqual(str(cm.exception),
+                         'Cannot specify both maxPacketLifeTime and maxRetransmits')
+
+        start(client_manager, server_manager)
+        run(asyncio.sleep(0.5))
+
+        # check remote channels
+        self.assertEqual(len(server_channels), 2)
+        self.assertEqual(server_channels[0].label, 'rexmit')
+        self.assertFalse(server_channels[0].ordered)
+        self.assertEqual(server_channels[0].maxRetransmits, 0)
+        self.assertIsNone(server_channels[0].maxPacketLifeTime)
+        self.assertEqual(server_channels[1].label, 'timed')
+        self.assertTrue(server_channels[1].ordered)
+        self.assertIsNone(server_channels[1].maxRetransmits)
+        self.assertEqual(server_channels[1].maxPacketLifeTime, 500)
+
+        stop(client_manager, server_manager)
+
+    def test_buffered_amount(self):
+        client_manager, server_manager = manager_pair()
+        server_messages = []
+
+        @server_manager.pc.on('datachannel')
+        def on_datachannel(channel):
+            channel.on('message', server_messages.append)
+
+        channel = client_manager.create_channel(label='chat', protocol='')
+        channel.bufferedAmountLowThreshold = 1000
+        self.assertEqual(channel.bufferedAmount, 0)
+        self.assertEqual(channel.bufferedAmountLowThreshold, 1000)
+
+        with self.assertRaises(ValueError):
+            channel.bufferedAmountLowThreshold = -1
+
+        low_events = []
+        channel.on('bufferedamountlow', lambda: low_events.append(channel.bufferedAmount))
+
+        # data is buffered until it is acknowledged
+        channel.send(b'\x00' * 2000)
+        channel.send('hello')
+        self.assertEqual(channel.bufferedAmount, 2005)
+
+        start(client_manager, server_manager)
+        run(asyncio.wait_for(channel.drain(), timeout=1))
+        run(asyncio.sleep(0.1))
+        self.assertEqual(channel.bufferedAmount, 0)
+        self.assertEqual(low_events, [805])
+        self.assertEqual(server_messages, [b'\x00' * 2000, 'hello'])
+
+        # drain returns immediately when nothing is buffered
+        run(channel.drain())
+
+        # an oversized message is rejected without being counted
+        with self.assertRaises(ValueError):
+            channel.send(b'\x00' * (client_manager.endpoint.remote_max_message_size + 1))
+        self.assertEqual(channel.bufferedAmount, 0)
+        run(asyncio.wait_for(channel.drain(), timeout=1))
+
+        stop(client_manager, server_manager)
+        self.assertEqual(channel.readyState, 'closed')
+
+    def test_close_reuses_stream_id(self):
+        client_manager, server_manager = manager_pair()
+        server_channels = []
+        server_manager.pc.on('datachannel', server_channels.append)
+
+        channel = client_manager.create_channel(label='file-1', protocol='')
+        self.assertEqual(channel.id, 1)
+
+        start(client_manager, server_manager)
+        run(asyncio.sleep(0.5))
+        self.assertEqual(channel.readyState, 'open')
+        self.assertEqual(len(server_channels), 1)
+
+        # closing resets the stream in both directions
+        close_events = []
+        server_channels[0].on('close', lambda: close_events.append('server'))
+        channel.on('close', lambda: close_events.append('client'))
+        channel.close()
+        self.assertEqual(channel.readyState, 'closing')
+        run(asyncio.sleep(0.5))
+        self.assertEqual(channel.readyState, 'closed')
+        self.assertEqual(server_channels[0].readyState, 'closed')
+        self.assertEqual(sorted(close_events), ['client', 'server'])
+        self.assertEqual(client_manager.channels, {})
+        self.assertEqual(server_manager.channels, {})
+
+        # the stream identifier is reused
+        channel = client_manager.create_channel(label='file-2', protocol='')
+        self.assertEqual(channel.id, 1)
+        run(asyncio.sleep(0.5))
+        self.assertEqual(channel.readyState, 'open')
+        self.assertEqual(len(server_channels), 2)
+        self.assertEqual(server_channels[1].id, 1)
+        self.assertEqual(server_channels[1].label, 'file-2')
+
+        stop(client_manager, server_manager)
+
+    def test_recv(self):
+        client_manager, server_manager = manager_pair()
+        server_channels = []
+        server_manager.pc.on('datachannel', server_channels.append)
+
+        channel = client_manager.create_channel(label='chat', protocol='')
+        channel.send('hello')
+        channel.send(b'\x00\x01')
+        channel.send('')
+
+        start(client_manager, server_manager)
+        run(asyncio.sleep(0.5))
+        self.assertEqual(len(server_channels), 1)
+
+        # messages are queued when there is no "message" handler, small
+        # amounts do not shrink the receive window
+        self.assertEqual(run(server_channels[0].recv()), 'hello')
+        self.assertEqual(server_manager.endpoint.recv_buffered, 0)
+
+        async def receive_all():
+            messages = []
+            async for message in server_channels[0]:
+                messages.append(message)
+            return messages
+
+        task = asyncio.ensure_future(receive_all())
+        channel.close()
+        self.assertEqual(run(task), [b'\x00\x01', ''])
+        self.assertEqual(server_manager.endpoint.recv_buffered, 0)
+
+        # a closed channel has nothing more to receive
+        with self.assertRaises(ConnectionError):
+            run(server_channels[0].recv())
+
+        stop(client_manager, server_manager)
+
+    @patch('aiortc.rtcdatachannel.RECV_BUFFER_SIZE', 5000)
+    @patch('aiortc.sctp.SCTP_RTO_INITIAL', 0.1)
+    def test_recv_backpressure(self):
+        client_manager, server_manager = manager_pair()
+        server_manager.endpoint.advertised_rwnd = 10000
+        server_channels = []
+        server_manager.pc.on('datachannel', server_channels.append)
+
+        channel = client_manager.create_channel(label='bulk', protocol='')
+        start(client_manager, server_manager)
+        run(asyncio.sleep(0.5))
+
+        # the unread messages close the receive window
+        message = b'\x00' * 1000
+        for i in range(30):
+            channel.send(message)
+        run(asyncio.sleep(0.5))
+        self.assertLessEqual(server_manager.endpoint.recv_buffered, 10000)
+        self.assertGreater(channel.bufferedAmount, 0)
+
+        # reading the messages opens it again
+        received = [run(server_channels[0].recv()) for i in range(30)]
+        self.assertEqual(received, [message] * 30)
+        run(asyncio.wait_for(channel.drain(), timeout=1))
+        self.assertEqual(channel.bufferedAmount, 0)
+        self.assertEqual(server_manager.endpoint.recv_buffered, 0)
+
+        stop(client_manager, server_manager)
+
+    def test_recv_slow_channel(self):
+        client_manager, server_manager = manager_pair()
+        server_manager.endpoint.advertised_rwnd = 10000
+        server_channels = []
+        server_manager.pc.on('datachannel', server_channels.append)
+
+        slow = client_manager.create_channel(label='slow', protocol='')
+        fast = client_manager.create_channel(label='fast', protocol='')
+        start(client_manager, server_manager)
+        run(asyncio.sleep(0.5))
+        self.assertEqual(len(server_channels), 2)
+
+        # unread messages on one channel stay within its own buffer
+        message = b'\x00' * 1000
+        for i in range(30):
+            slow.send(message)
+        run(asyncio.sleep(0.5))
+        self.assertEqual(server_manager.endpoint.recv_buffered, 0)
+        self.assertEqual(slow.bufferedAmount, 0)
+
+        # the other channel is not throttled
+        for i in range(30):
+            fast.send(message)
+        received = [run(server_channels[1].recv()) for i in range(30)]
+        self.assertEqual(received, [message] * 30)
+
+        stop(client_manager, server_manager)
+
+    def test_file_transfer(self):
+        client_manager, server_manager = manager_pair()
+        server_channels = []
+        server_manager.pc.on('datachannel', server_channels.append)
+
+        channel = client_manager.create_channel(label='file', protocol='')
+        start(client_manager, server_manager)
+        run(asyncio.sleep(0.5))
+
+        data = os.urandom(3 * 65536 + 1234)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'source')
+            sink = os.path.join(tmpdir, 'sink')
+            with open(source, 'wb') as f:
+                f.write(data)
+
+            task = asyncio.ensure_future(server_channels[0].recv_into_file(sink, len(data)))
+            self.assertEqual(run(channel.send_file(source)), len(data))
+            run(asyncio.wait_for(task, timeout=5))
+            with open(sink, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+        stop(client_manager, server_manager)
+
+    @patch('aiortc.rtcdatachannel.FILE_BUFFER_SIZE', 2 * 65536)
+    def test_file_transfer_low_water_mark(self):
+        client_manager, server_manager = manager_pair()
+        channel = client_manager.create_channel(label='file', protocol='')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            source = os.path.join(tmpdir, 'source')
+            with open(source, 'wb') as f:
+                f.write(os.urandom(4 * 65536))
+
+            # sending pauses once the buffer is full
+            task = asyncio.ensure_future(channel.send_file(source))
+            run(asyncio.sleep(0))
+            self.assertEqual(channel.bufferedAmount, 2 * 65536)
+
+            # and resumes when half of it is acknowledged, not all of it
+            channel._addBufferedAmount(-65536)
+            run(asyncio.sleep(0))
+            self.assertEqual(channel.bufferedAmount, 2 * 65536)
+            self.assertFalse(task.done())
+
+            channel._addBufferedAmount(-65536)
+            self.assertEqual(run(task), 4 * 65536)
+            self.assertEqual(channel.bufferedAmount, 2 * 65536)
+
+    def test_recv_into_file_unordered(self):
+        client_manager, server_manager = manager_pair()
+        for options in [{'ordered': False}, {'maxRetransmits': 0}, {'maxPacketLifeTime': 100}]:
+            channel = client_manager.create_channel(label='file', protocol='', **options)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                with self.assertRaises(ValueError) as cm:
+                    run(channel.recv_into_file(os.path.join(tmpdir, 'sink'), 1000))
+                self.assertEqual(
+                    str(cm.exception),
+                    'Cannot receive file on an unordered or partially reliable channel')
+
+    def test_negotiated(self):
+        client_manager, server_manager = manager_pair()
+        server_channels = []
+        server_manager.pc.on('datachannel', server_channels.append)
+
+        with self.assertRaises(ValueError) as cm:
+            client_manager.create_channel(label='bogus', protocol='', negotiated=True)
+        self.assertEqual(str(cm.exception), 'Negotiated data channels require an id')
+        with self.assertRaises(ValueError) as cm:
+            client_manager.create_channel(label='bogus', protocol='', negotiated=True, id=65535)
+        self.assertEqual(str(cm.exception), 'Data channel id must be in range 0 - 65534')
+
+        # both sides create the channel
+        client_channel = client_manager.create_channel(
+            label='control', protocol='', negotiated=True, id=1)
+        server_channel = server_manager.create_channel(
+            label='control', protocol='', negotiated=True, id=1)
+        self.assertTrue(client_channel.negotiated)
+        self.assertEqual(client_channel.readyState, 'connecting')
+        client_channel.send('hello')
+
+        with self.assertRaises(ValueError) as cm:
+            client_manager.create_channel(label='bogus', protocol='', negotiated=True, id=1)
+        self.assertEqual(str(cm.exception), 'Data channel id 1 is already in use')
+
+        # in-band channels skip the negotiated id
+        channel = client_manager.create_channel(label='chat', protocol='')
+        self.assertEqual(channel.id, 3)
+
+        start(client_manager, server_manager)
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client_channel.readyState, 'open')
+        self.assertEqual(server_channel.readyState, 'open')
+        self.assertEqual(run(server_channel.recv()), 'hello')
+        self.assertEqual([c.label for c in server_channels], ['chat'])
+
+        # channels created once connected are open immediately
+        channel = client_manager.create_channel(
+            label='late', protocol='', negotiated=True, id=10)
+        self.assertEqual(channel.readyState, 'open')
+
+        stop(client_manager, server_manager)
+
+    def test_negotiated_id_collision(self):
+        client_manager, server_manager = manager_pair()
+        server_channels = []
+        server_manager.pc.on('datachannel', server_channels.append)
+
+        # the server negotiates an id the client also picks for an in-band channel
+        server_channel = server_manager.create_channel(
+            label='control', protocol='', negotiated=True, id=1)
+        client_channel = client_manager.create_channel(label='chat', protocol='')
+        self.assertEqual(client_channel.id, 1)
+
+        start(client_manager, server_manager)
+        run(asyncio.sleep(0.5))
+
+        # the open request is ignored
+        self.assertEqual(server_channels, [])
+        self.assertEqual(server_channel.readyState, 'open')
+        self.assertEqual(client_channel.readyState, 'connecting')
+
+        # other channels keep working
+        channel = client_manager.create_channel(label='other', protocol='')
+        run(asyncio.sleep(0.5))
+        self.assertEqual(channel.readyState, 'open')
+        self.assertEqual([c.label for c in server_channels], ['other'])
+        channel.send('hello')
+        self.assertEqual(run(server_channels[0].recv()), 'hello')
+
+        # an acknowledgement for an unknown stream is ignored too
+        run(server_manager.endpoint.send(5, WEBRTC_DCEP, bytes([DATA_CHANNEL_ACK])))
+        run(asyncio.sleep(0.1))
+        self.assertEqual(sorted(client_manager.channels.keys()), [1, 3])
+
+        stop(client_manager, server_manager)
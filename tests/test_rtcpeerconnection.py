@@ -5,10 +5,11 @@ from unittest import TestCase
 from aiortc import RTCPeerConnection, RTCSessionDescription
 from aiortc.exceptions import (InternalError, InvalidAccessError,
                                InvalidStateError)
-from aiortc.mediastreams import (AudioStreamTrack, MediaStreamTrack,
+from aiortc.mediastreams import (AudioFrame, AudioStreamTrack,
+                                 MediaStreamTrack, VideoFrame,
                                  VideoStreamTrack)
 from aiortc.rtcpeerconnection import MEDIA_CODECS, find_common_codecs
-from aiortc.sdp import MediaDescription
+from aiortc.sdp import MediaDescription, SessionDescription
 
 from .utils import run
 
@@ -520,9 +521,12 @@ class RTCPeerConnectionTest(TestCase):
             b'binary-echo: ' + LONG_DATA,
         ])
 
-        # close data channel
+        # close data channel, the stream is reset by both parties
         dc.close()
+        self.assertEqual(dc.readyState, 'closing')
+        run(asyncio.sleep(0.5))
         self.assertEqual(dc.readyState, 'closed')
+        self.assertEqual(pc2_data_channels[0].readyState, 'closed')
 
         # close
         run(pc1.close())
@@ -545,6 +549,241 @@ class RTCPeerConnectionTest(TestCase):
         self.assertEqual(pc2_states['signalingState'], [
             'stable', 'have-remote-offer', 'stable', 'closed'])
 
+    def test_connect_bundle(self):
+        pc1 = RTCPeerConnection()
+        pc1_states = track_states(pc1)
+
+        pc2 = RTCPeerConnection()
+        pc2_data_messages = []
+        pc2_states = track_states(pc2)
+        pc2_tracks = []
+
+        @pc2.on('datachannel')
+        def on_datachannel(channel):
+            @channel.on('message')
+            def on_message(message):
+                pc2_data_messages.append(message)
+
+        @pc2.on('track')
+        def on_track(track):
+            pc2_tracks.append(track)
+
+        # create offer
+        pc1.addTrack(AudioStreamTrack())
+        pc1.addTrack(VideoStreamTrack())
+        dc = pc1.createDataChannel('chat')
+        dc.send('hello')
+
+        offer = run(pc1.createOffer())
+        self.assertTrue('a=group:BUNDLE 0 1 2' in offer.sdp)
+        self.assertTrue('a=mid:0' in offer.sdp)
+        self.assertTrue('a=mid:1' in offer.sdp)
+        self.assertTrue('a=mid:2' in offer.sdp)
+
+        # all media share the same transport
+        run(pc1.setLocalDescription(offer))
+        parsed = SessionDescription.parse(pc1.localDescription.sdp)
+        self.assertEqual(parsed.bundle, ['0', '1', '2'])
+        self.assertEqual(len(parsed.media), 3)
+        self.assertEqual(len(set(media.ice_ufrag for media in parsed.media)), 1)
+        self.assertEqual(len(set(media.port for media in parsed.media)), 1)
+
+        # handle offer
+        run(pc2.setRemoteDescription(pc1.localDescription))
+        self.assertEqual([track.kind for track in pc2_tracks], ['audio', 'video'])
+
+        # create answer
+        answer = run(pc2.createAnswer())
+        self.assertTrue('a=group:BUNDLE 0 1 2' in answer.sdp)
+
+        run(pc2.setLocalDescription(answer))
+        parsed = SessionDescription.parse(pc2.localDescription.sdp)
+        self.assertEqual(parsed.bundle, ['0', '1', '2'])
+        self.assertEqual([media.mid for media in parsed.media], ['0', '1', '2'])
+        self.assertEqual(len(set(media.ice_ufrag for media in parsed.media)), 1)
+
+        # handle answer
+        run(pc1.setRemoteDescription(pc2.localDescription))
+
+        # check outcome
+        run(asyncio.sleep(1))
+        self.assertEqual(pc1.iceConnectionState, 'completed')
+        self.assertEqual(pc2.iceConnectionState, 'completed')
+        self.assertEqual(pc2_data_messages, ['hello'])
+
+        # media is routed to the right track
+        frame = run(asyncio.wait_for(pc2_tracks[0].recv(), timeout=1))
+        self.assertTrue(isinstance(frame, AudioFrame))
+        frame = run(asyncio.wait_for(pc2_tracks[1].recv(), timeout=1))
+        self.assertTrue(isinstance(frame, VideoFrame))
+
+        # close
+        run(pc1.close())
+        run(pc2.close())
+        self.assertEqual(pc1_states['iceConnectionState'], [
+            'new', 'checking', 'completed', 'closed'])
+        self.assertEqual(pc2_states['iceConnectionState'], [
+            'new', 'checking', 'completed', 'closed'])
+
+    def test_connect_max_compat(self):
+        pc1 = RTCPeerConnection(bundlePolicy='max-compat')
+        pc2 = RTCPeerConnection()
+
+        pc1.addTrack(AudioStreamTrack())
+        pc1.addTrack(VideoStreamTrack())
+        offer = run(pc1.createOffer())
+        self.assertFalse('a=group:BUNDLE' in offer.sdp)
+
+        # each media has its own transport
+        run(pc1.setLocalDescription(offer))
+        parsed = SessionDescription.parse(pc1.localDescription.sdp)
+        self.assertEqual(parsed.bundle, [])
+        self.assertEqual(len(set(media.ice_ufrag for media in parsed.media)), 2)
+
+        run(pc2.setRemoteDescription(pc1.localDescription))
+        run(pc2.setLocalDescription(run(pc2.createAnswer())))
+        self.assertFalse('a=group:BUNDLE' in pc2.localDescription.sdp)
+        run(pc1.setRemoteDescription(pc2.localDescription))
+
+        run(asyncio.sleep(1))
+        self.assertEqual(pc1.iceConnectionState, 'completed')
+        self.assertEqual(pc2.iceConnectionState, 'completed')
+
+        run(pc1.close())
+        run(pc2.close())
+
+    def test_connect_ice_restart(self):
+        pc1 = RTCPeerConnection()
+        pc1_transport_states = []
+        pc2 = RTCPeerConnection()
+        pc2_data_messages = []
+
+        @pc1.on('transportstatechange')
+        def transportstatechange(mids, state):
+            pc1_transport_states.append((mids, state))
+
+        @pc2.on('datachannel')
+        def on_datachannel(channel):
+            @channel.on('message')
+            def on_message(message):
+                pc2_data_messages.append(message)
+
+        dc = pc1.createDataChannel('chat')
+
+        # ICE restart is only possible once connected
+        with self.assertRaises(InvalidStateError) as cm:
+            run(pc1.createOffer(iceRestart=True))
+        self.assertEqual(str(cm.exception),
+                         'Cannot restart ICE in ICE connection state "new"')
+
+        run(pc1.setLocalDescription(run(pc1.createOffer())))
+        run(pc2.setRemoteDescription(pc1.localDescription))
+        run(pc2.setLocalDescription(run(pc2.createAnswer())))
+        run(pc1.setRemoteDescription(pc2.localDescription))
+
+        run(asyncio.sleep(1))
+        self.assertEqual(pc1.iceConnectionState, 'completed')
+        self.assertEqual(pc2.iceConnectionState, 'completed')
+        dc.send('hello')
+        run(asyncio.sleep(0.5))
+        self.assertEqual(pc2_data_messages, ['hello'])
+
+        # restart ICE
+        ufrag1 = SessionDescription.parse(pc1.localDescription.sdp).media[0].ice_ufrag
+        ufrag2 = SessionDescription.parse(pc2.localDescription.sdp).media[0].ice_ufrag
+        run(pc1.setLocalDescription(run(pc1.createOffer(iceRestart=True))))
+        run(pc2.setRemoteDescription(pc1.localDescription))
+        run(pc2.setLocalDescription(run(pc2.createAnswer())))
+        run(pc1.setRemoteDescription(pc2.localDescription))
+        self.assertNotEqual(
+            SessionDescription.parse(pc1.localDescription.sdp).media[0].ice_ufrag, ufrag1)
+        self.assertNotEqual(
+            SessionDescription.parse(pc2.localDescription.sdp).media[0].ice_ufrag, ufrag2)
+
+        # the data channel carries on over the new ICE connections
+        run(asyncio.sleep(1))
+        self.assertEqual(pc1.iceConnectionState, 'completed')
+        self.assertEqual(pc2.iceConnectionState, 'completed')
+        self.assertEqual(dc.readyState, 'open')
+        dc.send('world')
+        run(asyncio.sleep(0.5))
+        self.assertEqual(pc2_data_messages, ['hello', 'world'])
+
+        # the restarted transport skips the DTLS handshake
+        self.assertEqual(pc1_transport_states, [
+            (['0'], 'checking'),
+            (['0'], 'connecting'),
+            (['0'], 'connected'),
+            (['0'], 'checking'),
+            (['0'], 'connected'),
+        ])
+
+        run(pc1.close())
+        run(pc2.close())
+
+    def test_connect_bad_fingerprint(self):
+        pc1 = RTCPeerConnection(bundlePolicy='max-compat')
+        pc1_states = track_states(pc1)
+        pc1_transport_states = {}
+        pc2 = RTCPeerConnection()
+
+        @pc1.on('transportstatechange')
+        def transportstatechange(mids, state):
+            pc1_transport_states.setdefault(tuple(mids), []).append(state)
+
+        pc1.addTrack(AudioStreamTrack())
+        pc1.addTrack(VideoStreamTrack())
+        run(pc1.setLocalDescription(run(pc1.createOffer())))
+        run(pc2.setRemoteDescription(pc1.localDescription))
+        run(pc2.setLocalDescription(run(pc2.createAnswer())))
+
+        # tamper with the fingerprint of the video transport
+        fingerprint = SessionDescription.parse(pc2.localDescription.sdp).media[1].dtls_fingerprint
+        audio, video = pc2.localDescription.sdp.split('m=video')
+        video = video.replace(fingerprint, '00:' * 31 + '00')
+        run(pc1.setRemoteDescription(RTCSessionDescription(
+            sdp=audio + 'm=video' + video, type='answer')))
+
+        # one transport fails, so does the connection
+        run(asyncio.sleep(1))
+        self.assertEqual(pc1.iceConnectionState, 'failed')
+        self.assertEqual(pc1_states['iceConnectionState'], [
+            'new', 'checking', 'failed'])
+
+        # the state of each transport is reported
+        self.assertEqual(pc1_transport_states, {
+            ('0',): ['checking', 'connecting', 'connected'],
+            ('1',): ['checking', 'connecting', 'failed'],
+        })
+
+        run(pc1.close())
+        run(pc2.close())
+
+    def test_bundlePolicy_bogus(self):
+        with self.assertRaises(ValueError) as cm:
+            RTCPeerConnection(bundlePolicy='balanced')
+        self.assertEqual(str(cm.exception), 'Unsupported bundle policy "balanced"')
+
+    def test_setRemoteDescription_answer_without_bundle(self):
+        pc1 = RTCPeerConnection()
+        pc1.addTrack(AudioStreamTrack())
+        pc1.addTrack(VideoStreamTrack())
+        run(pc1.setLocalDescription(run(pc1.createOffer())))
+
+        pc2 = RTCPeerConnection(bundlePolicy='max-compat')
+        pc2.addTrack(AudioStreamTrack())
+        pc2.addTrack(VideoStreamTrack())
+        run(pc2.setLocalDescription(run(pc2.createOffer())))
+        answer = RTCSessionDescription(sdp=pc2.localDescription.sdp, type='answer')
+
+        with self.assertRaises(InternalError) as cm:
+            run(pc1.setRemoteDescription(answer))
+        self.assertEqual(str(cm.exception), 'Remote party does not support BUNDLE, use the '
+                                            '"max-compat" bundle policy')
+
+        run(pc1.close())
+        run(pc2.close())
+
     def test_createAnswer_closed(self):
         pc = RTCPeerConnection()
         run(pc.close())
@@ -2,49 +2,154 @@ import asyncio
 from unittest import TestCase
 
 from aiortc.codecs.g711 import PcmuDecoder, PcmuEncoder
+from aiortc.instrumentation import Instrumentation
 from aiortc.mediastreams import AudioFrame, AudioStreamTrack
 from aiortc.rtcrtptransceiver import (RemoteStreamTrack, RTCRtpReceiver,
-                                      RTCRtpSender)
+                                      RTCRtpSender, RtpRouter)
+from aiortc.rtp import RtpPacket
 
 from .utils import dummy_transport_pair, load, run
 
 
+class RtpRouterTest(TestCase):
+    def test_route(self):
+        transport, remote = dummy_transport_pair()
+        router = RtpRouter(transport)
+        audio = router.register(payload_types=[0, 8])
+        video = router.register(payload_types=[100], ssrcs=[1234])
+
+        # route on payload type, then on the SSRC which was learnt
+        router.data_received(bytes(RtpPacket(payload_type=0, ssrc=5678)))
+        router.data_received(bytes(RtpPacket(payload_type=8, ssrc=5678)))
+        self.assertEqual(RtpPacket.parse(run(audio.recv())).payload_type, 0)
+        self.assertEqual(RtpPacket.parse(run(audio.recv())).payload_type, 8)
+
+        # route on an announced SSRC
+        router.data_received(bytes(RtpPacket(payload_type=0, ssrc=1234)))
+        self.assertEqual(RtpPacket.parse(run(video.recv())).ssrc, 1234)
+
+        # unknown payload type is dropped
+        router.data_received(bytes(RtpPacket(payload_type=101, ssrc=4321)))
+
+        # RTCP goes to all transceivers
+        router.data_received(load('rtcp_sr.bin'))
+        self.assertEqual(run(audio.recv()), load('rtcp_sr.bin'))
+        self.assertEqual(run(video.recv()), load('rtcp_sr.bin'))
+        self.assertTrue(audio._queue.empty())
+        self.assertTrue(video._queue.empty())
+
+        # sending goes through the shared transport
+        run(video.send(b'foo'))
+        self.assertEqual(run(remote.recv()), b'foo')
+
+    def test_route_handler(self):
+        transport, remote = dummy_transport_pair()
+        router = RtpRouter(transport)
+        audio = router.register(payload_types=[0])
+        video = router.register(payload_types=[100])
+
+        # packets queued before the handler is set are delivered first
+        router.data_received(bytes(RtpPacket(payload_type=0, ssrc=5678)))
+        audio_packets = []
+        audio.set_handler(audio_packets.append)
+        video_packets = []
+        video.set_handler(video_packets.append)
+        self.assertEqual(len(audio_packets), 1)
+
+        router.data_received(bytes(RtpPacket(payload_type=100, ssrc=1234)))
+        router.data_received(load('rtcp_sr.bin'))
+        self.assertEqual(len(audio_packets), 2)
+        self.assertEqual(RtpPacket.parse(video_packets[0]).ssrc, 1234)
+        self.assertEqual(video_packets[1], load('rtcp_sr.bin'))
+
+        # go back to queueing
+        audio.set_handler(None)
+        router.data_received(bytes(RtpPacket(payload_type=0, ssrc=5678)))
+        self.assertEqual(len(audio_packets), 2)
+        self.assertEqual(RtpPacket.parse(run(audio.recv())).ssrc, 5678)
+
+    def test_route_handler_error(self):
+        transport, remote = dummy_transport_pair()
+        router = RtpRouter(transport)
+        audio = router.register(payload_types=[0])
+        video = router.register(payload_types=[100])
+
+        def bogus_handler(data):
+            raise ValueError('bogus')
+
+        audio.set_handler(bogus_handler)
+        video_packets = []
+        video.set_handler(video_packets.append)
+
+        # an error in one handler does not stop delivery to the others
+        router.data_received(load('rtcp_sr.bin'))
+        router.data_received(bytes(RtpPacket(payload_type=100, ssrc=1234)))
+        self.assertEqual(len(video_packets), 2)
+
+
 class RTCRtpReceiverTest(TestCase):
-    def test_connection_error(self):
-        transport, _ = dummy_transport_pair()
+    def test_rtp_and_rtcp(self):
+        transport, remote = dummy_transport_pair()
+        router = RtpRouter(transport)
         decoder = PcmuDecoder()
 
         receiver = RTCRtpReceiver(kind='audio')
-        run(asyncio.gather(
-            receiver._run(transport=transport, decoder=decoder, payload_type=0),
-            transport.close()))
+        receiver._track = RemoteStreamTrack(kind='audio')
+        receiver._attach(router.register(payload_types=[0]), decoder=decoder, payload_type=0)
 
-    def test_rtp_and_rtcp(self):
+        # receive RTP and RTCP
+        router.data_received(load('rtp.bin'))
+        router.data_received(load('rtcp_sr.bin'))
+
+        # check remote track
+        frame = run(receiver._track.recv())
+        self.assertTrue(isinstance(frame, AudioFrame))
+
+    def test_instrumentation(self):
         transport, remote = dummy_transport_pair()
         decoder = PcmuDecoder()
 
+        router = RtpRouter(transport)
+
         receiver = RTCRtpReceiver(kind='audio')
+        receiver._instrumentation = Instrumentation(label='foo')
         receiver._track = RemoteStreamTrack(kind='audio')
-
-        task = asyncio.ensure_future(
-            receiver._run(transport=transport, decoder=decoder, payload_type=0))
+        receiver._attach(router.register(payload_types=[0]), decoder=decoder, payload_type=0)
 
         # receive RTP
-        run(remote.send(load('rtp.bin')))
+        router.data_received(load('rtp.bin'))
+        run(receiver._track.recv())
 
-        # receive RTCP
-        run(remote.send(load('rtcp_sr.bin')))
+        stages = receiver._instrumentation.stages
+        self.assertEqual(stages['parse'].count, 1)
+        self.assertEqual(stages['jitter'].count, 1)
+        self.assertEqual(stages['decode'].count, 1)
+        self.assertEqual(stages['encode'].count, 0)
 
-        # check remote track
-        frame = run(receiver._track.recv())
-        self.assertTrue(isinstance(frame, AudioFrame))
+
+class RTCRtpSenderTest(TestCase):
+    def test_send_frames(self):
+        transport, remote = dummy_transport_pair()
+        encoder = PcmuEncoder()
+
+        sender = RTCRtpSender(kind='audio')
+        sender._track = AudioStreamTrack()
+        task = asyncio.ensure_future(
+            sender._run(transport=transport, encoder=encoder, payload_type=0))
+
+        # check packets
+        packet1 = RtpPacket.parse(run(remote.recv()))
+        packet2 = RtpPacket.parse(run(remote.recv()))
+        self.assertEqual(packet1.payload_type, 0)
+        self.assertEqual(packet1.ssrc, sender._ssrc)
+        self.assertEqual(packet1.marker, 1)
+        self.assertEqual(packet2.sequence_number, packet1.sequence_number + 1)
+        self.assertEqual(packet2.timestamp, packet1.timestamp + 160)
 
         # shutdown
         run(transport.close())
         run(task)
 
-
-class RTCRtpSenderTest(TestCase):
     def test_connection_error(self):
         transport, _ = dummy_transport_pair()
         encoder = PcmuEncoder()
@@ -1,12 +1,31 @@
 import asyncio
 import logging
+import time
 from unittest import TestCase
+from unittest.mock import patch
 
 from aiortc import sctp
 
 from .utils import dummy_transport_pair, load, run
 
 
+def drop_data(transport, payload):
+    """
+    Make `transport` drop any packet carrying a DATA chunk with `payload`.
+    """
+    real_send = transport.send
+
+    async def mock_send(data):
+        packet = sctp.Packet.parse(data)
+        for chunk in packet.chunks:
+            if (isinstance(chunk, (sctp.DataChunk, sctp.IDataChunk)) and
+               chunk.user_data == payload):
+                return
+        await real_send(data)
+
+    transport.send = mock_send
+
+
 class SctpPacketTest(TestCase):
     def test_parse_init(self):
         data = load('sctp_init.bin')
@@ -55,6 +74,77 @@ class SctpPacketTest(TestCase):
 
         self.assertEqual(bytes(packet), data)
 
+    def test_parse_forward_tsn(self):
+        chunk = sctp.ForwardTsnChunk()
+        chunk.cumulative_tsn = 1234
+        chunk.streams = [(1, 2), (3, 4)]
+
+        packet = sctp.Packet(source_port=5000, destination_port=5000, verification_tag=123)
+        packet.chunks.append(chunk)
+        parsed = sctp.Packet.parse(bytes(packet))
+        self.assertEqual(len(parsed.chunks), 1)
+        self.assertTrue(isinstance(parsed.chunks[0], sctp.ForwardTsnChunk))
+        self.assertEqual(parsed.chunks[0].type, 192)
+        self.assertEqual(parsed.chunks[0].cumulative_tsn, 1234)
+        self.assertEqual(parsed.chunks[0].streams, [(1, 2), (3, 4)])
+
+    def test_parse_reconfig(self):
+        param = sctp.StreamResetOutgoingParam(
+            request_sequence=1, response_sequence=2, last_tsn=3, streams=[4, 5, 6])
+        chunk = sctp.ReconfigChunk()
+        chunk.params.append((sctp.RECONFIG_PARAM_OUTGOING_RESET, bytes(param)))
+
+        packet = sctp.Packet(source_port=5000, destination_port=5000, verification_tag=0)
+        packet.chunks.append(chunk)
+        packet = sctp.Packet.parse(bytes(packet))
+        self.assertEqual(len(packet.chunks), 1)
+        self.assertTrue(isinstance(packet.chunks[0], sctp.ReconfigChunk))
+
+        param_type, param_value = packet.chunks[0].params[0]
+        self.assertEqual(param_type, sctp.RECONFIG_PARAM_OUTGOING_RESET)
+        param = sctp.StreamResetOutgoingParam.parse(param_value)
+        self.assertEqual(param.request_sequence, 1)
+        self.assertEqual(param.response_sequence, 2)
+        self.assertEqual(param.last_tsn, 3)
+        self.assertEqual(param.streams, [4, 5, 6])
+
+        param = sctp.StreamAddOutgoingParam.parse(bytes(
+            sctp.StreamAddOutgoingParam(request_sequence=7, new_streams=16)))
+        self.assertEqual(param.request_sequence, 7)
+        self.assertEqual(param.new_streams, 16)
+
+        param = sctp.StreamResetResponseParam.parse(bytes(
+            sctp.StreamResetResponseParam(response_sequence=7, result=1)))
+        self.assertEqual(param.response_sequence, 7)
+        self.assertEqual(param.result, 1)
+
+    def test_parse_heartbeat(self):
+        chunk = sctp.HeartbeatChunk()
+        chunk.params.append((sctp.HEARTBEAT_INFO, b'\x01\x02\x03'))
+
+        packet = sctp.Packet(source_port=5000, destination_port=5000, verification_tag=0)
+        packet.chunks.append(chunk)
+        packet.chunks.append(sctp.HeartbeatAckChunk(body=chunk.body))
+        packet = sctp.Packet.parse(bytes(packet))
+        self.assertEqual(len(packet.chunks), 2)
+        self.assertEqual(packet.chunks[0].type, 4)
+        self.assertEqual(packet.chunks[0].params, [(sctp.HEARTBEAT_INFO, b'\x01\x02\x03')])
+        self.assertEqual(packet.chunks[1].type, 5)
+        self.assertEqual(packet.chunks[1].params, [(sctp.HEARTBEAT_INFO, b'\x01\x02\x03')])
+
+    def test_parse_sack(self):
+        chunk = sctp.SackChunk()
+        chunk.cumulative_tsn = 1234
+        chunk.advertised_rwnd = 5678
+        chunk.gaps = [(2, 3), (5, 5)]
+        chunk.duplicates = [1230]
+
+        parsed = sctp.SackChunk(flags=0, body=chunk.body)
+        self.assertEqual(parsed.cumulative_tsn, 1234)
+        self.assertEqual(parsed.advertised_rwnd, 5678)
+        self.assertEqual(parsed.gaps, [(2, 3), (5, 5)])
+        self.assertEqual(parsed.duplicates, [1230])
+
     def test_invalid_checksum(self):
         data = load('sctp_init.bin')
         data = data[0:8] + b'\x01\x02\x03\x04' + data[12:]
@@ -69,6 +159,254 @@ class SctpPacketTest(TestCase):
         self.assertEqual(str(cm.exception), 'SCTP packet length is less than 12 bytes')
 
 
+class SctpStreamTest(TestCase):
+    def setUp(self):
+        self.fragmented = []
+        for i, flags in enumerate([sctp.SCTP_DATA_FIRST_FRAG, 0, sctp.SCTP_DATA_LAST_FRAG]):
+            chunk = sctp.DataChunk()
+            chunk.flags = flags
+            chunk.tsn = 100 + i
+            chunk.stream_id = 456
+            chunk.stream_seq = 0
+            chunk.protocol = 123
+            chunk.user_data = bytes([i]) * 3
+            self.fragmented.append(chunk)
+
+        self.ordered = []
+        for i in range(3):
+            chunk = sctp.DataChunk()
+            chunk.flags = sctp.SCTP_DATA_FIRST_FRAG | sctp.SCTP_DATA_LAST_FRAG
+            chunk.tsn = 100 + i
+            chunk.stream_id = 456
+            chunk.stream_seq = i
+            chunk.protocol = 123
+            chunk.user_data = bytes([i])
+            self.ordered.append(chunk)
+
+    def test_fragmented_out_of_order(self):
+        stream = sctp.InboundStream()
+        stream.add_chunk(self.fragmented[2])
+        self.assertEqual(list(stream.pop_messages()), [])
+        stream.add_chunk(self.fragmented[0])
+        self.assertEqual(list(stream.pop_messages()), [])
+
+        # duplicates are ignored
+        stream.add_chunk(self.fragmented[0])
+        self.assertEqual(len(stream.chunks), 2)
+
+        stream.add_chunk(self.fragmented[1])
+        self.assertEqual(list(stream.pop_messages()), [
+            (456, 123, b'\x00\x00\x00\x01\x01\x01\x02\x02\x02'),
+        ])
+        self.assertEqual(stream.chunks, {})
+        self.assertEqual(stream.sequence_number, 1)
+
+    def test_ordered_out_of_order(self):
+        stream = sctp.InboundStream()
+        stream.add_chunk(self.ordered[2])
+        stream.add_chunk(self.ordered[1])
+        self.assertEqual(list(stream.pop_messages()), [])
+
+        stream.add_chunk(self.ordered[0])
+        self.assertEqual(list(stream.pop_messages()), [
+            (456, 123, b'\x00'),
+            (456, 123, b'\x01'),
+            (456, 123, b'\x02'),
+        ])
+        self.assertEqual(stream.sequence_number, 3)
+
+        # late duplicate of a delivered message is dropped
+        stream.add_chunk(self.ordered[1])
+        self.assertEqual(stream.chunks, {})
+
+    def test_unordered_out_of_order(self):
+        for chunk in self.ordered:
+            chunk.flags |= sctp.SCTP_DATA_UNORDERED
+            chunk.stream_seq = 0
+
+        stream = sctp.InboundStream()
+        stream.add_chunk(self.ordered[2])
+        self.assertEqual(list(stream.pop_messages()), [(456, 123, b'\x02')])
+        stream.add_chunk(self.ordered[1])
+        self.assertEqual(list(stream.pop_messages()), [(456, 123, b'\x01')])
+        stream.add_chunk(self.ordered[0])
+        self.assertEqual(list(stream.pop_messages()), [(456, 123, b'\x00')])
+        self.assertEqual(stream.sequence_number, 0)
+
+    def test_oversized(self):
+        stream = sctp.InboundStream(max_message_size=5)
+        stream.add_chunk(self.fragmented[0])
+        stream.add_chunk(self.fragmented[1])
+        self.assertEqual(list(stream.pop_messages()), [])
+        self.assertEqual(stream.chunks, {})
+        self.assertEqual(stream.sequence_number, 1)
+
+        # the last fragment is dropped too
+        stream.add_chunk(self.fragmented[2])
+        self.assertEqual(stream.chunks, {})
+        self.assertEqual(list(stream.pop_messages()), [])
+
+    def test_oversized_trailing_fragments(self):
+        def message(stream_seq, unordered):
+            chunks = []
+            for i in range(20):
+                chunk = sctp.DataChunk()
+                if i == 0:
+                    chunk.flags |= sctp.SCTP_DATA_FIRST_FRAG
+                if i == 19:
+                    chunk.flags |= sctp.SCTP_DATA_LAST_FRAG
+                if unordered:
+                    chunk.flags |= sctp.SCTP_DATA_UNORDERED
+                chunk.tsn = 101 + i
+                chunk.stream_id = 456
+                chunk.stream_seq = stream_seq
+                chunk.protocol = 123
+                chunk.user_data = bytes([i]) * 3
+                chunks.append(chunk)
+            # some trailing fragments arrive out of order
+            chunks[5], chunks[8] = chunks[8], chunks[5]
+            return chunks
+
+        # unordered message
+        stream = sctp.InboundStream(max_message_size=5)
+        for chunk in message(stream_seq=0, unordered=True):
+            stream.add_chunk(chunk)
+        self.assertEqual(list(stream.pop_messages()), [])
+        self.assertEqual(stream.chunks, {})
+        self.assertEqual(stream.partial, {})
+
+        # ordered message waiting behind a gap
+        stream = sctp.InboundStream(max_message_size=5)
+        for chunk in message(stream_seq=1, unordered=False):
+            stream.add_chunk(chunk)
+        self.assertEqual(list(stream.pop_messages()), [])
+        self.assertEqual(stream.chunks, {})
+        self.assertEqual(stream.partial, {})
+
+        # filling the gap skips the discarded message
+        stream.add_chunk(self.ordered[0])
+        self.assertEqual(list(stream.pop_messages()), [(456, 123, b'\x00')])
+        self.assertEqual(stream.sequence_number, 2)
+        self.assertEqual(stream.ordered, {})
+
+    def test_many_fragments(self):
+        count = 3200
+        chunks = []
+        for i in range(count):
+            chunk = sctp.DataChunk()
+            if i == 0:
+                chunk.flags |= sctp.SCTP_DATA_FIRST_FRAG
+            if i == count - 1:
+                chunk.flags |= sctp.SCTP_DATA_LAST_FRAG
+            chunk.tsn = (sctp.SCTP_TSN_MODULO - 10 + i) % sctp.SCTP_TSN_MODULO
+            chunk.stream_id = 456
+            chunk.stream_seq = 0
+            chunk.protocol = 123
+            chunk.user_data = bytes([i % 256])
+            chunks.append(chunk)
+        expected = [(456, 123, b''.join(c.user_data for c in chunks))]
+
+        # in order, reversed and with every other fragment delayed
+        delayed = chunks[1::2] + chunks[0::2]
+        for order in [chunks, list(reversed(chunks)), delayed]:
+            stream = sctp.InboundStream()
+            with patch('aiortc.sctp.tsn_plus_one', wraps=sctp.tsn_plus_one) as tsn_plus_one:
+                messages = []
+                for chunk in order:
+                    stream.add_chunk(chunk)
+                    messages.extend(stream.pop_messages())
+            self.assertEqual(messages, expected)
+            self.assertEqual(stream.chunks, {})
+
+            # each fragment is only examined a bounded number of times
+            self.assertLessEqual(tsn_plus_one.call_count, 2 * count)
+
+
+class SctpInterleavedStreamTest(TestCase):
+    def setUp(self):
+        self.chunks = []
+        for message_id in range(2):
+            for fsn, flags in enumerate([sctp.SCTP_DATA_FIRST_FRAG, sctp.SCTP_DATA_LAST_FRAG]):
+                chunk = sctp.IDataChunk()
+                chunk.flags = flags
+                chunk.tsn = 100 + 2 * message_id + fsn
+                chunk.stream_id = 456
+                chunk.message_id = message_id
+                chunk.fsn = fsn
+                chunk.protocol = 123
+                chunk.user_data = bytes([message_id, fsn])
+                self.chunks.append(chunk)
+
+    def test_parse(self):
+        packet = sctp.Packet(source_port=5000, destination_port=5000, verification_tag=0)
+        packet.chunks = self.chunks[0:2]
+        packet = sctp.Packet.parse(bytes(packet))
+        self.assertEqual(len(packet.chunks), 2)
+        self.assertTrue(isinstance(packet.chunks[0], sctp.IDataChunk))
+        self.assertEqual(packet.chunks[0].protocol, 123)
+        self.assertEqual(packet.chunks[0].fsn, 0)
+        self.assertEqual(packet.chunks[1].protocol, 0)
+        self.assertEqual(packet.chunks[1].fsn, 1)
+        self.assertEqual(packet.chunks[1].user_data, b'\x00\x01')
+
+    def test_ordered_interleaved(self):
+        stream = sctp.InterleavedInboundStream()
+        stream.add_chunk(self.chunks[2])
+        stream.add_chunk(self.chunks[0])
+        stream.add_chunk(self.chunks[3])
+        self.assertEqual(list(stream.pop_messages()), [])
+
+        stream.add_chunk(self.chunks[1])
+        self.assertEqual(list(stream.pop_messages()), [
+            (456, 123, b'\x00\x00\x00\x01'),
+            (456, 123, b'\x01\x00\x01\x01'),
+        ])
+        self.assertEqual(stream.messages, {})
+        self.assertEqual(stream.sequence_number, 2)
+
+        # late duplicate of a delivered message is dropped
+        stream.add_chunk(self.chunks[0])
+        self.assertEqual(stream.messages, {})
+
+    def test_unordered_interleaved(self):
+        for chunk in self.chunks:
+            chunk.flags |= sctp.SCTP_DATA_UNORDERED
+
+        stream = sctp.InterleavedInboundStream()
+        stream.add_chunk(self.chunks[2])
+        stream.add_chunk(self.chunks[0])
+        stream.add_chunk(self.chunks[3])
+        self.assertEqual(list(stream.pop_messages()), [(456, 123, b'\x01\x00\x01\x01')])
+        stream.add_chunk(self.chunks[1])
+        self.assertEqual(list(stream.pop_messages()), [(456, 123, b'\x00\x00\x00\x01')])
+        self.assertEqual(stream.sequence_number, 0)
+
+    def test_oversized(self):
+        self.chunks[0].user_data = b'\x00' * 5
+
+        stream = sctp.InterleavedInboundStream(max_message_size=5)
+        stream.add_chunk(self.chunks[0])
+        stream.add_chunk(self.chunks[1])
+        self.assertEqual(stream.messages, {})
+
+        # the discarded message is skipped
+        stream.add_chunk(self.chunks[2])
+        stream.add_chunk(self.chunks[3])
+        self.assertEqual(list(stream.pop_messages()), [(456, 123, b'\x01\x00\x01\x01')])
+        self.assertEqual(stream.sequence_number, 2)
+
+    def test_skip_messages(self):
+        stream = sctp.InterleavedInboundStream()
+        stream.add_chunk(self.chunks[1])
+        stream.add_chunk(self.chunks[2])
+        stream.add_chunk(self.chunks[3])
+        self.assertEqual(list(stream.pop_messages()), [])
+
+        stream.skip_messages(unordered=False, message_id=0)
+        self.assertEqual(list(stream.pop_messages()), [(456, 123, b'\x01\x00\x01\x01')])
+        self.assertEqual(stream.sequence_number, 2)
+
+
 class SctpAssociationTest(TestCase):
     def test_ok(self):
         client_transport, server_transport = dummy_transport_pair()
@@ -95,6 +433,486 @@ class SctpAssociationTest(TestCase):
         self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
         self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
 
+    def test_large_message(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        client.remote_max_message_size = server.max_message_size
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+
+        # send a message which needs to be fragmented
+        user_data = bytes(range(256)) * 1000
+        run(client.send(1, 53, user_data))
+        stream_id, protocol, data = run(server.recv())
+        self.assertEqual(stream_id, 1)
+        self.assertEqual(protocol, 53)
+        self.assertEqual(data, user_data)
+
+        # try sending a message which exceeds the maximum size
+        with self.assertRaises(ValueError) as cm:
+            run(client.send(1, 53, b'\x00' * (server.max_message_size + 1)))
+        self.assertEqual(str(cm.exception),
+                         'Message size 262145 exceeds maximum message size 262144')
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    def test_oversized_message_discarded(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport,
+                               max_message_size=4096)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+
+        # the first message is too big for the server and gets discarded
+        run(client.send(1, 53, b'\x01' * 8192))
+        run(client.send(1, 53, b'\x02' * 2048))
+        stream_id, protocol, data = run(server.recv())
+        self.assertEqual(data, b'\x02' * 2048)
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    def test_reordered_and_unordered(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+
+        # swap the first two packets sent by the client
+        packets = []
+        real_send = client_transport.send
+
+        async def mock_send(data):
+            packets.append(data)
+            if len(packets) == 2:
+                await real_send(packets[1])
+                await real_send(packets[0])
+            elif len(packets) > 2:
+                await real_send(data)
+
+        client_transport.send = mock_send
+
+        # messages are too big to be bundled in a single packet
+        first = b'1' * 1000
+        second = b'2' * 1000
+        run(client.send(1, 51, first))
+        run(client.send(1, 51, second))
+        run(client.send(3, 51, b'unordered', ordered=False))
+        self.assertEqual(run(server.recv()), (1, 51, first))
+        self.assertEqual(run(server.recv()), (1, 51, second))
+        self.assertEqual(run(server.recv()), (3, 51, b'unordered'))
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    def test_send_scheduler(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        client.interleaving_supported = False
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertFalse(client.interleaving)
+        self.assertFalse(server.interleaving)
+
+        # record the streams of transmitted DATA chunks
+        sent = []
+        real_send = client_transport.send
+
+        async def mock_send(data):
+            for chunk in sctp.Packet.parse(data).chunks:
+                if isinstance(chunk, sctp.DataChunk):
+                    sent.append((chunk.stream_id, chunk.flags))
+            await real_send(data)
+
+        client_transport.send = mock_send
+
+        # queue messages on two streams
+        big = b'\x00' * 3000
+        for i in range(10):
+            client.send_nowait(1, 53, big)
+        client.send_nowait(3, 51, b'urgent')
+
+        # messages are all delivered exactly once
+        received = [run(server.recv()) for i in range(11)]
+        self.assertEqual(received.count((1, 53, big)), 10)
+        self.assertEqual(received.count((3, 51, b'urgent')), 1)
+
+        # the second stream does not wait for the first one to be flushed
+        self.assertEqual(sent[0:4], [
+            (1, sctp.SCTP_DATA_FIRST_FRAG),
+            (1, 0),
+            (1, sctp.SCTP_DATA_LAST_FRAG),
+            (3, sctp.SCTP_DATA_FIRST_FRAG | sctp.SCTP_DATA_LAST_FRAG),
+        ])
+
+        # the congestion window grew as data was acknowledged
+        run(asyncio.sleep(0.1))
+        self.assertGreater(client.cwnd, sctp.SCTP_CWND_INITIAL)
+        self.assertEqual(client.flight_size, 0)
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    def test_interleaving(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertTrue(client.interleaving)
+        self.assertTrue(server.interleaving)
+
+        # record the streams of transmitted I-DATA chunks
+        sent = []
+        real_send = client_transport.send
+
+        async def mock_send(data):
+            for chunk in sctp.Packet.parse(data).chunks:
+                if isinstance(chunk, sctp.IDataChunk):
+                    sent.append((chunk.stream_id, chunk.fsn))
+            await real_send(data)
+
+        client_transport.send = mock_send
+
+        # a small message is not stuck behind a large one
+        big = b'\x00' * 30000
+        client.send_nowait(1, 53, big)
+        client.send_nowait(1, 53, big, ordered=False)
+        client.send_nowait(3, 51, b'urgent')
+        self.assertEqual(run(server.recv()), (3, 51, b'urgent'))
+        self.assertEqual(sent[0:3], [(1, 0), (3, 0), (1, 1)])
+        self.assertEqual(run(server.recv()), (1, 53, big))
+        self.assertEqual(run(server.recv()), (1, 53, big))
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    def test_stream_reset(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertTrue(client.remote_reconfig)
+        self.assertTrue(server.remote_reconfig)
+
+        # queued messages are delivered before the reset
+        client.send_nowait(1, 51, b'one')
+        client.send_nowait(1, 51, b'two')
+        client.reset_stream(1)
+        self.assertTrue(client.is_stream_resetting(1))
+        self.assertEqual(run(server.recv()), (1, 51, b'one'))
+        self.assertEqual(run(server.recv()), (1, 51, b'two'))
+        self.assertEqual(run(server.recv()), (1, None, None))
+
+        # the stream sequence numbers start over
+        run(asyncio.sleep(0.1))
+        self.assertFalse(client.is_stream_resetting(1))
+        self.assertNotIn(1, client.stream_seq)
+        self.assertNotIn(1, server.inbound)
+        client.send_nowait(1, 51, b'three')
+        self.assertEqual(run(server.recv()), (1, 51, b'three'))
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    def test_add_streams(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(client.outbound_streams_count, 256)
+
+        # sending beyond the negotiated streams adds streams
+        client.send_nowait(299, 51, b'hello')
+        self.assertEqual(run(server.recv()), (299, 51, b'hello'))
+        self.assertEqual(client.outbound_streams_count, 300)
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    def test_retransmit(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertTrue(client.remote_partial_reliability)
+        self.assertTrue(server.remote_partial_reliability)
+
+        # lose the first transmission of a message
+        real_send = client_transport.send
+        drop_data(client_transport, b'lost')
+        client.rto = 0.1
+        run(client.send(1, 51, b'lost'))
+        client_transport.send = real_send
+
+        # message is retransmitted
+        self.assertEqual(run(server.recv()), (1, 51, b'lost'))
+        run(asyncio.sleep(0.1))
+        self.assertEqual(len(client.sent_queue), 0)
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    def test_fast_retransmit(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+
+        # lose the first transmission of a message, followed by three packets
+        real_send = client_transport.send
+        drop_data(client_transport, b'lost')
+        run(client.send(1, 51, b'lost'))
+        client_transport.send = real_send
+        for i in range(3):
+            run(client.send(1, 51, b'ping'))
+            run(asyncio.sleep(0.05))
+
+        # message is fast retransmitted long before the T3 timer expires
+        self.assertEqual(client.rto, sctp.SCTP_RTO_INITIAL)
+        self.assertEqual(
+            run(asyncio.wait_for(server.recv(), timeout=0.5)), (1, 51, b'lost'))
+        for i in range(3):
+            self.assertEqual(run(server.recv()), (1, 51, b'ping'))
+        run(asyncio.sleep(0.1))
+        self.assertEqual(len(client.sent_queue), 0)
+
+        # congestion window was halved and recovery is over
+        self.assertEqual(client.ssthresh, 4 * sctp.SCTP_MTU)
+        self.assertEqual(client.cwnd, 4 * sctp.SCTP_MTU)
+        self.assertIsNone(client.fast_recovery_exit)
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    def test_close_with_queued_data(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+
+        # queue more data than the congestion window allows, then close
+        for i in range(20):
+            client.send_nowait(1, 51, bytes([i]) * 1000)
+        self.assertTrue(client.outbound_queues)
+        close_task = asyncio.ensure_future(client.close())
+        run(asyncio.sleep(0))
+        self.assertEqual(client.state, sctp.Endpoint.State.SHUTDOWN_PENDING)
+
+        # no new data is accepted
+        with self.assertRaises(ConnectionError):
+            client.send_nowait(1, 51, b'late')
+
+        # queued data is delivered before the association shuts down
+        run(close_task)
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+        for i in range(20):
+            self.assertEqual(run(server.recv()), (1, 51, bytes([i]) * 1000))
+        with self.assertRaises(ConnectionError):
+            run(server.recv())
+
+    def test_partial_reliability_max_retransmits(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+
+        # the first message is always lost and gets abandoned
+        drop_data(client_transport, b'lost')
+        client.rto = 0.1
+        run(client.send(1, 51, b'lost', max_retransmits=0))
+        run(client.send(1, 51, b'delivered', max_retransmits=0))
+        self.assertEqual(run(server.recv()), (1, 51, b'delivered'))
+        run(asyncio.sleep(0.1))
+        self.assertEqual(len(client.sent_queue), 0)
+        self.assertEqual(server.last_received_tsn, client.last_sacked_tsn)
+        self.assertEqual(server.inbound[1].messages, {})
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    def test_partial_reliability_expiry(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        client.interleaving_supported = False
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+
+        # the first fragmented message is always lost and gets abandoned
+        lost = b'\x00' * 3000
+        drop_data(client_transport, lost[0:sctp.USERDATA_MAX_LENGTH])
+        client.rto = 0.1
+        run(client.send(1, 51, lost, expiry=time.time() + 0.05))
+        run(client.send(1, 51, b'delivered'))
+        self.assertEqual(run(server.recv()), (1, 51, b'delivered'))
+        run(asyncio.sleep(0.1))
+        self.assertEqual(len(client.sent_queue), 0)
+        self.assertEqual(server.inbound[1].chunks, {})
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    @patch('aiortc.sctp.SCTP_HB_INTERVAL', 0.1)
+    @patch('aiortc.sctp.SCTP_RTO_INITIAL', 0.1)
+    def test_heartbeat(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+
+        # an idle association sends heartbeats, which measure the RTT
+        self.assertIsNotNone(client.srtt)
+        self.assertEqual(client.rto, sctp.SCTP_RTO_MIN)
+        self.assertEqual(client.error_count, 0)
+
+        # shutdown
+        run(client.close())
+        run(server.close())
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
+    @patch('aiortc.sctp.SCTP_HB_INTERVAL', 0.01)
+    @patch('aiortc.sctp.SCTP_RTO_INITIAL', 0.01)
+    @patch('aiortc.sctp.SCTP_RTO_MAX', 0.02)
+    def test_dead_peer(self):
+        client_transport, server_transport = dummy_transport_pair()
+        client = sctp.Endpoint(is_server=False, transport=client_transport)
+        server = sctp.Endpoint(is_server=True, transport=server_transport)
+        asyncio.ensure_future(server.run())
+        asyncio.ensure_future(client.run())
+
+        # check outcome
+        run(asyncio.sleep(0.5))
+        self.assertEqual(client.state, sctp.Endpoint.State.ESTABLISHED)
+        self.assertEqual(server.state, sctp.Endpoint.State.ESTABLISHED)
+
+        # the server stops answering
+        async def mock_send(data):
+            pass
+
+        server_transport.send = mock_send
+
+        # the client gives up after too many unanswered heartbeats
+        run(asyncio.wait_for(client.closed.wait(), timeout=2))
+        self.assertEqual(client.state, sctp.Endpoint.State.CLOSED)
+        self.assertEqual(client.error_count, sctp.SCTP_MAX_ASSOCIATION_RETRANS + 1)
+
+        # shutdown
+        run(server.abort())
+        self.assertEqual(server.state, sctp.Endpoint.State.CLOSED)
+
     def test_abort(self):
         client_transport, server_transport = dummy_transport_pair()
         client = sctp.Endpoint(is_server=False, transport=client_transport)
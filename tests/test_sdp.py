@@ -50,8 +50,11 @@ a=ssrc:1944796561 cname:/vC4ULAr8vHNjXmq
 a=ssrc:1944796561 msid:TF6VRif1dxuAfe5uefrV2953LhUZt1keYvxU ec1eb8de-8df8-4956-ae81-879e5d062d12
 a=ssrc:1944796561 mslabel:TF6VRif1dxuAfe5uefrV2953LhUZt1keYvxU
 a=ssrc:1944796561 label:ec1eb8de-8df8-4956-ae81-879e5d062d12"""))  # noqa
+        self.assertEqual(d.bundle, ['audio'])
         self.assertEqual(len(d.media), 1)
         self.assertEqual(d.media[0].kind, 'audio')
+        self.assertEqual(d.media[0].mid, 'audio')
+        self.assertEqual(d.media[0].ssrc, [1944796561])
         self.assertEqual(d.media[0].host, '192.168.99.58')
         self.assertEqual(d.media[0].port, 45076)
         self.assertEqual(d.media[0].profile, 'UDP/TLS/RTP/SAVPF')
@@ -94,6 +97,7 @@ a=ssrc:1944796561 label:ec1eb8de-8df8-4956-ae81-879e5d062d12"""))  # noqa
         self.assertEqual(str(d.media[0]), lf2crlf("""m=audio 45076 UDP/TLS/RTP/SAVPF 111 103 104 9 0 8 106 105 13 110 112 113 126
 c=IN IP4 192.168.99.58
 a=sendrecv
+a=mid:audio
 a=rtcp:9 IN IP4 0.0.0.0
 a=rtcp-mux
 a=candidate:2665802302 1 udp 2122262783 2a02:a03f:3eb0:e000:b0aa:d60a:cff2:933c 38475 typ host generation 0
@@ -146,8 +150,11 @@ a=rtpmap:101 telephone-event/8000
 a=setup:actpass
 a=ssrc:882128807 cname:{ed463ac5-dabf-44d4-8b9f-e14318427b2b}
 """))  # noqa
+        self.assertEqual(d.bundle, ['sdparta_0'])
         self.assertEqual(len(d.media), 1)
         self.assertEqual(d.media[0].kind, 'audio')
+        self.assertEqual(d.media[0].mid, 'sdparta_0')
+        self.assertEqual(d.media[0].ssrc, [882128807])
         self.assertEqual(d.media[0].host, '192.168.99.58')
         self.assertEqual(d.media[0].port, 45274)
         self.assertEqual(d.media[0].profile, 'UDP/TLS/RTP/SAVPF')
@@ -204,8 +211,11 @@ a=sctpmap:5000 webrtc-datachannel 256
 a=setup:actpass
 a=max-message-size:1073741823
 """))  # noqa
+        self.assertEqual(d.bundle, ['sdparta_0'])
         self.assertEqual(len(d.media), 1)
         self.assertEqual(d.media[0].kind, 'application')
+        self.assertEqual(d.media[0].mid, 'sdparta_0')
+        self.assertEqual(d.media[0].ssrc, [])
         self.assertEqual(d.media[0].host, '192.168.99.58')
         self.assertEqual(d.media[0].port, 45791)
         self.assertEqual(d.media[0].profile, 'DTLS/SCTP')
@@ -214,6 +224,7 @@ a=max-message-size:1073741823
         self.assertEqual(d.media[0].sctpmap, {
             5000: 'webrtc-datachannel 256',
         })
+        self.assertEqual(d.media[0].max_message_size, 1073741823)
 
         # ice
         self.assertEqual(len(d.media[0].ice_candidates), 4)
@@ -0,0 +1,63 @@
+import asyncio
+from unittest import TestCase
+
+from aiortc.utils import ClosableQueue
+
+from .utils import run
+
+
+class ClosableQueueTest(TestCase):
+    def test_get(self):
+        queue = ClosableQueue()
+        self.assertTrue(queue.empty())
+
+        queue.put_nowait(1)
+        run(queue.put(2))
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(run(queue.get()), 1)
+        self.assertEqual(queue.get_nowait(), 2)
+        with self.assertRaises(asyncio.QueueEmpty):
+            queue.get_nowait()
+
+    def test_get_waiting(self):
+        queue = ClosableQueue()
+        task = asyncio.ensure_future(queue.get())
+        run(asyncio.sleep(0))
+        self.assertFalse(task.done())
+
+        queue.put_nowait(1)
+        self.assertEqual(run(task), 1)
+
+    def test_get_cancelled(self):
+        queue = ClosableQueue()
+        task1 = asyncio.ensure_future(queue.get())
+        task2 = asyncio.ensure_future(queue.get())
+        run(asyncio.sleep(0))
+
+        # the wakeup is passed on to the next waiter
+        queue.put_nowait(1)
+        task1.cancel()
+        self.assertEqual(run(task2), 1)
+
+    def test_close(self):
+        queue = ClosableQueue()
+        queue.put_nowait(1)
+        queue.close()
+        self.assertTrue(queue.closed)
+
+        # items put before closing are still delivered, later ones are dropped
+        queue.put_nowait(2)
+        self.assertEqual(run(queue.get()), 1)
+        with self.assertRaises(ConnectionError):
+            run(queue.get())
+        with self.assertRaises(ConnectionError):
+            queue.get_nowait()
+
+    def test_close_waiting(self):
+        queue = ClosableQueue()
+        task = asyncio.ensure_future(queue.get())
+        run(asyncio.sleep(0))
+
+        queue.close()
+        with self.assertRaises(ConnectionError):
+            run(task)
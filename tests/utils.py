@@ -1,12 +1,12 @@
 import asyncio
 import os
 
-from aiortc.utils import first_completed
+from aiortc.utils import ClosableQueue
 
 
 def dummy_transport_pair():
-    queue_a = asyncio.Queue()
-    queue_b = asyncio.Queue()
+    queue_a = ClosableQueue()
+    queue_b = ClosableQueue()
     return (
         DummyTransport(rx_queue=queue_a, tx_queue=queue_b),
         DummyTransport(rx_queue=queue_b, tx_queue=queue_a),
@@ -16,23 +16,31 @@ def dummy_transport_pair():
 class DummyTransport:
     def __init__(self, rx_queue, tx_queue):
         self.closed = asyncio.Event()
+        self.loss = []
         self.rx_queue = rx_queue
         self.tx_queue = tx_queue
+        self.tx_count = 0
 
     async def close(self):
         self.closed.set()
+        self.rx_queue.close()
 
     async def recv(self):
-        data = await first_completed(self.rx_queue.get(), self.closed.wait())
-        if data is True:
-            raise ConnectionError
-        return data
+        return await self.rx_queue.get()
 
     async def send(self, data):
         if self.closed.is_set():
             raise ConnectionError
+        self.tx_count += 1
+        if (self.tx_count - 1) in self.loss:
+            # simulate a lost datagram
+            return
         await self.tx_queue.put(data)
 
+    async def send_batch(self, batch):
+        for data in batch:
+            await self.send(data)
+
 
 def load(name):
     path = os.path.join(os.path.dirname(__file__), name)